@@ -0,0 +1,130 @@
+import argparse
+import gzip
+import json
+import random
+import sys
+import time
+
+
+AUTH = "auth"
+NGINX = "nginx"
+
+API_PATHS = ["/api/v1/login", "/api/v1/users", "/api/health", "/v1/ping", "/auth/token"]
+STATIC_PATHS = ["/", "/index.html", "/static/app.js", "/css/site.css", "/img/logo.png", "/favicon.ico"]
+USERS = ["root", "admin", "ubuntu", "test", "oracle", "git", "postgres", "deploy"]
+
+
+def syslog_stamp(ts):
+    t = time.localtime(ts)
+    return f"{time.strftime('%b', t)} {t.tm_mday:2d} {time.strftime('%H:%M:%S', t)}"
+
+
+def nginx_stamp(ts):
+    return time.strftime("%d/%b/%Y:%H:%M:%S +0000", time.gmtime(ts))
+
+
+def make_ip(n):
+    return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}"
+
+
+class LoadGen:
+    # Background traffic from `ips` distinct sources, plus `attack_share` of
+    # the lines coming from `attackers` sources (brute force on auth.log,
+    # API floods on the access log)
+    def __init__(self, kind, ips=10000, attack_share=0.01, attackers=5, api_share=0.2, seed=1):
+        if kind not in (AUTH, NGINX):
+            raise ValueError(f"unknown log kind: {kind}")
+        self.kind = kind
+        self.ips = max(1, int(ips))
+        self.attack_share = float(attack_share)
+        self.attackers = [f"203.0.{113 + i // 254}.{i % 254 + 1}" for i in range(max(1, int(attackers)))]
+        self.api_share = float(api_share)
+        self.rnd = random.Random(seed)
+
+    def line(self, ts):
+        rnd = self.rnd
+        attack = rnd.random() < self.attack_share
+        ip = rnd.choice(self.attackers) if attack else make_ip(rnd.randrange(self.ips))
+        if self.kind == AUTH:
+            host = f"{syslog_stamp(ts)} web sshd[{rnd.randrange(1000, 99999)}]:"
+            if attack:
+                user = rnd.choice(USERS)
+                if rnd.random() < 0.5:
+                    return f"{host} Failed password for invalid user {user} from {ip} port 22 ssh2"
+                return f"{host} Failed password for {user} from {ip} port 22 ssh2"
+            if rnd.random() < 0.02:
+                return f"{host} Failed password for deploy from {ip} port 22 ssh2"
+            return f"{host} Accepted publickey for deploy from {ip} port 22 ssh2: RSA SHA256:x"
+        if attack or rnd.random() < self.api_share:
+            path = rnd.choice(API_PATHS)
+        else:
+            path = rnd.choice(STATIC_PATHS)
+        return (
+            f'{ip} - - [{nginx_stamp(ts)}] "GET {path} HTTP/1.1" 200 512 "-" '
+            f'"Mozilla/5.0 (X11; Linux x86_64)"'
+        )
+
+    def lines(self, n, rate, start=None):
+        # Event time advances at `rate` lines per second whatever the write speed
+        ts = time.time() if start is None else start
+        step = 1.0 / rate if rate > 0 else 0.0
+        for i in range(n):
+            yield self.line(ts + i * step)
+
+
+def write_file(path, gen, n, rate, start=None):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        for line in gen.lines(n, rate, start):
+            f.write(line + "\n")
+
+
+def append_live(path, gen, rate, duration, batch=0.05):
+    # Writes in real time, stamping lines with the wall clock
+    written = 0
+    started = time.time()
+    with open(path, "a", encoding="utf-8") as f:
+        while True:
+            now = time.time()
+            if now - started >= duration:
+                break
+            due = int((now - started) * rate) - written
+            for _ in range(max(0, due)):
+                f.write(gen.line(now) + "\n")
+            written += max(0, due)
+            f.flush()
+            time.sleep(batch)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetic auth.log / nginx access log generator")
+    parser.add_argument("kind", choices=[AUTH, NGINX])
+    parser.add_argument("out", help="output file (.gz is compressed)")
+    parser.add_argument("--lines", type=int, default=100000, help="lines to write (offline mode)")
+    parser.add_argument("--rate", type=float, default=1000.0, help="lines per second of event time")
+    parser.add_argument("--ips", type=int, default=10000, help="distinct background IPs")
+    parser.add_argument("--attack-share", type=float, default=0.01)
+    parser.add_argument("--attackers", type=int, default=5)
+    parser.add_argument("--api-share", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--live", type=float, metavar="SEC", help="append in real time for SEC seconds")
+    args = parser.parse_args(argv)
+
+    gen = LoadGen(args.kind, args.ips, args.attack_share, args.attackers, args.api_share, args.seed)
+    started = time.perf_counter()
+    if args.live:
+        written = append_live(args.out, gen, args.rate, args.live)
+    else:
+        write_file(args.out, gen, args.lines, args.rate)
+        written = args.lines
+    json.dump(
+        {"kind": args.kind, "out": args.out, "lines": written, "seconds": round(time.perf_counter() - started, 3)},
+        sys.stdout,
+    )
+    sys.stdout.write("\n")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
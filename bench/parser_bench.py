@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nginx_parser import FORMAT_COMBINED, FORMAT_JSON, AccessLogParser  # noqa: E402
+
+
+PREFIXES = ["/api/", "/v1/", "/auth/"]
+PATHS = ["/api/v1/login", "/api/users/42?page=2", "/v1/ping", "/auth/token"] + [
+    "/static/app.js",
+    "/index.html",
+    "/img/logo.png",
+    "/favicon.ico",
+    "/css/site.css",
+    "/blog/post-1",
+    "/",
+    "/robots.txt",
+]
+
+
+def make_lines(n, fmt, api_share):
+    rnd = random.Random(1)
+    api = PATHS[:4]
+    other = PATHS[4:]
+    out = []
+    for i in range(n):
+        path = rnd.choice(api) if rnd.random() < api_share else rnd.choice(other)
+        ip = f"10.{i % 7}.{(i >> 3) % 256}.{i % 251}"
+        second = (i // 500) % 60
+        if fmt == FORMAT_JSON:
+            rec = {
+                "time_local": f"18/Oct/2026:12:00:{second:02d} +0500",
+                "remote_addr": ip,
+                "request_method": "GET",
+                "request_uri": path,
+                "status": 200,
+                "body_bytes_sent": 512,
+                "http_user_agent": "Mozilla/5.0 (X11; Linux x86_64)",
+            }
+            out.append(json.dumps(rec, separators=(",", ":")).encode())
+        else:
+            out.append(
+                f'{ip} - - [18/Oct/2026:12:00:{second:02d} +0500] "GET {path} HTTP/1.1" 200 512 '
+                f'"-" "Mozilla/5.0 (X11; Linux x86_64)"'.encode()
+            )
+    return out
+
+
+def run(lines, fmt):
+    parser = AccessLogParser(PREFIXES, fmt)
+    parse = parser.parse
+    start = time.perf_counter()
+    hits = 0
+    for raw in lines:
+        if parse(raw) is not None:
+            hits += 1
+    elapsed = time.perf_counter() - start
+    return {"format": fmt, "lines": len(lines), "api_hits": hits, "lines_per_sec": int(len(lines) / elapsed)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="nginx access-log parser micro-benchmark")
+    ap.add_argument("--lines", type=int, default=500000)
+    ap.add_argument("--api-share", type=float, default=0.1)
+    args = ap.parse_args()
+    results = [run(make_lines(args.lines, fmt, args.api_share), fmt) for fmt in (FORMAT_COMBINED, FORMAT_JSON)]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,584 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+# Never pick up the real bot token or chat ids from .env, and never talk to
+# api.telegram.org: everything goes to the local stub
+BENCH_ENV = {
+    "SECURITY_BOT_ENV": os.devnull,
+    "TELEGRAM_BOT_TOKEN": "bench",
+    "TELEGRAM_CHAT_ID": "1001,1002",
+    "TELEGRAM_API_URL": "http://127.0.0.1:9",
+    "TELEGRAM_CHAT_RATE": "0",
+    "TELEGRAM_GLOBAL_RATE": "0",
+    "TELEGRAM_DIGEST_WINDOW_SEC": "0",
+}
+os.environ.update(BENCH_ENV)
+
+from loadgen import AUTH, NGINX, LoadGen, make_ip, nginx_stamp, syslog_stamp  # noqa: E402
+from stub_telegram import StubTelegram  # noqa: E402
+
+SCENARIOS = ("parse", "parallel", "memory", "latency", "delivery", "fleet", "iplists", "snapshot")
+BLOCK_LINES = 10000
+
+
+def _watcher_cls(kind):
+    if kind == AUTH:
+        from ssh_watch import SSHWatcher
+
+        return SSHWatcher
+    from nginx_watch import NginxWatcher
+
+    return NginxWatcher
+
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    idx = min(len(values) - 1, max(0, int(round(q * (len(values) - 1)))))
+    return values[idx]
+
+
+def bench_parse(lines, attack_share):
+    out = {}
+    for kind in (AUTH, NGINX):
+        gen = LoadGen(kind, ips=50000, attack_share=attack_share, attackers=20)
+        data = [line.encode() for line in gen.lines(lines, rate=2000, start=time.time() - lines / 2000)]
+        alerts = []
+        watcher = _watcher_cls(kind)(emit=alerts.append, live=False)
+        started = time.perf_counter()
+        for i in range(0, len(data), BLOCK_LINES):
+            watcher.feed(data[i : i + BLOCK_LINES])
+        elapsed = time.perf_counter() - started
+        out[kind] = {
+            "lines": lines,
+            "lines_per_sec": int(lines / elapsed),
+            "alerts": len(alerts),
+        }
+    return out
+
+
+def _cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat", "rb") as f:
+        fields = f.read().rsplit(b")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def _alert_key(message):
+    return message.template.kind, tuple(sorted(message.values.items()))
+
+
+def bench_parallel(lines, attack_share, workers):
+    # nginx_watch --workers N against the single-process watcher on the same
+    # lines. stage_cpu_sec is the CPU each process used; with a core per
+    # process the busiest one bounds throughput (projected_lines_per_sec).
+    from nginx_watch import make_watcher
+
+    gen = LoadGen(NGINX, ips=50000, attack_share=attack_share, attackers=20, api_share=0.5)
+    data = [line.encode() for line in gen.lines(lines, rate=2000, start=time.time() - lines / 2000)]
+    out = {"cpus": os.cpu_count(), "lines": lines}
+    baseline = None
+    for n in [0] + workers:
+        alerts = []
+        watcher = make_watcher(n, emit=alerts.append, live=False)
+        procs = getattr(watcher, "_procs", [])
+        cpu0 = {p.name: _cpu_seconds(p.pid) for p in procs}
+        cpu0["main"] = time.process_time()
+        started = time.perf_counter()
+        for i in range(0, len(data), BLOCK_LINES):
+            watcher.feed(data[i : i + BLOCK_LINES])
+        watcher.flush()
+        elapsed = time.perf_counter() - started
+        cpu = {p.name: round(_cpu_seconds(p.pid) - cpu0[p.name], 3) for p in procs}
+        cpu["main"] = round(time.process_time() - cpu0["main"], 3)
+        watcher.close()
+        got = sorted(_alert_key(m) for m in alerts)
+        if baseline is None:
+            baseline = got
+        out[f"workers_{n}"] = {
+            "lines_per_sec": int(lines / elapsed),
+            "alerts": len(got),
+            "same_alerts": got == baseline,
+            "stage_cpu_sec": cpu,
+            "projected_lines_per_sec": int(lines / max(cpu.values())) if max(cpu.values()) > 0 else None,
+        }
+    return out
+
+
+def _peak_rss():
+    # VmHWM belongs to this exec'd image; ru_maxrss on Linux keeps the
+    # parent's high-water mark across fork + exec
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _child_rss(kind, n):
+    # Runs in a fresh interpreter so the peak RSS belongs to this watcher only
+    watcher = _watcher_cls(kind)(emit=lambda _m: None, live=False)
+    ts = time.time() - 30
+    for start in range(0, n, BLOCK_LINES):
+        block = []
+        for i in range(start, min(n, start + BLOCK_LINES)):
+            ip = make_ip(i)
+            if kind == AUTH:
+                block.append(f"{syslog_stamp(ts)} web sshd[1]: Failed password for root from {ip} port 22 ssh2".encode())
+            else:
+                block.append(f'{ip} - - [{nginx_stamp(ts)}] "GET /api/v1/login HTTP/1.1" 200 1 "-" "x"'.encode())
+        watcher.feed(block)
+    counter = watcher.attempts if kind == AUTH else watcher.hits
+    return {"peak_rss_bytes": _peak_rss(), "tracked": len(counter)}
+
+
+def bench_memory(ips):
+    out = {}
+    for kind in (AUTH, NGINX):
+        res = {}
+        for n in (0, ips):
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child-rss", kind, str(n)],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            res[n] = json.loads(proc.stdout)
+        base = res[0]["peak_rss_bytes"]
+        peak = res[ips]["peak_rss_bytes"]
+        tracked = res[ips]["tracked"]
+        out[kind] = {
+            "tracked_ips": tracked,
+            "baseline_rss_bytes": base,
+            "peak_rss_bytes": peak,
+            "bytes_per_ip": int((peak - base) / tracked) if tracked else None,
+        }
+    return out
+
+
+def bench_latency(samples, timeout):
+    # Append a burst to a real ssh_watch.py process and time it to the stub
+    stub = StubTelegram().start()
+    tmp = tempfile.mkdtemp(prefix="security-bot-bench-")
+    log = os.path.join(tmp, "auth.log")
+    open(log, "w").close()
+    env = dict(os.environ)
+    env.update(BENCH_ENV)
+    env.update(
+        {
+            "TELEGRAM_API_URL": stub.url,
+            "AUTH_LOG": log,
+            "SECURITY_BOT_STATE_DIR": tmp,
+            "TAIL_CHECKPOINTS": "0",
+            "SSH_BRUTE_THRESHOLD": "5",
+        }
+    )
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "ssh_watch.py")], env=env)
+    latencies = []
+    missed = 0
+    try:
+        time.sleep(1.0)
+        with open(log, "a") as f:
+            for i in range(samples):
+                ip = f"198.51.100.{i % 254 + 1}"
+                stamp = syslog_stamp(time.time())
+                burst = "".join(
+                    f"{stamp} web sshd[1]: Failed password for root from {ip} port 22 ssh2\n" for _ in range(5)
+                )
+                t0 = time.time()
+                f.write(burst)
+                f.flush()
+                got = stub.wait_for(lambda p, ip=ip: f" {ip}\n" in p.get("text", "") + "\n", timeout)
+                if got is None:
+                    missed += 1
+                else:
+                    latencies.append((got[0] - t0) * 1000.0)
+    finally:
+        proc.terminate()
+        proc.wait(10)
+        stub.stop()
+    return {
+        "samples": samples,
+        "missed": missed,
+        "p50_ms": _round(_percentile(latencies, 0.5)),
+        "p95_ms": _round(_percentile(latencies, 0.95)),
+        "max_ms": _round(max(latencies) if latencies else None),
+    }
+
+
+def bench_delivery(alerts, fail_rate, latency, timeout):
+    # Alerts pushed through the real dispatcher while the API rejects a
+    # share of the calls with 429 (retry_after kept short)
+    import telegram_alert
+    from ssh_watch import SSH_ALERT
+
+    stub = StubTelegram(latency=latency, fail_rate=fail_rate, retry_after=0.05).start()
+    os.environ["TELEGRAM_API_URL"] = stub.url
+    telegram_alert.reload_config()
+    chats = len(telegram_alert.get_config().chat_ids)
+    dispatcher = telegram_alert.AlertDispatcher(maxsize=alerts)
+    started = time.perf_counter()
+    try:
+        for i in range(alerts):
+            dispatcher.submit(SSH_ALERT.message(user="root", ip=f"192.0.{2 + i // 254}.{i % 254 + 1}", time="-", server="bench"))
+        dispatcher.flush(timeout)
+        elapsed = time.perf_counter() - started
+        delivered = {(p.get("chat_id"), p.get("text")) for _at, p in stub.messages}
+    finally:
+        dispatcher.close(1.0)
+        stub.stop()
+        os.environ["TELEGRAM_API_URL"] = BENCH_ENV["TELEGRAM_API_URL"]
+        telegram_alert.reload_config()
+    return {
+        "alerts": alerts,
+        "chats": chats,
+        "fail_rate": fail_rate,
+        "api_latency_ms": latency * 1000.0,
+        "delivered_messages": len(delivered),
+        "expected_messages": alerts * chats,
+        "delivery_ratio": round(len(delivered) / float(alerts * chats), 4),
+        "alerts_sent": dispatcher.sent,
+        "alerts_failed": dispatcher.failed,
+        "api_requests": stub.requests,
+        "api_rejected": stub.rejected,
+        "seconds": round(elapsed, 3),
+    }
+
+
+def _fleet_sender(target, host, events, ips):
+    from fleet import KIND_API, EventForwarder
+
+    forwarder = EventForwarder(target, host=host)
+    ts = time.time()
+    for start in range(0, events, 1000):
+        for i in range(start, min(events, start + 1000)):
+            forwarder.add(KIND_API, make_ip(i % ips), "/api/v1/login", ts)
+        forwarder.flush()
+    forwarder.close()
+    print(json.dumps({"sent": forwarder.events, "dropped": forwarder.dropped}), flush=True)
+
+
+def _listed(text):
+    # "a (3), b (2) +4" -> 6
+    more = text.rsplit(" +", 1)
+    return text.count("(") + (int(more[1]) if len(more) == 2 else 0)
+
+
+def bench_fleet(hosts, events, senders, timeout):
+    # One aggregator on localhost. Detection: every host sees an IP below
+    # its own SSH threshold; the fleet must raise exactly one alert naming
+    # all hosts. Throughput: `senders` processes push API events as fast as
+    # they can over UDP and TCP.
+    import threading
+
+    from fleet import FLEET_SSH_THRESHOLD, KIND_SSH, EventForwarder, FleetAggregator, FleetServer
+    from ssh_watch import BRUTE_FORCE_THRESHOLD
+
+    alerts = []
+    aggregator = FleetAggregator(emit=alerts.append)
+    server = FleetServer(aggregator, "127.0.0.1:0")
+    stop = threading.Event()
+
+    def loop():
+        while not stop.is_set():
+            server.poll(0.05)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    out = {"hosts": hosts}
+    target = "%s:%d" % server.address
+    try:
+        per_host = BRUTE_FORCE_THRESHOLD - 1
+        attacker = "198.51.100.7"
+        ts = time.time()
+        for h in range(hosts):
+            forwarder = EventForwarder("tcp://" + target, host=f"web{h:02d}")
+            for i in range(per_host):
+                forwarder.add(KIND_SSH, attacker, "root", ts + h * 0.01 + i * 0.001)
+                forwarder.add(KIND_SSH, make_ip(h * 100 + i), "admin", ts)
+            forwarder.flush()
+            forwarder.close()
+        deadline = time.time() + timeout
+        while aggregator.events < hosts * per_host * 2 and time.time() < deadline:
+            time.sleep(0.01)
+        mine = [m for m in alerts if m.values.get("ip") == attacker]
+        out["detection"] = {
+            "per_host_attempts": per_host,
+            "local_threshold": BRUTE_FORCE_THRESHOLD,
+            "alerts": len(alerts),
+            "attacker_alerts": len(mine),
+            # The alert goes out when the fleet threshold is crossed and
+            # names the hosts seen by then
+            "fleet_threshold": FLEET_SSH_THRESHOLD,
+            "hosts_in_alert": _listed(mine[0].values["hosts"]) if mine else 0,
+        }
+        for proto in ("udp", "tcp"):
+            before = aggregator.events
+            started = time.perf_counter()
+            procs = [
+                subprocess.Popen(
+                    [sys.executable, "-c", "import sys, run_bench; run_bench._fleet_sender(*sys.argv[1:3], int(sys.argv[3]), 50000)", f"{proto}://{target}", f"load{i}", str(events)],
+                    cwd=HERE,
+                    stdout=subprocess.PIPE,
+                    text=True,
+                )
+                for i in range(senders)
+            ]
+            reports = [json.loads(p.communicate(timeout=timeout)[0]) for p in procs]
+            sent = sum(r["sent"] for r in reports)
+            deadline = time.time() + timeout
+            last = -1
+            # UDP has no end marker: wait until the count stops moving
+            while aggregator.events - before < sent and time.time() < deadline:
+                if aggregator.events == last:
+                    break
+                last = aggregator.events
+                time.sleep(0.2)
+            elapsed = time.perf_counter() - started
+            received = aggregator.events - before
+            out[proto] = {
+                "senders": senders,
+                "sent": sent,
+                "dropped_by_sender": sum(r["dropped"] for r in reports),
+                "received": received,
+                "loss": round(1.0 - received / float(sent), 4) if sent else None,
+                "events_per_sec": int(received / elapsed),
+            }
+        out["aggregator"] = {"batches": aggregator.batches, "bad": aggregator.bad, "tracked_keys": aggregator.tracked_keys()}
+    finally:
+        stop.set()
+        thread.join(1.0)
+        server.close()
+    return out
+
+
+def bench_iplists(prefixes, lookups, lines):
+    # Lookup rate against `prefixes` random v4/v6 ranges (a tenth of them
+    # nested in another), then nginx_watch parse cost with the list loaded.
+    # The load generator uses 10.0.0.0/8; the list stays out of it except
+    # for one /24, so nearly every line pays for a full lookup.
+    import ipaddress
+    import random
+
+    import iplists
+    from nginx_watch import NginxWatcher
+
+    rng = random.Random(7)
+    private = ipaddress.ip_network("10.0.0.0/8")
+    nets = []
+    for i in range(prefixes):
+        if i % 10 == 9 and nets:
+            outer = nets[rng.randrange(len(nets))]
+            if outer.prefixlen < outer.max_prefixlen:
+                nets.append(next(outer.subnets(new_prefix=outer.prefixlen + 1)))
+                continue
+        if i % 4 == 3:
+            nets.append(ipaddress.ip_network((rng.getrandbits(128), rng.randint(32, 64)), strict=False))
+        else:
+            net = ipaddress.ip_network((rng.getrandbits(32), rng.randint(12, 28)), strict=False)
+            nets.append(net if not net.overlaps(private) else ipaddress.ip_network(f"11.{i % 256}.{i // 256 % 256}.0/24"))
+    nets.append(ipaddress.ip_network("10.0.0.0/24"))
+    tmp = tempfile.mkdtemp(prefix="bench-iplists-")
+    path = os.path.join(tmp, "cdn.txt")
+    with open(path, "w") as f:
+        f.write("".join(f"{net}\n" for net in nets))
+    out = {"prefixes": prefixes}
+    started = time.perf_counter()
+    lists = iplists.IPLists(allow=[path], deny=[path])
+    out["build_sec"] = round((time.perf_counter() - started) / 2, 3)
+
+    inside = []
+    for net in rng.sample(nets, min(len(nets), 1000)):
+        inside.append(str(net.network_address + rng.randrange(min(net.num_addresses, 1 << 16))))
+    outside = [str(ipaddress.ip_address(rng.getrandbits(32))) for _ in range(1000)]
+    for name, ips in (("hit", inside), ("random_v4", outside)):
+        lookup = lists.allowed
+        rounds = max(1, lookups // len(ips))
+        started = time.perf_counter()
+        found = 0
+        for _ in range(rounds):
+            for ip in ips:
+                if lookup(ip):
+                    found += 1
+        elapsed = time.perf_counter() - started
+        out[name] = {"lookups_per_sec": int(rounds * len(ips) / elapsed), "matched": round(found / float(rounds * len(ips)), 3)}
+
+    gen = LoadGen(NGINX, ips=50000, attack_share=0.05, attackers=20, api_share=0.5)
+    data = [line.encode() for line in gen.lines(lines, rate=2000, start=time.time() - lines / 2000)]
+    for name, spec in (("feed_without_list", None), ("feed_with_list", path)):
+        iplists.IP_ALLOWLIST = spec or ""
+        watcher = NginxWatcher(emit=lambda _m: None, live=False)
+        started = time.perf_counter()
+        for i in range(0, len(data), BLOCK_LINES):
+            watcher.feed(data[i : i + BLOCK_LINES])
+        elapsed = time.perf_counter() - started
+        out[name] = {"lines_per_sec": int(lines / elapsed), "excluded": watcher.excluded}
+    iplists.IP_ALLOWLIST = ""
+    os.unlink(path)
+    os.rmdir(tmp)
+    return out
+
+
+def _restarted(make, data, path):
+    # Alerts of one watcher fed everything, and of one stopped halfway,
+    # snapshotted and continued by a fresh watcher restored from the file
+    from state import read_snapshot, write_snapshot
+
+    alerts = []
+    watcher = make(alerts.append)
+    for i in range(0, len(data), BLOCK_LINES):
+        watcher.feed(data[i : i + BLOCK_LINES])
+    watcher.flush()
+    watcher.close()
+    expected = sorted(_alert_key(m) for m in alerts)
+
+    half = len(data) // 2 // BLOCK_LINES * BLOCK_LINES
+    alerts = []
+    watcher = make(alerts.append)
+    for i in range(0, half, BLOCK_LINES):
+        watcher.feed(data[i : i + BLOCK_LINES])
+    write_snapshot(path, watcher.snapshot())
+    watcher.close()
+    watcher = make(alerts.append)
+    watcher.restore(read_snapshot(path))
+    for i in range(half, len(data), BLOCK_LINES):
+        watcher.feed(data[i : i + BLOCK_LINES])
+    watcher.flush()
+    watcher.close()
+    return {"alerts": len(expected), "same_alerts": sorted(_alert_key(m) for m in alerts) == expected}
+
+
+def bench_snapshot(keys, lines, attack_share, workers):
+    # Save and restore of `keys` tracked IPs (nginx flood windows, a quarter
+    # of them with an alert cooldown), then the same log fed with and
+    # without a restart halfway
+    from nginx_watch import FLOOD_WINDOW_SEC, NginxWatcher, make_watcher
+    from state import read_snapshot, write_snapshot
+
+    out = {"keys": keys}
+    watcher = NginxWatcher(emit=lambda m: None, live=False, max_keys=keys + 1)
+    start = time.time() - FLOOD_WINDOW_SEC
+    step = FLOOD_WINDOW_SEC / keys
+    events = [(make_ip(i), "/api/login", start + i * step) for i in range(keys)]
+    for i in range(0, keys, BLOCK_LINES):
+        watcher.flood(events[i : i + BLOCK_LINES])
+    for i in range(0, keys, 4):
+        watcher.hits.get(events[i][0]).alert = events[i][2]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "snapshot.bin")
+        started = time.perf_counter()
+        write_snapshot(path, watcher.snapshot())
+        out["save_sec"] = _round(time.perf_counter() - started)
+        out["file_mb"] = _round(os.path.getsize(path) / 2**20)
+        restored = NginxWatcher(emit=lambda m: None, live=False, max_keys=keys + 1)
+        started = time.perf_counter()
+        restored.restore(read_snapshot(path))
+        out["restore_sec"] = _round(time.perf_counter() - started)
+        # Restored keys are thawed when first seen again
+        later = [(ip, path_, ts + 1) for ip, path_, ts in events[: BLOCK_LINES * 10]]
+        started = time.perf_counter()
+        for i in range(0, len(later), BLOCK_LINES):
+            restored.flood(later[i : i + BLOCK_LINES])
+        out["thaw_events_per_sec"] = int(len(later) / (time.perf_counter() - started))
+        out["same_counts"] = all(
+            restored.hits.count(ip, ts) == watcher.hits.add(ip, ts) for ip, _p, ts in later[:1000]
+        )
+        started = time.perf_counter()
+        write_snapshot(path, restored.snapshot())
+        out["save_after_restore_sec"] = _round(time.perf_counter() - started)
+        del watcher, restored, events, later
+
+        gen = LoadGen(NGINX, ips=50000, attack_share=attack_share, attackers=20, api_share=0.5)
+        data = [line.encode() for line in gen.lines(lines, rate=2000, start=time.time() - lines / 2000)]
+        for n in [0] + workers:
+            out[f"restart_workers_{n}"] = _restarted(lambda emit: make_watcher(n, emit=emit, live=False), data, path)
+    return out
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline detection and delivery benchmarks (JSON output)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated: " + ",".join(SCENARIOS))
+    parser.add_argument("--lines", type=int, default=200000, help="parse: lines per log kind")
+    parser.add_argument("--attack-share", type=float, default=0.05)
+    parser.add_argument("--workers", default="1,2,4", help="parallel: comma separated worker counts")
+    parser.add_argument("--ips", type=int, default=100000, help="memory: distinct tracked IPs")
+    parser.add_argument("--samples", type=int, default=20, help="latency: bursts appended")
+    parser.add_argument("--alerts", type=int, default=50, help="delivery: alerts sent")
+    parser.add_argument("--fail-rate", type=float, default=0.3, help="delivery: share of calls answered 429")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="delivery: seconds per API call")
+    parser.add_argument("--hosts", type=int, default=20, help="fleet: forwarding hosts in the detection check")
+    parser.add_argument("--fleet-events", type=int, default=200000, help="fleet: events per sender process")
+    parser.add_argument("--senders", type=int, default=2, help="fleet: sender processes")
+    parser.add_argument("--prefixes", type=int, default=50000, help="iplists: CIDR ranges loaded")
+    parser.add_argument("--lookups", type=int, default=1000000, help="iplists: lookups timed per case")
+    parser.add_argument("--keys", type=int, default=1000000, help="snapshot: tracked IPs saved and restored")
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--out", help="also write the JSON here")
+    parser.add_argument("--child-rss", nargs=2, metavar=("KIND", "N"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child_rss:
+        kind, n = args.child_rss
+        print(json.dumps(_child_rss(kind, int(n))))
+        return 0
+
+    wanted = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = [s for s in wanted if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+    results = {}
+    if "parse" in wanted:
+        results["parse"] = bench_parse(args.lines, args.attack_share)
+    if "parallel" in wanted:
+        workers = [int(n) for n in args.workers.split(",") if n.strip()]
+        results["parallel"] = bench_parallel(args.lines, args.attack_share, workers)
+    if "memory" in wanted:
+        results["memory"] = bench_memory(args.ips)
+    if "latency" in wanted:
+        results["latency"] = bench_latency(args.samples, min(args.timeout, 10.0))
+    if "delivery" in wanted:
+        results["delivery"] = bench_delivery(args.alerts, args.fail_rate, args.api_latency, args.timeout)
+    if "fleet" in wanted:
+        results["fleet"] = bench_fleet(args.hosts, args.fleet_events, args.senders, args.timeout)
+    if "iplists" in wanted:
+        results["iplists"] = bench_iplists(args.prefixes, args.lookups, args.lines)
+    if "snapshot" in wanted:
+        workers = [int(n) for n in args.workers.split(",") if n.strip()]
+        results["snapshot"] = bench_snapshot(args.keys, args.lines, args.attack_share, workers)
+
+    report = {
+        "timestamp": int(time.time()),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
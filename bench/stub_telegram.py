@@ -0,0 +1,135 @@
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubTelegram:
+    # Local stand-in for the Bot API: records sendMessage calls and can add
+    # latency or answer a share of them with 429 Too Many Requests.
+    # `emoji` maps custom_emoji_id -> base emoji for getCustomEmojiStickers.
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, fail_rate=0.0, retry_after=1.0, seed=1, emoji=None):
+        self.latency = float(latency)
+        self.fail_rate = float(fail_rate)
+        self.retry_after = retry_after
+        self.emoji = dict(emoji or {})
+        self.emoji_calls = 0
+        self.messages = []
+        self.requests = 0
+        self.rejected = 0
+        self._rnd = random.Random(seed)
+        self._cond = threading.Condition()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *_args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    payload = json.loads(self.rfile.read(length) or b"{}")
+                except ValueError:
+                    payload = {}
+                status, body = stub.handle(self.path, payload)
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    def handle(self, path, payload):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        method = path.rsplit("/", 1)[-1]
+        if method == "getCustomEmojiStickers":
+            with self._cond:
+                self.emoji_calls += 1
+            ids = [str(i) for i in payload.get("custom_emoji_ids", [])]
+            found = [{"custom_emoji_id": i, "emoji": self.emoji[i]} for i in ids if i in self.emoji]
+            return 200, {"ok": True, "result": found}
+        if method != "sendMessage":
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+        with self._cond:
+            self.requests += 1
+            if self.fail_rate > 0 and self._rnd.random() < self.fail_rate:
+                self.rejected += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": "Too Many Requests",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            self.messages.append((time.time(), payload))
+            self._cond.notify_all()
+        return 200, {"ok": True, "result": {"message_id": len(self.messages)}}
+
+    def wait_for(self, predicate, timeout):
+        # Returns (received at, payload) of the first recorded message matching
+        deadline = time.monotonic() + timeout
+        seen = 0
+        with self._cond:
+            while True:
+                for at, payload in self.messages[seen:]:
+                    if predicate(payload):
+                        return at, payload
+                seen = len(self.messages)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-telegram", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stub Telegram Bot API for local benchmarks")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of sendMessage calls answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    stub = StubTelegram(port=args.port, latency=args.latency, fail_rate=args.fail_rate, retry_after=args.retry_after)
+    stub.start()
+    print(f"stub telegram on {stub.url} (TELEGRAM_API_URL={stub.url})", file=sys.stderr)
+    printed = 0
+    try:
+        while True:
+            time.sleep(0.5)
+            for at, payload in stub.messages[printed:]:
+                print(json.dumps({"at": at, "chat_id": payload.get("chat_id"), "text": payload.get("text")}, ensure_ascii=False))
+                printed += 1
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,12 +1,37 @@
 import argparse
-from datetime import datetime, timedelta, timezone
+import os
+import socket
+import sys
+import time
 
-from telegram_alert import send_message, md_kv, md_icon, md_title_icon, hostname
 
+# Only the standard library is imported up front: with the bot running
+# a ban is one datagram and the process exits in a few milliseconds.
+SOCKET_PATH = os.environ.get("FAIL2BAN_SOCKET", "/run/security-bot/fail2ban.sock")
 
-def now_ts():
-    tz = timezone(timedelta(hours=5))
-    return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+
+def _clean(value):
+    return str(value).replace("\t", " ").replace("\n", " ")
+
+
+def send_event(jail, ip, ts, path=SOCKET_PATH, timeout=0.5):
+    data = f"ban\t{_clean(jail)}\t{_clean(ip)}\t{ts:.3f}\n".encode("utf-8")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(data, path)
+
+
+def send_direct(jail, ip, ts):
+    # Bot not running: send to Telegram from this process. The fail2ban
+    # action runs us with "python3 -S", so enable site-packages first.
+    if sys.flags.no_site:
+        import site
+
+        site.main()
+    from fail2ban_watch import BAN_ALERT, format_ts
+    from telegram_alert import send_message, hostname
+
+    send_message(BAN_ALERT.message(jail=jail, ip=ip, time=format_ts(ts), server=hostname()))
 
 
 def main():
@@ -15,16 +40,13 @@ def main():
     parser.add_argument("--ip", required=True, help="Bloklangan IP manzil")
     args = parser.parse_args()
 
-    msg = "\n".join(
-        [
-            md_title_icon(md_icon("FAIL2BAN_TITLE", "🚫"), "Fail2Ban: IP bloklandi"),
-            md_kv(md_icon("JAIL", "🧷"), "Qamoq", args.jail),
-            md_kv(md_icon("IP", "🌍"), "IP", args.ip),
-            md_kv(md_icon("TIME", "⏰"), "Vaqt", now_ts()),
-            md_kv(md_icon("SERVER", "🖥️"), "Server", hostname()),
-        ]
-    )
-    send_message(msg)
+    ts = time.time()
+    try:
+        send_event(args.jail, args.ip, ts)
+        return
+    except OSError:
+        pass
+    send_direct(args.jail, args.ip, ts)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+import os
+import select
+import signal
+import socket
+from datetime import datetime, timedelta, timezone
+
+import heartbeat
+import metrics
+from telegram_alert import AlertTemplate, send_alert, hostname, prefetch_emojis, reload_config
+
+
+# fail2ban_alert.py writes one datagram per ban here:
+#   ban<TAB>jail<TAB>ip<TAB>unix time
+SOCKET_PATH = os.environ.get("FAIL2BAN_SOCKET", "/run/security-bot/fail2ban.sock")
+MAX_DATAGRAM = 4096
+
+BAN_ALERT = AlertTemplate(
+    ("FAIL2BAN_TITLE", "🚫"),
+    "Fail2Ban: IP bloklandi",
+    [
+        ("jail", "JAIL", "🧷", "Qamoq"),
+        ("ip", "IP", "🌍", "IP"),
+        ("time", "TIME", "⏰", "Vaqt"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="fail2ban_ban",
+    digest_keys=("jail", "ip"),
+)
+
+
+def format_ts(ts=None):
+    tz = timezone(timedelta(hours=5))
+    dt = datetime.now(tz) if ts is None else datetime.fromtimestamp(ts, tz)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_event(data):
+    parts = data.decode("utf-8", "ignore").rstrip("\n").split("\t")
+    if len(parts) < 3 or parts[0] != "ban" or not parts[2]:
+        return None
+    ts = None
+    if len(parts) > 3:
+        try:
+            ts = float(parts[3])
+        except ValueError:
+            ts = None
+    return parts[1], parts[2], ts
+
+
+class Fail2banWatcher:
+    def __init__(self, emit=send_alert, path=SOCKET_PATH):
+        self.emit = emit
+        self.path = path
+        self.sock = None
+        self.events = 0
+        self.alerts = 0
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o660)
+        sock.setblocking(False)
+        self.sock = sock
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    # Reads every queued ban; the dispatcher merges a ban wave into digests
+    def drain(self):
+        while True:
+            try:
+                data = self.sock.recv(MAX_DATAGRAM)
+            except (BlockingIOError, InterruptedError):
+                return
+            event = parse_event(data)
+            if event is None:
+                continue
+            jail, ip, ts = event
+            self.events += 1
+            self.alerts += 1
+            self.emit(BAN_ALERT.message(jail=jail, ip=ip, time=format_ts(ts), server=hostname()))
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+def main():
+    watcher = Fail2banWatcher()
+    watcher.open()
+    metrics.register_watcher("fail2ban_watch", watcher)
+    metrics.serve()
+    prefetch_emojis()
+    beat = heartbeat.from_env()
+    # Bans can be hours apart; wake up anyway to report being alive
+    timeout = beat.interval if beat is not None else None
+    try:
+        while True:
+            select.select([watcher.sock], [], [], timeout)
+            watcher.drain()
+            if beat is not None:
+                beat.beat(watcher.events)
+    finally:
+        watcher.close()
+
+
+def _handle_term(_sig, _frame):
+    raise SystemExit(0)
+
+
+def _handle_hup(_sig, _frame):
+    # Alert settings only; this watcher keeps no detection windows
+    reload_config()
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _handle_term)
+    signal.signal(signal.SIGHUP, _handle_hup)
+    try:
+        main()
+    except Exception as e:
+        print(f"fail2ban_watch error: {e}")
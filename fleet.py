@@ -0,0 +1,560 @@
+import argparse
+import hashlib
+import hmac
+import ipaddress
+import os
+import queue
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+
+import metrics
+from telegram_alert import AlertTemplate, get_config, send_alert, hostname, prefetch_emojis
+from windows import EventClock, WindowedCounter
+
+
+def load_settings():
+    # Read once the env file is loaded; the aggregator and forwarders
+    # need a restart to pick up changes
+    global FLEET_FORWARD, FLEET_HOST, FLEET_LOCAL_ALERTS, FLEET_MAX_BATCH, FLEET_QUEUE, FLEET_SECRET
+    global FLEET_LISTEN, FLEET_SSH_WINDOW_SEC, FLEET_SSH_THRESHOLD, FLEET_API_WINDOW_SEC, FLEET_API_THRESHOLD
+    global FLEET_COOLDOWN_SEC, FLEET_MIN_HOSTS, FLEET_MAX_TRACKED_IPS
+    # The env file may set them too; it is read at most once here
+    get_config()
+    # Watchers ship parsed events here: "udp://host:port" or "tcp://host:port"
+    FLEET_FORWARD = os.environ.get("FLEET_FORWARD", "").strip()
+    # Name this host reports; defaults to the hostname
+    FLEET_HOST = os.environ.get("FLEET_HOST", "").strip()
+    # 0: a forwarding watcher leaves the per-IP alerts the aggregator also
+    # detects (SSH bruteforce, API flood) to the aggregator; other alerts stay local
+    FLEET_LOCAL_ALERTS = os.environ.get("FLEET_LOCAL_ALERTS", "1").strip() != "0"
+    # Bytes per UDP datagram or TCP frame; 1400 stays under a usual MTU
+    FLEET_MAX_BATCH = int(os.environ.get("FLEET_MAX_BATCH", "1400"))
+    # Batches waiting for the sender thread; beyond that they are dropped
+    FLEET_QUEUE = int(os.environ.get("FLEET_QUEUE", "1024"))
+    # Shared by every host and the aggregator: each datagram/frame carries an
+    # HMAC-SHA256 of it. The aggregator needs it to listen beyond loopback.
+    FLEET_SECRET = os.environ.get("FLEET_SECRET", "")
+
+    # Aggregator
+    FLEET_LISTEN = os.environ.get("FLEET_LISTEN", "127.0.0.1:9500")
+    FLEET_SSH_WINDOW_SEC = int(os.environ.get("FLEET_SSH_WINDOW_SEC", "300"))
+    FLEET_SSH_THRESHOLD = int(os.environ.get("FLEET_SSH_THRESHOLD", "20"))
+    FLEET_API_WINDOW_SEC = int(os.environ.get("FLEET_API_WINDOW_SEC", "60"))
+    FLEET_API_THRESHOLD = int(os.environ.get("FLEET_API_THRESHOLD", "300"))
+    # One alert per IP (any attack type) per cooldown
+    FLEET_COOLDOWN_SEC = int(os.environ.get("FLEET_COOLDOWN_SEC", "600"))
+    # Attacks seen on fewer hosts are left to the local watchers, unless one of
+    # those hosts forwards with FLEET_LOCAL_ALERTS=0
+    FLEET_MIN_HOSTS = int(os.environ.get("FLEET_MIN_HOSTS", "2"))
+    FLEET_MAX_TRACKED_IPS = int(os.environ.get("FLEET_MAX_TRACKED_IPS", "200000"))
+
+
+load_settings()
+
+FLEET_TOP = 10
+
+MAGIC = b"SBF1\t"
+MAX_FRAME = 1 << 20
+TAG_LEN = hashlib.sha256().digest_size
+KIND_SSH = "s"
+KIND_API = "a"
+# Alert kinds the aggregator raises itself from forwarded events
+FLEET_DETECTED = frozenset(("ssh_brute", "api_flood"))
+
+
+FLEET_ALERT = AlertTemplate(
+    ("FLEET_TITLE", "🛰️"),
+    "Bir nechta serverga hujum aniqlandi",
+    [
+        ("ip", "IP", "🌍", "IP"),
+        ("attack", "ATTACK", "⚔️", "Hujum"),
+        ("count", "RATE", "📈", "Urinishlar"),
+        ("hosts", "SERVER", "🖥️", "Serverlar"),
+        ("detail", "USER", "👤", "Eng ko'p"),
+        ("server", "SERVER", "🛰️", "Agregator"),
+    ],
+    kind="fleet_attack",
+    digest_keys=("ip", "attack"),
+)
+
+
+def parse_target(target, default_proto="udp"):
+    proto, sep, rest = target.partition("://")
+    if not sep:
+        proto, rest = default_proto, target
+    host, _, port = rest.rpartition(":")
+    host = host.strip("[]") or "127.0.0.1"
+    if proto not in ("udp", "tcp"):
+        raise ValueError(f"unknown fleet transport: {proto}")
+    return proto, (host, int(port))
+
+
+def _tag(key, payload):
+    return hmac.new(key, payload, hashlib.sha256).digest()
+
+
+def _clean(value):
+    return str(value).replace("\t", " ").replace("\n", " ")
+
+
+def local_emit(emit, live):
+    if live and FLEET_FORWARD and not FLEET_LOCAL_ALERTS:
+
+        def emit_local(message):
+            if message.template.kind not in FLEET_DETECTED:
+                emit(message)
+
+        return emit_local
+    return emit
+
+
+class EventForwarder:
+    # Records are "kind\tip\tuser-or-route\tevent time\n" after a
+    # "SBF1\thost" line ("SBF1\thost\tq" when the host raises no alerts
+    # of its own for FLEET_DETECTED kinds), packed up to max_batch bytes per datagram (UDP)
+    # or length-prefixed frame (TCP), behind an HMAC tag when a secret is
+    # set. A thread does the sending; the feed path only queues, and a
+    # batch that does not fit or cannot be sent is dropped: the local
+    # watcher still has the events.
+    def __init__(self, target, host=None, max_batch=FLEET_MAX_BATCH, secret=FLEET_SECRET, queue_size=FLEET_QUEUE, quiet=False):
+        self.proto, self.addr = parse_target(target)
+        self.key = secret.encode("utf-8") if secret else None
+        self.header = MAGIC + _clean(host or hostname()).encode("utf-8") + (b"\tq\n" if quiet else b"\n")
+        tag_len = TAG_LEN if self.key is not None else 0
+        self.max_batch = max(len(self.header) + 64, int(max_batch) - tag_len)
+        # events/batches/failed belong to the sender thread, shed to the feed path
+        self.events = 0
+        self.batches = 0
+        self.failed = 0
+        self.shed = 0
+        self._buf = []
+        self._size = len(self.header)
+        self._queue = queue.Queue(max(1, int(queue_size)))
+        self._thread = None
+        self._sock = None
+        self._retry_at = 0.0
+
+    @property
+    def dropped(self):
+        return self.shed + self.failed
+
+    def add(self, kind, ip, key, ts):
+        rec = f"{kind}\t{ip}\t{_clean(key)}\t{ts:.3f}\n".encode("utf-8", "replace")
+        if self._buf and self._size + len(rec) > self.max_batch:
+            self._send()
+        self._buf.append(rec)
+        self._size += len(rec)
+
+    def flush(self):
+        if self._buf:
+            self._send()
+
+    def _send(self):
+        payload = self.header + b"".join(self._buf)
+        count = len(self._buf)
+        self._buf = []
+        self._size = len(self.header)
+        if self.key is not None:
+            payload = _tag(self.key, payload) + payload
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="fleet-forwarder", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait((payload, count))
+        except queue.Full:
+            self.shed += count
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            payload, count = item
+            if self._deliver(payload):
+                self.events += count
+                self.batches += 1
+            else:
+                self.failed += count
+
+    def _connect(self):
+        now = time.monotonic()
+        if now < self._retry_at:
+            return None
+        socktype = socket.SOCK_DGRAM if self.proto == "udp" else socket.SOCK_STREAM
+        try:
+            # Resolved once per socket; a connected UDP socket sends without
+            # a lookup per datagram
+            family, socktype, proto, _name, sockaddr = socket.getaddrinfo(self.addr[0], self.addr[1], type=socktype)[0]
+            sock = socket.socket(family, socktype, proto)
+            if self.proto == "tcp":
+                sock.settimeout(5.0)
+            sock.connect(sockaddr)
+            if self.proto == "tcp":
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            self._retry_at = now + 5.0
+            print(f"fleet: cannot reach {self.proto}://{self.addr[0]}:{self.addr[1]}: {e}", file=sys.stderr)
+            return None
+        self._sock = sock
+        return sock
+
+    def _deliver(self, payload):
+        sock = self._sock or self._connect()
+        if sock is None:
+            return False
+        try:
+            if self.proto == "udp":
+                sock.send(payload)
+            else:
+                sock.sendall(struct.pack("!I", len(payload)) + payload)
+        except OSError:
+            # Nobody listening (UDP, reported by ICMP) or a broken or
+            # stalled connection (TCP)
+            if self.proto == "tcp":
+                self._close_socket()
+                self._retry_at = time.monotonic() + 1.0
+            return False
+        return True
+
+    def _close_socket(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def close(self, timeout=2.0):
+        # Sends what is queued, for up to `timeout` seconds
+        if self._thread is not None:
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                return
+            self._thread = None
+        self._close_socket()
+
+
+def make_forwarder():
+    if not FLEET_FORWARD:
+        return None
+    return EventForwarder(FLEET_FORWARD, host=FLEET_HOST or None, quiet=not FLEET_LOCAL_ALERTS)
+
+
+class _Breakdown:
+    # Per-host and per-user/route counts of one IP for the current window
+    # period and the one before it. The previous period is weighted by the
+    # share of it the sliding window still covers, so old traffic ages out
+    # of the alert text instead of piling up for the slot's lifetime.
+    __slots__ = ("epoch", "hosts", "keys", "prev_hosts", "prev_keys")
+
+    def __init__(self, epoch):
+        self.epoch = epoch
+        self.hosts = {}
+        self.keys = {}
+        self.prev_hosts = {}
+        self.prev_keys = {}
+
+    def roll(self, epoch):
+        if epoch == self.epoch + 1:
+            self.prev_hosts, self.prev_keys = self.hosts, self.keys
+        else:
+            self.prev_hosts, self.prev_keys = {}, {}
+        self.hosts, self.keys = {}, {}
+        self.epoch = epoch
+
+
+class _FleetDetector:
+    # Events per IP across every host; slot.extra holds a _Breakdown for
+    # the alert text
+    def __init__(self, label, window_sec, threshold, max_keys=FLEET_MAX_TRACKED_IPS):
+        self.label = label
+        self.window_sec = window_sec
+        self.threshold = threshold
+        self.counter = WindowedCounter(window_sec, max_keys=max_keys, idle_ttl=max(window_sec, FLEET_COOLDOWN_SEC))
+
+    def add(self, ip, host, key, ts):
+        count = self.counter.add(ip, ts)
+        slot = self.counter.get(ip)
+        epoch = int(ts // self.window_sec)
+        br = slot.extra
+        if br is None:
+            br = slot.extra = _Breakdown(epoch)
+        elif epoch > br.epoch:
+            br.roll(epoch)
+        if epoch == br.epoch:
+            hosts, keys = br.hosts, br.keys
+        elif epoch == br.epoch - 1:
+            # Late event from the previous period
+            hosts, keys = br.prev_hosts, br.prev_keys
+        else:
+            return count, slot
+        seen = hosts.get(host)
+        if seen is None:
+            hosts[host] = [1, ts]
+        else:
+            seen[0] += 1
+            if ts > seen[1]:
+                seen[1] = ts
+        if key in keys:
+            keys[key] += 1
+        elif len(keys) < 64:
+            keys[key] = 1
+        return count, slot
+
+    def _weight(self, br, ts):
+        return max(0.0, 1.0 - (ts - br.epoch * self.window_sec) / self.window_sec)
+
+    def active_hosts(self, slot, ts):
+        # Hosts with an event inside the window, busiest first
+        br = slot.extra
+        since = ts - self.window_sec
+        weight = self._weight(br, ts)
+        counts = {host: n * weight for host, (n, last) in br.prev_hosts.items() if last >= since}
+        for host, (n, _last) in br.hosts.items():
+            counts[host] = counts.get(host, 0) + n
+        return sorted(((host, max(1, round(n))) for host, n in counts.items()), key=lambda kv: kv[1], reverse=True)
+
+    def top_keys(self, slot, ts):
+        br = slot.extra
+        weight = self._weight(br, ts)
+        counts = {key: n * weight for key, n in br.prev_keys.items()}
+        for key, n in br.keys.items():
+            counts[key] = counts.get(key, 0) + n
+        return sorted(((key, round(n)) for key, n in counts.items() if round(n) > 0), key=lambda kv: kv[1], reverse=True)
+
+
+def _top(items, n=FLEET_TOP):
+    shown = ", ".join(f"{k} ({v})" for k, v in items[:n])
+    if len(items) > n:
+        shown += f" +{len(items) - n}"
+    return shown
+
+
+class FleetAggregator:
+    def __init__(self, emit=send_alert, min_hosts=FLEET_MIN_HOSTS, cooldown=FLEET_COOLDOWN_SEC, secret=FLEET_SECRET):
+        self.emit = emit
+        # Batches without a valid tag are rejected. Replays of a genuine
+        # batch are not detected; the secret keeps out hosts without it.
+        self.key = secret.encode("utf-8") if secret else None
+        self.min_hosts = max(1, int(min_hosts))
+        self.cooldown = cooldown
+        self.detectors = {
+            KIND_SSH: _FleetDetector("SSH bruteforce", FLEET_SSH_WINDOW_SEC, FLEET_SSH_THRESHOLD),
+            KIND_API: _FleetDetector("API flood", FLEET_API_WINDOW_SEC, FLEET_API_THRESHOLD),
+        }
+        # Per sending host: their clocks and lateness are independent
+        self.clocks = {}
+        # Hosts that leave FLEET_DETECTED alerts to the aggregator: attacks
+        # on them are reported even below min_hosts
+        self.quiet = set()
+        self.last_alert = {}
+        self.batches = 0
+        self.lines_read = 0
+        self.events = 0
+        self.bad = 0
+        self.rejected = 0
+        self.alerts = 0
+
+    def tracked_keys(self):
+        return sum(len(d.counter) for d in self.detectors.values())
+
+    def memory_bytes(self):
+        return sum(d.counter.memory_bytes() for d in self.detectors.values())
+
+    def ingest(self, payload):
+        if self.key is not None:
+            tag, payload = payload[:TAG_LEN], payload[TAG_LEN:]
+            if not hmac.compare_digest(tag, _tag(self.key, payload)):
+                self.rejected += 1
+                return
+        header, _, body = payload.partition(b"\n")
+        if not header.startswith(MAGIC):
+            self.bad += 1
+            return
+        host, _, flags = header[len(MAGIC) :].decode("utf-8", "replace").partition("\t")
+        if flags == "q":
+            self.quiet.add(host)
+        else:
+            self.quiet.discard(host)
+        clock = self.clocks.get(host)
+        if clock is None:
+            clock = self.clocks[host] = EventClock(live=True)
+        self.batches += 1
+        detectors = self.detectors
+        for line in body.split(b"\n"):
+            if not line:
+                continue
+            self.lines_read += 1
+            parts = line.split(b"\t")
+            if len(parts) != 4:
+                self.bad += 1
+                continue
+            det = detectors.get(parts[0].decode("ascii", "replace"))
+            try:
+                ts = float(parts[3])
+            except ValueError:
+                ts = None
+            if det is None or ts is None:
+                self.bad += 1
+                continue
+            ts = clock.observe(ts)
+            if ts is None:
+                continue
+            self.events += 1
+            ip = parts[1].decode("utf-8", "replace")
+            count, slot = det.add(ip, host, parts[2].decode("utf-8", "replace"), ts)
+            if count >= det.threshold:
+                self._check(det, ip, count, slot, ts)
+
+    def _check(self, det, ip, count, slot, ts):
+        if ts - self.last_alert.get(ip, float("-inf")) < self.cooldown:
+            return
+        hosts = det.active_hosts(slot, ts)
+        if len(hosts) < self.min_hosts and not any(host in self.quiet for host, _n in hosts):
+            return
+        if len(self.last_alert) >= FLEET_MAX_TRACKED_IPS:
+            cutoff = ts - self.cooldown
+            self.last_alert = {k: v for k, v in self.last_alert.items() if v >= cutoff}
+        self.last_alert[ip] = ts
+        keys = det.top_keys(slot, ts)
+        self.alerts += 1
+        self.emit(
+            FLEET_ALERT.message(
+                ip=ip,
+                attack=det.label,
+                count=f"{count} ({len(hosts)} server)",
+                hosts=_top(hosts),
+                detail=_top(keys, 5),
+                server=hostname(),
+            )
+        )
+
+
+def _is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class FleetServer:
+    # UDP datagrams and TCP connections (4-byte length + payload) on the
+    # same port, in one selector loop
+    def __init__(self, aggregator, listen=FLEET_LISTEN):
+        self.aggregator = aggregator
+        host, _, port = listen.rpartition(":")
+        host = host.strip("[]") or "127.0.0.1"
+        if aggregator.key is None and not _is_loopback(host):
+            raise ValueError(f"FLEET_SECRET is required to listen on {host}")
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        self.sel = selectors.DefaultSelector()
+        self.tcp = socket.socket(family, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind((host, int(port)))
+        self.tcp.listen(64)
+        self.tcp.setblocking(False)
+        self.address = self.tcp.getsockname()[:2]
+        self.udp = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            self.udp.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        except OSError:
+            pass
+        self.udp.bind(self.address)
+        self.udp.setblocking(False)
+        self.sel.register(self.udp, selectors.EVENT_READ, "udp")
+        self.sel.register(self.tcp, selectors.EVENT_READ, "accept")
+
+    def poll(self, timeout=1.0):
+        for key, _mask in self.sel.select(timeout):
+            if key.data == "udp":
+                self._read_udp()
+            elif key.data == "accept":
+                self._accept()
+            else:
+                self._read_tcp(key.fileobj, key.data)
+
+    def _read_udp(self):
+        ingest = self.aggregator.ingest
+        for _ in range(1024):
+            try:
+                data = self.udp.recv(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            ingest(data)
+
+    def _accept(self):
+        try:
+            conn, _addr = self.tcp.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        conn.setblocking(False)
+        self.sel.register(conn, selectors.EVENT_READ, bytearray())
+
+    def _drop(self, conn):
+        self.sel.unregister(conn)
+        conn.close()
+
+    def _read_tcp(self, conn, buf):
+        try:
+            data = conn.recv(1 << 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(conn)
+            return
+        buf += data
+        while len(buf) >= 4:
+            (size,) = struct.unpack_from("!I", buf)
+            if size > MAX_FRAME:
+                self.aggregator.bad += 1
+                self._drop(conn)
+                return
+            if len(buf) < 4 + size:
+                break
+            self.aggregator.ingest(bytes(buf[4 : 4 + size]))
+            del buf[: 4 + size]
+
+    def close(self):
+        for key in list(self.sel.get_map().values()):
+            key.fileobj.close()
+        self.sel.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fleet agregatori: serverlardan kelgan hodisalarni birgalikda tahlil qiladi")
+    parser.add_argument("--listen", default=FLEET_LISTEN, help="HOST:PORT (UDP va TCP)")
+    args = parser.parse_args(argv)
+
+    aggregator = FleetAggregator()
+    server = FleetServer(aggregator, args.listen)
+    metrics.register_watcher("fleet", aggregator)
+    metrics.serve()
+    prefetch_emojis()
+    print(f"fleet: listening on {server.address[0]}:{server.address[1]} (udp+tcp)", file=sys.stderr)
+    try:
+        while True:
+            server.poll(1.0)
+    finally:
+        server.close()
+
+
+def _handle_term(_sig, _frame):
+    raise SystemExit(0)
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _handle_term)
+    try:
+        raise SystemExit(main())
+    except Exception as e:
+        print(f"fleet error: {e}")
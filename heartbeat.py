@@ -0,0 +1,65 @@
+import os
+import time
+
+
+# Set by main.py for each watcher: the write end of its heartbeat pipe
+HEARTBEAT_FD_ENV = "SECURITY_BOT_HEARTBEAT_FD"
+# Seconds between beats; the supervisor's timeout must be well above it
+HEARTBEAT_SEC = float(os.environ.get("SECURITY_BOT_HEARTBEAT_SEC", "5"))
+
+
+class Heartbeat:
+    # One line per beat: "<progress> <offset> <backlog>\n" (lines handled,
+    # tail offset, bytes not read yet). Beats are sent from the watcher's
+    # main loop, not a thread, so a loop stuck anywhere stops beating.
+    def __init__(self, fd, interval=HEARTBEAT_SEC):
+        self.fd = fd
+        self.interval = interval
+        self.sent = 0
+        self._next = 0.0
+        # A busy supervisor must never block the watcher
+        os.set_blocking(fd, False)
+
+    def due(self):
+        return self.fd is not None and time.monotonic() >= self._next
+
+    def beat(self, progress, offset=0, backlog=0):
+        if not self.due():
+            return False
+        self._next = time.monotonic() + self.interval
+        try:
+            os.write(self.fd, b"%d %d %d\n" % (progress, offset, backlog))
+        except BlockingIOError:
+            return False
+        except OSError:
+            # Supervisor gone; nothing to report to any more
+            self.fd = None
+            return False
+        self.sent += 1
+        return True
+
+
+def from_env():
+    # The variable is removed so processes started by the watcher do not
+    # write to the pipe too
+    raw = os.environ.pop(HEARTBEAT_FD_ENV, "")
+    if not raw:
+        return None
+    try:
+        return Heartbeat(int(raw))
+    except (ValueError, OSError):
+        return None
+
+
+def parse_beats(data):
+    # Complete lines of `data` as (progress, offset, backlog), and the
+    # unfinished rest
+    *lines, rest = data.split(b"\n")
+    beats = []
+    for line in lines:
+        try:
+            progress, offset, backlog = (int(v) for v in line.split())
+        except ValueError:
+            continue
+        beats.append((progress, offset, backlog))
+    return beats, rest
@@ -0,0 +1,197 @@
+import ipaddress
+import os
+import socket
+import sys
+import time
+from bisect import bisect_right
+
+
+def load_settings():
+    # ssh_watch/nginx_watch read these again after loading the env file
+    global IP_ALLOWLIST, IP_DENYLIST, IPLIST_RELOAD_SEC
+    # Comma separated files of CIDR ranges, one per line ("# comment" allowed)
+    # Allowlisted IPs (monitoring, load balancers, CDNs) never reach detection
+    IP_ALLOWLIST = os.environ.get("IP_ALLOWLIST", "")
+    # Denylisted IPs are still detected; their alerts name the list. A line may
+    # carry its own tag after the range, otherwise the file name is used
+    IP_DENYLIST = os.environ.get("IP_DENYLIST", "")
+    # How often the files are checked for changes
+    IPLIST_RELOAD_SEC = float(os.environ.get("IPLIST_RELOAD_SEC", "30"))
+
+
+load_settings()
+
+
+def ip_key(ip):
+    # (4 or 6, integer) for an address string, None if it is not one.
+    # IPv4-mapped IPv6 addresses are looked up as IPv4.
+    try:
+        if ":" not in ip:
+            return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+        n = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip.split("%", 1)[0]), "big")
+    except (OSError, ValueError):
+        return None
+    if n >> 32 == 0xFFFF:
+        return 4, n & 0xFFFFFFFF
+    return 6, n
+
+
+class PrefixIndex:
+    # CIDR ranges flattened into sorted, non-overlapping intervals, each
+    # carrying the value of the longest prefix covering it. A lookup is one
+    # bisect (log2 of the interval count, at most the prefix length steps).
+    def __init__(self, prefixes=()):
+        self.count = 0
+        self._tables = {}
+        by_version = {4: [], 6: []}
+        for net, value in prefixes:
+            start = int(net.network_address)
+            # Outer ranges sort before the ranges nested in them
+            by_version[net.version].append((start, start + net.num_addresses - 1, value))
+            self.count += 1
+        for version, items in by_version.items():
+            if items:
+                items.sort(key=lambda r: (r[0], -r[1]))
+                self._tables[version] = self._flatten(items)
+
+    @staticmethod
+    def _flatten(items):
+        starts, ends, values = [], [], []
+
+        def emit(lo, hi, value):
+            if lo > hi:
+                return
+            if ends and ends[-1] + 1 == lo and values[-1] == value:
+                ends[-1] = hi
+                return
+            starts.append(lo)
+            ends.append(hi)
+            values.append(value)
+
+        stack = []
+        cursor = 0
+        for lo, hi, value in items:
+            while stack and stack[-1][1] < lo:
+                _lo, top_hi, top_value = stack.pop()
+                emit(cursor, top_hi, top_value)
+                cursor = top_hi + 1
+            if stack:
+                emit(cursor, lo - 1, stack[-1][2])
+            stack.append((lo, hi, value))
+            cursor = lo
+        while stack:
+            _lo, top_hi, top_value = stack.pop()
+            emit(cursor, top_hi, top_value)
+            cursor = top_hi + 1
+        return starts, ends, values
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, ip):
+        key = ip_key(ip)
+        if key is None:
+            return None
+        table = self._tables.get(key[0])
+        if table is None:
+            return None
+        starts, ends, values = table
+        n = key[1]
+        i = bisect_right(starts, n) - 1
+        if i >= 0 and n <= ends[i]:
+            return values[i]
+        return None
+
+
+def _split(spec):
+    return [p.strip() for p in spec.split(",") if p.strip()]
+
+
+def read_prefixes(path, default_tag):
+    prefixes = []
+    bad = 0
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split(None, 1)
+            try:
+                net = ipaddress.ip_network(parts[0], strict=False)
+            except ValueError:
+                bad += 1
+                continue
+            prefixes.append((net, parts[1].strip() if len(parts) > 1 else default_tag))
+    if bad:
+        print(f"iplists: {path}: {bad} invalid lines skipped", file=sys.stderr)
+    return prefixes
+
+
+class IPLists:
+    # Allow and deny indexes built from files and rebuilt when one of the
+    # files changes; the swap is a single assignment, so lookups never see
+    # a half-built index
+    def __init__(self, allow=(), deny=(), reload_sec=None):
+        self.allow_paths = list(allow)
+        self.deny_paths = list(deny)
+        self.reload_sec = IPLIST_RELOAD_SEC if reload_sec is None else reload_sec
+        self.allow = PrefixIndex()
+        self.deny = PrefixIndex()
+        self.reloads = 0
+        self._stamps = None
+        self._checked = 0.0
+        self.refresh(force=True)
+
+    def _stat(self):
+        stamps = []
+        for path in self.allow_paths + self.deny_paths:
+            try:
+                st = os.stat(path)
+                stamps.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except OSError:
+                stamps.append(None)
+        return stamps
+
+    def _build(self, paths, tagged):
+        prefixes = []
+        for path in paths:
+            tag = os.path.splitext(os.path.basename(path))[0] if tagged else True
+            try:
+                prefixes.extend(read_prefixes(path, tag))
+            except OSError as e:
+                print(f"iplists: cannot read {path}: {e}", file=sys.stderr)
+        return PrefixIndex(prefixes)
+
+    def refresh(self, now=None, force=False):
+        now = time.monotonic() if now is None else now
+        if not force and now - self._checked < self.reload_sec:
+            return False
+        self._checked = now
+        stamps = self._stat()
+        if stamps == self._stamps:
+            return False
+        self.allow = self._build(self.allow_paths, tagged=False)
+        self.deny = self._build(self.deny_paths, tagged=True)
+        if self._stamps is not None:
+            self.reloads += 1
+            print(f"iplists: reloaded, {len(self.allow)} allowed and {len(self.deny)} denied ranges", file=sys.stderr)
+        self._stamps = stamps
+        return True
+
+    def allowed(self, ip):
+        return self.allow.lookup(ip) is not None
+
+    def tag(self, ip):
+        return self.deny.lookup(ip)
+
+    def label(self, ip):
+        # Alert field text
+        return self.deny.lookup(ip) or "-"
+
+
+def load_iplists():
+    allow = _split(IP_ALLOWLIST)
+    deny = _split(IP_DENYLIST)
+    if not allow and not deny:
+        return None
+    return IPLists(allow, deny)
@@ -1,8 +1,46 @@
 import os
+import selectors
 import signal
 import subprocess
 import sys
 import time
+from collections import deque
+
+import metrics
+from heartbeat import HEARTBEAT_FD_ENV, parse_beats
+from telegram_alert import AlertTemplate, flush_alerts, hostname, send_alert
+
+
+# Restart delay after a failure doubles from SECURITY_BOT_RESTART_SEC up to this
+RESTART_MAX_SEC = float(os.environ.get("SECURITY_BOT_RESTART_MAX_SEC", "300"))
+# A watcher that stays up this long starts again from the shortest delay
+STABLE_SEC = float(os.environ.get("SECURITY_BOT_STABLE_SEC", "60"))
+# This many failures within the window is a crash loop: one alert, then
+# restarts only every RESTART_MAX_SEC
+CRASH_LOOP_COUNT = int(os.environ.get("SECURITY_BOT_CRASH_LOOP_COUNT", "5"))
+CRASH_LOOP_WINDOW_SEC = float(os.environ.get("SECURITY_BOT_CRASH_LOOP_WINDOW_SEC", "600"))
+# No heartbeat for this long: the watcher is stuck and gets restarted (0: off).
+# Idle watchers beat every SECURITY_BOT_HEARTBEAT_SEC or TAIL_IDLE_TIMEOUT_SEC,
+# whichever is longer, so keep it well above both.
+HEARTBEAT_TIMEOUT_SEC = float(os.environ.get("SECURITY_BOT_HEARTBEAT_TIMEOUT_SEC", "60"))
+# Heartbeats keep coming but report unread log bytes and no progress (0: off)
+STALL_SEC = float(os.environ.get("SECURITY_BOT_STALL_SEC", "120"))
+# SIGTERM first, so the watcher can save its snapshot; SIGKILL after this
+KILL_GRACE_SEC = float(os.environ.get("SECURITY_BOT_KILL_GRACE_SEC", "10"))
+
+
+WATCHER_ALERT = AlertTemplate(
+    ("WATCHER_TITLE", "🛠️"),
+    "Kuzatuvchi ishlamayapti",
+    [
+        ("watcher", "WATCHER", "🧩", "Kuzatuvchi"),
+        ("reason", "REASON", "❗", "Sabab"),
+        ("next", "DURATION", "⏳", "Qayta ishga tushirish"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="watcher_down",
+    digest_keys=("watcher",),
+)
 
 
 def _env_int(name, default):
@@ -19,17 +57,301 @@ def _env_bool(name, default=False):
     return val.strip().lower() in {"1", "true", "yes", "on"}
 
 
+def _child_env(script, index, beat_fd):
+    env = dict(os.environ)
+    env[HEARTBEAT_FD_ENV] = str(beat_fd)
+    # Each watcher process serves its own metrics next to the supervisor's
+    listen = os.environ.get(metrics.LISTEN_ENV, "").strip()
+    if listen:
+        env[metrics.LISTEN_ENV] = metrics.child_listen(listen, index, script[:-3])
+    return env
+
+
 def _build_cmd(script_name):
     return [sys.executable, os.path.join(os.path.dirname(__file__), script_name)]
 
 
-def main():
+def _pidfd(pid):
+    # Readable once the process exits (Linux 5.3+); None falls back to SIGCHLD
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+def _exit_reason(code):
+    if code < 0:
+        try:
+            return f"signal {signal.Signals(-code).name}"
+        except ValueError:
+            return f"signal {-code}"
+    return f"exit code {code}"
+
+
+class _Child:
+    def __init__(self, script, index):
+        self.script = script
+        self.name = script[:-3]
+        self.index = index
+        self.proc = None
+        self.pidfd = None
+        self.beat_fd = None
+        self.buf = b""
+        self.started = 0.0
+        self.last_beat = 0.0
+        # (lines, offset) of the last heartbeat and when it last changed
+        self.progress = None
+        self.progress_at = 0.0
+        self.backlog = 0
+        # Why it is being killed, and when SIGKILL follows the SIGTERM
+        self.stalled = None
+        self.kill_at = None
+        self.failures = 0
+        self.crashes = deque()
+        self.crash_loop = False
+        self.restart_at = None
+
+
+class Supervisor:
+    # Waits on child pidfds (or SIGCHLD), heartbeat pipes and signals with
+    # one selector; nothing is polled on a timer. Timeouts only wake it
+    # for the next restart, heartbeat or kill deadline.
+    def __init__(self, scripts, restart_sec, emit=send_alert):
+        self.children = [_Child(script, i) for i, script in enumerate(scripts)]
+        self.restart_sec = max(0.1, float(restart_sec))
+        self.emit = emit
+        self.stopping = False
+        self.selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+        for child in self.children:
+            metrics.WATCHER_UP.labels(child.name).set_function(lambda c=child: 1 if c.proc is not None else 0)
+            metrics.CRASH_LOOP.labels(child.name).set_function(lambda c=child: 1 if c.crash_loop else 0)
+            metrics.HEARTBEAT_AGE.labels(child.name).set_function(
+                lambda c=child: time.monotonic() - c.last_beat if c.proc is not None else 0
+            )
+
+    def _on_stop(self, _sig, _frame):
+        self.stopping = True
+
+    def _on_hup(self, _sig, _frame):
+        # Each watcher re-reads its own settings. One waiting out a backoff
+        # is started now: the new settings may be the fix.
+        for child in self.children:
+            if child.proc is not None and child.proc.poll() is None:
+                child.proc.send_signal(signal.SIGHUP)
+            elif child.restart_at is not None:
+                child.restart_at = 0.0
+
+    def install(self):
+        # Signals write to the wake pipe, so select() returns on each one
+        signal.set_wakeup_fd(self._wake_w)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_hup)
+        signal.signal(signal.SIGCHLD, lambda _sig, _frame: None)
+        return self
+
+    def _spawn(self, child, now):
+        child.restart_at = None
+        r, w = os.pipe()
+        try:
+            child.proc = subprocess.Popen(
+                _build_cmd(child.script),
+                env=_child_env(child.script, child.index, w),
+                pass_fds=(w,),
+            )
+        except OSError as e:
+            os.close(r)
+            print(f"main: cannot start {child.name}: {e}", file=sys.stderr)
+            self._schedule(child, now, str(e))
+            return
+        finally:
+            os.close(w)
+        os.set_blocking(r, False)
+        child.beat_fd = r
+        child.buf = b""
+        child.started = child.last_beat = child.progress_at = now
+        child.progress = None
+        child.backlog = 0
+        child.stalled = child.kill_at = None
+        self.selector.register(r, selectors.EVENT_READ, child)
+        child.pidfd = _pidfd(child.proc.pid)
+        if child.pidfd is not None:
+            self.selector.register(child.pidfd, selectors.EVENT_READ, child)
+
+    def _close_fds(self, child):
+        for fd in (child.beat_fd, child.pidfd):
+            if fd is not None:
+                self.selector.unregister(fd)
+                os.close(fd)
+        child.beat_fd = child.pidfd = None
+
+    def _read_beats(self, child, now):
+        try:
+            data = os.read(child.beat_fd, 65536)
+        except BlockingIOError:
+            return
+        if not data:
+            # Write end closed; the exit itself comes through pidfd/SIGCHLD
+            self.selector.unregister(child.beat_fd)
+            os.close(child.beat_fd)
+            child.beat_fd = None
+            return
+        beats, child.buf = parse_beats(child.buf + data)
+        if not beats:
+            return
+        progress, offset, backlog = beats[-1]
+        child.last_beat = now
+        # Idle with nothing to read is not a stall
+        if (progress, offset) != child.progress or backlog == 0:
+            child.progress_at = now
+        child.progress = (progress, offset)
+        child.backlog = backlog
+
+    def _reap(self, child, now):
+        code = child.proc.poll()
+        if code is None:
+            return
+        self._close_fds(child)
+        child.proc = None
+        if self.stopping:
+            return
+        self._schedule(child, now, child.stalled or _exit_reason(code), stalled=child.stalled is not None)
+
+    def _schedule(self, child, now, reason, stalled=False):
+        if now - child.started >= STABLE_SEC:
+            child.failures = 0
+        child.failures += 1
+        crashes = child.crashes
+        crashes.append(now)
+        while crashes and now - crashes[0] > CRASH_LOOP_WINDOW_SEC:
+            crashes.popleft()
+        delay = min(RESTART_MAX_SEC, self.restart_sec * 2 ** (child.failures - 1))
+        if len(crashes) >= CRASH_LOOP_COUNT:
+            delay = RESTART_MAX_SEC
+            if not child.crash_loop:
+                child.crash_loop = True
+                print(f"main: {child.name} is crash looping ({len(crashes)} failures)", file=sys.stderr)
+                self._alert(
+                    child,
+                    f"{int(CRASH_LOOP_WINDOW_SEC)}s ichida {len(crashes)} marta to'xtadi ({reason})",
+                    delay,
+                )
+        elif stalled:
+            # A crash only shows in the logs; a hang is worth an alert
+            self._alert(child, reason, delay)
+        child.restart_at = now + delay
+        print(f"main: {child.name} stopped ({reason}), restart in {delay:.1f}s", file=sys.stderr)
+
+    def _alert(self, child, reason, delay):
+        self.emit(WATCHER_ALERT.message(watcher=child.name, reason=reason, next=f"{delay:g}s", server=hostname()))
+
+    def _stall(self, child, now, reason):
+        child.stalled = reason
+        child.kill_at = now + KILL_GRACE_SEC
+        metrics.STALLS.labels(child.name).inc()
+        print(f"main: {child.name} stalled ({reason}), terminating", file=sys.stderr)
+        child.proc.terminate()
+
+    def _check(self, child, now):
+        # The next deadline of this child, acting on any that passed
+        if child.proc is None:
+            if child.restart_at is None:
+                return None
+            if now < child.restart_at:
+                return child.restart_at
+            metrics.RESTARTS.labels(child.name).inc()
+            self._spawn(child, now)
+            return self._check(child, now) if child.proc is not None else child.restart_at
+        if child.stalled is not None:
+            # Being stopped; after SIGKILL only the exit is left to wait for
+            # (a read stuck on NFS delays even that)
+            if child.kill_at is not None and now >= child.kill_at:
+                print(f"main: {child.name} ignored SIGTERM, killing", file=sys.stderr)
+                child.proc.kill()
+                child.kill_at = None
+            return child.kill_at
+        if child.crash_loop and now - child.started >= STABLE_SEC:
+            child.crash_loop = False
+            child.crashes.clear()
+            print(f"main: {child.name} recovered", file=sys.stderr)
+        deadlines = []
+        if HEARTBEAT_TIMEOUT_SEC > 0:
+            if now - child.last_beat >= HEARTBEAT_TIMEOUT_SEC:
+                self._stall(child, now, f"{int(now - child.last_beat)}s davomida heartbeat yo'q")
+                return child.kill_at
+            deadlines.append(child.last_beat + HEARTBEAT_TIMEOUT_SEC)
+        if STALL_SEC > 0 and child.backlog > 0:
+            if now - child.progress_at >= STALL_SEC:
+                self._stall(
+                    child, now, f"{int(now - child.progress_at)}s davomida o'qish to'xtagan, {child.backlog} bayt kutmoqda"
+                )
+                return child.kill_at
+            deadlines.append(child.progress_at + STALL_SEC)
+        return min(deadlines) if deadlines else None
+
+    def run(self):
+        now = time.monotonic()
+        for child in self.children:
+            self._spawn(child, now)
+        try:
+            while not self.stopping:
+                now = time.monotonic()
+                deadlines = [d for d in (self._check(child, now) for child in self.children) if d is not None]
+                timeout = max(0.0, min(deadlines) - now) if deadlines else None
+                ready = self.selector.select(timeout)
+                now = time.monotonic()
+                for key, _events in ready:
+                    child = key.data
+                    if child is None:
+                        try:
+                            os.read(self._wake_r, 4096)
+                        except BlockingIOError:
+                            pass
+                    elif key.fd == child.beat_fd:
+                        self._read_beats(child, now)
+                # pidfd or SIGCHLD: a waitpid per child tells which one exited
+                for child in self.children:
+                    if child.proc is not None:
+                        self._reap(child, now)
+        finally:
+            self.stopping = True
+            self.stop_all()
+        return 0
+
+    def stop_all(self):
+        procs = [child.proc for child in self.children if child.proc is not None]
+        for p in procs:
+            try:
+                p.terminate()
+            except OSError:
+                pass
+        deadline = time.time() + 10
+        for p in procs:
+            try:
+                p.wait(timeout=max(0.0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+        for child in self.children:
+            if child.proc is not None:
+                self._close_fds(child)
+                child.proc = None
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
     restart_sec = _env_int("SECURITY_BOT_RESTART_SEC", "2")
+    # Opt-in: run every watcher as an asyncio task in this one process
+    single = "--single-process" in argv or _env_bool("SECURITY_BOT_SINGLE_PROCESS", False)
     disable_ssh = _env_bool("DISABLE_SSH_WATCH", False)
     disable_nginx = _env_bool("DISABLE_NGINX_WATCH", False)
     disable_resource = _env_bool("DISABLE_RESOURCE_WATCH", False)
+    disable_fail2ban = _env_bool("DISABLE_FAIL2BAN_WATCH", False)
 
-    procs = {}
     scripts = []
     if not disable_ssh:
         scripts.append("ssh_watch.py")
@@ -37,56 +359,23 @@ def main():
         scripts.append("nginx_watch.py")
     if not disable_resource:
         scripts.append("resource_watch.py")
+    if not disable_fail2ban:
+        scripts.append("fail2ban_watch.py")
 
     if not scripts:
         print("main: no watchers enabled", file=sys.stderr)
         return 1
 
-    def start(script):
-        cmd = _build_cmd(script)
-        return subprocess.Popen(cmd)
+    if single:
+        from runtime import run
 
-    def start_all():
-        for s in scripts:
-            procs[s] = start(s)
+        return run(scripts, restart_sec=restart_sec)
 
-    def stop_all():
-        for p in procs.values():
-            try:
-                p.terminate()
-            except Exception:
-                pass
-        deadline = time.time() + 10
-        for p in procs.values():
-            try:
-                remaining = max(0.0, deadline - time.time())
-                p.wait(timeout=remaining)
-            except Exception:
-                try:
-                    p.kill()
-                except Exception:
-                    pass
-
-    stop = {"flag": False}
-
-    def handle(_sig, _frame):
-        stop["flag"] = True
-
-    signal.signal(signal.SIGINT, handle)
-    signal.signal(signal.SIGTERM, handle)
-
-    start_all()
-
-    while not stop["flag"]:
-        for s, p in list(procs.items()):
-            code = p.poll()
-            if code is not None:
-                # restart crashed process
-                procs[s] = start(s)
-        time.sleep(restart_sec)
-
-    stop_all()
-    return 0
+    metrics.serve()
+    try:
+        return Supervisor(scripts, restart_sec).install().run()
+    finally:
+        flush_alerts()
 
 
 if __name__ == "__main__":
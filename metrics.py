@@ -0,0 +1,323 @@
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# "127.0.0.1:9464" or "unix:/run/security-bot/metrics.sock"; unset = off
+LISTEN_ENV = "METRICS_LISTEN"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt(value):
+    if isinstance(value, float):
+        if value != value:
+            return "NaN"
+        if value in (float("inf"), float("-inf")):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(int(value))
+
+
+class _Value:
+    # Plain attribute, no lock: each child is written from one thread and
+    # a scrape reading a value mid-update is harmless. `fn` is read at
+    # scrape time instead, for numbers the watchers keep anyway.
+    __slots__ = ("value", "fn")
+
+    def __init__(self):
+        self.value = 0
+        self.fn = None
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, fn):
+        self.fn = fn
+
+    def get(self):
+        if self.fn is None:
+            return self.value
+        try:
+            return self.fn()
+        except Exception:
+            return float("nan")
+
+
+class _LockedValue(_Value):
+    # For counters bumped from several threads (the Telegram fan-out pool)
+    __slots__ = ("_lock",)
+
+    def __init__(self):
+        _Value.__init__(self)
+        self._lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self._lock:
+            self.value += n
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count", "_lock")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metric:
+    def __init__(self, kind, name, doc, labels=(), buckets=None, locked=False):
+        self.kind = kind
+        self.locked = locked
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets or LATENCY_BUCKETS)
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def _new(self):
+        if self.kind == "histogram":
+            return _HistogramValue(self.buckets)
+        return _LockedValue() if self.locked else _Value()
+
+    def labels(self, *values):
+        # Bind once outside the hot loop; the child is then used directly
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._children[key] = self._new()
+        return child
+
+    def _default(self):
+        return self.labels()
+
+    def inc(self, n=1):
+        self._default().inc(n)
+
+    def set(self, value):
+        self._default().set(value)
+
+    def set_function(self, fn):
+        self._default().set_function(fn)
+
+    def observe(self, value):
+        self._default().observe(value)
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(v) for v in values), None)
+
+    def _labelstr(self, key, extra=None):
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self, out):
+        out.append(f"# HELP {self.name} {self.doc}")
+        out.append(f"# TYPE {self.name} {self.kind}")
+        for key, child in sorted(self._children.items()):
+            if self.kind != "histogram":
+                out.append(f"{self.name}{self._labelstr(key)} {_fmt(child.get())}")
+                continue
+            with child._lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            acc = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                le = 'le="' + le + '"'
+                out.append(f"{self.name}_bucket{self._labelstr(key, le)} {acc}")
+            out.append(f"{self.name}_sum{self._labelstr(key)} {_fmt(float(total))}")
+            out.append(f"{self.name}_count{self._labelstr(key)} {count}")
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, kind, name, doc, labels=(), buckets=None, locked=False):
+        # Registering twice returns the same metric, so a restarted watcher
+        # keeps counting where it left off
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Metric(kind, name, doc, labels, buckets, locked)
+            return metric
+
+    def counter(self, name, doc, labels=(), locked=False):
+        return self._get("counter", name, doc, labels, locked=locked)
+
+    def gauge(self, name, doc, labels=()):
+        return self._get("gauge", name, doc, labels)
+
+    def histogram(self, name, doc, labels=(), buckets=None):
+        return self._get("histogram", name, doc, labels, buckets)
+
+    def render(self):
+        out = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.render(out)
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+LINES_READ = counter("security_bot_lines_read_total", "Log lines read", ("watcher",))
+EVENTS = counter("security_bot_events_total", "Lines that parsed into an event", ("watcher",))
+PARSE_MISSES = counter("security_bot_parse_misses_total", "Lines the parser could not match", ("watcher",))
+LATE_EVENTS = counter("security_bot_late_events_total", "Events dropped as too far out of order", ("watcher",))
+ALERTS = counter("security_bot_alerts_emitted_total", "Alerts raised by a watcher", ("watcher",))
+EXCLUDED = counter("security_bot_excluded_events_total", "Events from allowlisted ranges, dropped before detection", ("watcher",))
+TRACKED_KEYS = gauge("security_bot_tracked_keys", "Keys held in detection windows", ("watcher",))
+TRACKED_BYTES = gauge("security_bot_tracked_memory_bytes", "Estimated memory of detection state", ("watcher",))
+TAILER_LAG = gauge("security_bot_tailer_lag_bytes", "Bytes between the read offset and EOF", ("watcher",))
+TAILER_OFFSET = gauge("security_bot_tailer_offset_bytes", "Read offset in the followed file", ("watcher",))
+RESTARTS = counter("security_bot_watcher_restarts_total", "Watcher restarts after a crash or exit", ("watcher",))
+WATCHER_UP = gauge("security_bot_watcher_up", "1 while the watcher is running", ("watcher",))
+STALLS = counter("security_bot_watcher_stalls_total", "Watchers killed for missing heartbeats or no progress", ("watcher",))
+CRASH_LOOP = gauge("security_bot_watcher_crash_loop", "1 while the watcher is in a crash loop", ("watcher",))
+HEARTBEAT_AGE = gauge("security_bot_watcher_heartbeat_age_seconds", "Seconds since the watcher's last heartbeat", ("watcher",))
+PROCESS_CPU = counter("security_bot_process_cpu_seconds_total", "User + system CPU time of this process")
+PROCESS_RSS = gauge("security_bot_process_resident_memory_bytes", "Resident memory of this process")
+START_TIME = gauge("security_bot_process_start_time_seconds", "Unix time the process started")
+
+
+def _rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _cpu():
+    t = os.times()
+    return t.user + t.system
+
+
+PROCESS_CPU.set_function(_cpu)
+PROCESS_RSS.set_function(_rss)
+START_TIME.set(time.time())
+
+
+def register_watcher(name, watcher, tailer=None):
+    # Everything is read from the watcher at scrape time: the per-line loop
+    # only bumps plain int attributes it already keeps
+    for metric, attr in ((LINES_READ, "lines_read"), (EVENTS, "events"), (ALERTS, "alerts"), (EXCLUDED, "excluded")):
+        if hasattr(watcher, attr):
+            metric.labels(name).set_function(lambda attr=attr: getattr(watcher, attr))
+    # parser and clock are looked up on each scrape: a reload may replace them
+    if getattr(watcher, "parser", None) is not None:
+        PARSE_MISSES.labels(name).set_function(lambda: watcher.parser.misses)
+    if getattr(watcher, "clock", None) is not None:
+        LATE_EVENTS.labels(name).set_function(lambda: watcher.clock.late)
+    if hasattr(watcher, "tracked_keys"):
+        TRACKED_KEYS.labels(name).set_function(watcher.tracked_keys)
+        TRACKED_BYTES.labels(name).set_function(watcher.memory_bytes)
+    if tailer is not None:
+        TAILER_LAG.labels(name).set_function(tailer.lag)
+        TAILER_OFFSET.labels(name).set_function(lambda: tailer.pos)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        data = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *_args):
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+_SERVER = None
+
+
+def _parse_listen(listen):
+    if listen.startswith("unix:"):
+        return socket.AF_UNIX, listen[5:]
+    host, _, port = listen.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def child_listen(listen, index, name):
+    # Per-process address for a watcher started by the supervisor
+    if not listen:
+        return ""
+    family, addr = _parse_listen(listen)
+    if family == socket.AF_UNIX:
+        base, ext = os.path.splitext(addr)
+        return f"unix:{base}-{name}{ext or '.sock'}"
+    return f"{addr[0]}:{addr[1] + index + 1}"
+
+
+def serve(listen=None):
+    global _SERVER
+    if _SERVER is not None:
+        return _SERVER
+    listen = (os.environ.get(LISTEN_ENV, "") if listen is None else listen).strip()
+    if not listen:
+        return None
+    try:
+        family, addr = _parse_listen(listen)
+        if family == socket.AF_UNIX:
+            os.makedirs(os.path.dirname(addr) or ".", exist_ok=True)
+            try:
+                os.unlink(addr)
+            except FileNotFoundError:
+                pass
+            server = _UnixHTTPServer(addr, _Handler)
+        else:
+            server = ThreadingHTTPServer(addr, _Handler)
+            server.daemon_threads = True
+    except (OSError, ValueError) as e:
+        print(f"metrics: cannot listen on {listen}: {e}", file=sys.stderr)
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    _SERVER = server
+    return server
+
@@ -0,0 +1,324 @@
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import sys
+import zlib
+
+from nginx_watch import (
+    DIST_FLOOD_ALERT,
+    FLOOD_ALERT,
+    MAX_TRACKED_IPS,
+    PARSE_IN_FLIGHT,
+    NginxWatcher,
+    load_settings,
+    vhost_name,
+)
+from fleet import local_emit
+from telegram_alert import send_alert
+from windows import EventClock
+
+
+# Parsing and the per-IP windows run in `workers` processes; each one parses
+# the chunks handed to it round-robin and also owns one shard of the flood
+# windows (hash of the IP), so window state is never shared or locked. The
+# distributed-flood detector needs every event in order and gets its own
+# process. Every stage applies chunks strictly in chunk order, so alerts are
+# the same as with the single-process watcher.
+
+_TEMPLATES = {FLOOD_ALERT.kind: FLOOD_ALERT, DIST_FLOOD_ALERT.kind: DIST_FLOOD_ALERT}
+
+
+class _Stage:
+    # Chunks reach a stage from several parser processes in any order; they
+    # are buffered and applied by sequence number. The chunk's events carry
+    # `seen` (newest stamp so far in that chunk), which together with the
+    # watermark at the chunk start gives the same clock as one stream.
+    def __init__(self, watcher, detect):
+        self.watcher = watcher
+        self.detect = detect
+        self.pending = {}
+        self.next_seq = 0
+        self.alerts = []
+        watcher.emit = self._emit
+
+    def _emit(self, message):
+        self.alerts.append((message.template.kind, message.values))
+
+    def take(self, seq, newest, vhost, events):
+        self.pending[seq] = (newest, vhost, events)
+        clock = self.watcher.clock
+        settle = clock.settle
+        while self.next_seq in self.pending:
+            newest, vhost, events = self.pending.pop(self.next_seq)
+            kept = []
+            append = kept.append
+            for ip, path, ts, seen in events:
+                ts = settle(ts, seen)
+                if ts is not None:
+                    append((ip, path, ts))
+            self.detect(kept, vhost)
+            if newest is not None and (clock.watermark is None or newest > clock.watermark):
+                clock.watermark = newest
+            self.next_seq += 1
+        alerts, self.alerts = self.alerts, []
+        return self.next_seq - 1, alerts
+
+
+def _get(box, parent):
+    # Exit with the parent instead of blocking forever on an orphaned queue
+    while True:
+        try:
+            return box.get(timeout=1.0)
+        except queue.Empty:
+            if os.getppid() != parent:
+                return None
+
+
+def _parse_chunk(watcher, data, shards):
+    parse = watcher.parser.parse
+    clamp = watcher.clock.clamp
+    allowed = watcher.allowed_check()
+    excluded = 0
+    crc32 = zlib.crc32
+    parts = [[] for _ in range(shards)]
+    everything = []
+    append = everything.append
+    seen = None
+    for raw in data.split(b"\n"):
+        event = parse(raw)
+        if event is None:
+            continue
+        ip, path, ts = event
+        if allowed is not None and allowed(ip):
+            excluded += 1
+            continue
+        ts = clamp(ts)
+        if ts is not None and (seen is None or ts > seen):
+            seen = ts
+        event = (ip, path, ts, seen)
+        append(event)
+        # crc32, not hash(): str hashes differ between processes
+        parts[crc32(ip.encode()) % shards].append(event)
+    return seen, parts, everything, excluded
+
+
+def _control(index, watcher, msg, outbox, shards=1):
+    # Reload, snapshot and restore requests; they arrive between chunks
+    kind = msg[0]
+    if kind == "reload":
+        # The parent has re-read the env file; its environment comes along
+        os.environ.update(msg[1])
+        watcher.reload_settings(shards)
+    elif kind == "snapshot":
+        outbox.put(("snapshot", index, watcher.snapshot()))
+    elif kind == "restore":
+        try:
+            watcher.restore(msg[1])
+        except (KeyError, ValueError) as e:
+            print(f"nginx stage {index}: ignoring snapshot: {e}", file=sys.stderr)
+    else:
+        return False
+    return True
+
+
+def _run_worker(index, shards, live, boxes, outbox, parent):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    watcher = NginxWatcher(live=live, max_keys=max(1, MAX_TRACKED_IPS // shards))
+    stage = _Stage(watcher, watcher.flood)
+    inbox = boxes[index]
+    dist_box = boxes[shards]
+    while True:
+        msg = _get(inbox, parent)
+        if msg is None:
+            break
+        if msg[0] == "parse":
+            _kind, seq, vhost, data = msg
+            misses = watcher.parser.misses
+            seen, parts, everything, excluded = _parse_chunk(watcher, data, shards)
+            for box, part in zip(boxes, parts):
+                box.put(("events", seq, seen, vhost, part))
+            dist_box.put(("events", seq, seen, vhost, everything))
+            outbox.put(("parsed", seq, len(everything) + excluded, watcher.parser.misses - misses, excluded))
+        elif _control(index, watcher, msg, outbox, shards):
+            continue
+        else:
+            done, alerts = stage.take(*msg[1:])
+            clock = watcher.clock
+            outbox.put(("done", index, done, alerts, len(watcher.hits), watcher.hits.memory_bytes(), clock.late, clock.missing))
+
+
+def _run_dist(index, live, inbox, outbox, parent):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    watcher = NginxWatcher(live=live, max_keys=1)
+    stage = _Stage(watcher, watcher.dist_flood)
+    while True:
+        msg = _get(inbox, parent)
+        if msg is None:
+            break
+        if _control(index, watcher, msg, outbox):
+            continue
+        done, alerts = stage.take(*msg[1:])
+        clock = watcher.clock
+        outbox.put(("done", index, done, alerts, 0, watcher.dist.memory_bytes(), clock.late, clock.missing))
+
+
+class _ParseStats:
+    def __init__(self):
+        self.misses = 0
+
+
+class ParallelNginxWatcher:
+    # Same feed()/flush() surface as NginxWatcher; alerts come back to this
+    # process and go through `emit` here
+    def __init__(self, workers, emit=send_alert, live=True, in_flight=PARSE_IN_FLIGHT):
+        self.workers = max(1, int(workers))
+        self.emit = local_emit(emit, live)
+        self.max_in_flight = max(1, int(in_flight)) * self.workers
+        # late/missing mirror the distributed stage, which sees every event
+        self.clock = EventClock(live=live)
+        self.parser = _ParseStats()
+        self.lines_read = 0
+        self.events = 0
+        self.excluded = 0
+        self.alerts = 0
+        self._vhosts = {}
+        self._seq = 0
+        self._snapshots = None
+        stages = self.workers + 1
+        self._done = [-1] * stages
+        self._keys = [0] * stages
+        self._memory = [0] * stages
+        ctx = multiprocessing.get_context()
+        self._outbox = ctx.Queue()
+        self._boxes = [ctx.Queue() for _ in range(stages)]
+        parent = os.getpid()
+        self._procs = [
+            ctx.Process(
+                target=_run_worker,
+                args=(i, self.workers, live, self._boxes, self._outbox, parent),
+                name=f"nginx-parse-{i}",
+                daemon=True,
+            )
+            for i in range(self.workers)
+        ]
+        self._procs.append(
+            ctx.Process(
+                target=_run_dist,
+                args=(self.workers, live, self._boxes[self.workers], self._outbox, parent),
+                name="nginx-dist",
+                daemon=True,
+            )
+        )
+        for proc in self._procs:
+            proc.start()
+
+    def tracked_keys(self):
+        return sum(self._keys)
+
+    def memory_bytes(self):
+        return sum(self._memory)
+
+    def vhost(self, source):
+        vhost = self._vhosts.get(source)
+        if vhost is None:
+            vhost = self._vhosts[source] = vhost_name(source)
+        return vhost
+
+    def feed(self, lines, source=None):
+        if not lines:
+            return
+        seq = self._seq
+        self._seq += 1
+        self.lines_read += len(lines)
+        self._boxes[seq % self.workers].put(("parse", seq, self.vhost(source), b"\n".join(lines)))
+        self._collect(block=False)
+        while self._seq - 1 - min(self._done) > self.max_in_flight:
+            self._collect(block=True)
+
+    def _collect(self, block):
+        while True:
+            try:
+                msg = self._outbox.get(timeout=1.0) if block else self._outbox.get_nowait()
+            except queue.Empty:
+                if block:
+                    self._check()
+                return
+            if msg[0] == "parsed":
+                self.events += msg[2]
+                self.parser.misses += msg[3]
+                self.excluded += msg[4]
+            elif msg[0] == "snapshot":
+                self._snapshots[msg[1]] = msg[2]
+            else:
+                _kind, index, done, alerts, keys, memory, late, missing = msg
+                self._done[index] = done
+                self._keys[index] = keys
+                self._memory[index] = memory
+                if index == self.workers:
+                    self.clock.late = late
+                    self.clock.missing = missing
+                for kind, values in alerts:
+                    self.alerts += 1
+                    self.emit(_TEMPLATES[kind].message(**values))
+            # One message is enough progress for a blocking caller
+            block = False
+
+    def _check(self):
+        for proc in self._procs:
+            if not proc.is_alive():
+                raise RuntimeError(f"{proc.name} exited with code {proc.exitcode}")
+
+    def flush(self):
+        # Waits until every chunk fed so far went through all stages
+        while min(self._done) < self._seq - 1:
+            self._collect(block=True)
+        return True
+
+    def reload_settings(self):
+        load_settings()
+        for box in self._boxes:
+            box.put(("reload", dict(os.environ)))
+
+    def snapshot(self):
+        # Every stage dumps its own windows once the chunks fed so far are
+        # through; sections are prefixed with the stage number
+        self.flush()
+        self._snapshots = {}
+        for box in self._boxes:
+            box.put(("snapshot",))
+        while len(self._snapshots) < len(self._boxes):
+            self._collect(block=True)
+        sections = {"parallel": json.dumps({"workers": self.workers}).encode()}
+        for index, part in sorted(self._snapshots.items()):
+            for name, data in part.items():
+                sections[f"{index}/{name}"] = data
+        self._snapshots = None
+        return sections
+
+    def restore(self, sections):
+        # Shards are crc32(ip) % workers, so only the same worker count fits
+        workers = json.loads(sections["parallel"])["workers"]
+        if workers != self.workers:
+            raise ValueError(f"taken with {workers} workers, running {self.workers}")
+        parts = [{} for _ in self._boxes]
+        for name, data in sections.items():
+            index, sep, rest = name.partition("/")
+            if sep and index.isdigit() and int(index) < len(parts):
+                parts[int(index)][rest] = data
+        for box, part in zip(self._boxes, parts):
+            box.put(("restore", part))
+
+    def close(self):
+        try:
+            if all(proc.is_alive() for proc in self._procs):
+                self.flush()
+        finally:
+            for box in self._boxes:
+                box.put(None)
+            for proc in self._procs:
+                proc.join(5.0)
+                if proc.is_alive():
+                    proc.terminate()
+                    proc.join(1.0)
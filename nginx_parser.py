@@ -0,0 +1,155 @@
+import calendar
+import json
+import re
+from datetime import datetime
+
+
+FORMAT_AUTO = "auto"
+FORMAT_COMBINED = "combined"
+FORMAT_JSON = "json"
+
+MONTHS = {
+    b"Jan": 1, b"Feb": 2, b"Mar": 3, b"Apr": 4, b"May": 5, b"Jun": 6,
+    b"Jul": 7, b"Aug": 8, b"Sep": 9, b"Oct": 10, b"Nov": 11, b"Dec": 12,
+}
+
+# ip - user [time] "METHOD /path?query HTTP/x" ...; the query is left out
+COMBINED_RE = re.compile(rb'(\S+) \S+ \S+ \[([^\]]+)\] "\S+ ([^\s?"]+)')
+
+# Keys tried, in order, for nginx JSON log_format lines
+JSON_IP_KEYS = ("remote_addr", "client_ip", "ip")
+JSON_PATH_KEYS = ("request_uri", "uri", "path")
+JSON_TIME_KEYS = ("msec", "time_iso8601", "time_local", "time")
+
+
+def clean_prefixes(prefixes):
+    return tuple(p.strip() for p in prefixes if p and p.strip())
+
+
+def build_prefilter(prefixes):
+    # JSON lines: one alternation over every prefix, anchored on the quote
+    # before the value ("uri":"/api/..) or the space after the method
+    alts = b"|".join(re.escape(p.encode("utf-8")) for p in sorted(prefixes, key=len, reverse=True))
+    return re.compile(rb'[ "](?:' + alts + rb")")
+
+
+class TimeParser:
+    # nginx writes the same [time_local] on every line of a busy second, so
+    # the last conversion is reused and the rest go through a small cache
+    def __init__(self, max_cache=4096):
+        self.max_cache = max_cache
+        self._cache = {}
+        self._last_key = None
+        self._last_val = None
+
+    def local(self, raw):
+        if raw == self._last_key:
+            return self._last_val
+        val = self._cache.get(raw)
+        if val is None:
+            val = self._parse_local(raw)
+            if val is None:
+                return None
+            if len(self._cache) >= self.max_cache:
+                self._cache.clear()
+            self._cache[raw] = val
+        self._last_key = raw
+        self._last_val = val
+        return val
+
+    @staticmethod
+    def _parse_local(raw):
+        # 18/Oct/2026:12:00:05 +0500
+        try:
+            day = int(raw[0:2])
+            month = MONTHS[raw[3:6]]
+            year = int(raw[7:11])
+            hour = int(raw[12:14])
+            minute = int(raw[15:17])
+            second = int(raw[18:20])
+            ts = calendar.timegm((year, month, day, hour, minute, second, 0, 0, 0))
+            tz = raw[21:26]
+            if len(tz) == 5:
+                offset = int(tz[1:3]) * 3600 + int(tz[3:5]) * 60
+                ts -= offset if tz[:1] == b"+" else -offset
+            return float(ts)
+        except (KeyError, ValueError, IndexError):
+            return None
+
+    def any(self, value):
+        if isinstance(value, (int, float)):
+            return float(value)
+        text = str(value)
+        try:
+            return float(text)
+        except ValueError:
+            pass
+        if "/" in text:
+            return self.local(text.encode("ascii", "ignore"))
+        try:
+            return datetime.fromisoformat(text.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return None
+
+
+class AccessLogParser:
+    def __init__(self, prefixes, fmt=FORMAT_AUTO):
+        self.prefixes = clean_prefixes(prefixes)
+        self.prefix_bytes = tuple(p.encode("utf-8") for p in self.prefixes)
+        self.fmt = fmt
+        self.json_prefilter = build_prefilter(self.prefixes).search if self.prefixes else None
+        self.times = TimeParser()
+        self.misses = 0
+
+    def is_api_path(self, path):
+        return path.startswith(self.prefixes)
+
+    # Returns (ip, path, event time) for API requests, else None
+    def parse(self, raw):
+        if not self.prefixes:
+            return None
+        if self.fmt == FORMAT_JSON or (self.fmt == FORMAT_AUTO and raw[:1] == b"{"):
+            if self.json_prefilter(raw) is None:
+                return None
+            return self._parse_json(raw)
+        return self._parse_combined(raw)
+
+    def _parse_combined(self, raw):
+        # Prefilter: the prefix tuple is tested in C at the one offset where
+        # the path can start, so non-API lines never reach the regex
+        q = raw.find(b'"')
+        sp = raw.find(b" ", q + 1) if q > 0 else -1
+        if sp < 0:
+            self.misses += 1
+            return None
+        if not raw.startswith(self.prefix_bytes, sp + 1):
+            return None
+        m = COMBINED_RE.match(raw)
+        if m is None:
+            self.misses += 1
+            return None
+        ip, when, path = m.groups()
+        return ip.decode("ascii", "ignore"), path.decode("utf-8", "ignore"), self.times.local(when)
+
+    def _parse_json(self, raw):
+        try:
+            rec = json.loads(raw)
+        except ValueError:
+            self.misses += 1
+            return None
+        if not isinstance(rec, dict):
+            self.misses += 1
+            return None
+        ip = next((rec[k] for k in JSON_IP_KEYS if rec.get(k)), None)
+        path = next((rec[k] for k in JSON_PATH_KEYS if rec.get(k)), None)
+        if path is None and rec.get("request"):
+            parts = str(rec["request"]).split(" ")
+            path = parts[1] if len(parts) > 1 else None
+        if not ip or not path:
+            self.misses += 1
+            return None
+        path = str(path).split("?", 1)[0]
+        if not path.startswith(self.prefixes):
+            return None
+        when = next((rec[k] for k in JSON_TIME_KEYS if rec.get(k) not in (None, "")), None)
+        return str(ip), path, (None if when is None else self.times.any(when))
@@ -1,68 +1,211 @@
+import argparse
+import json
 import os
 import re
-import time
-from collections import deque, defaultdict
+import signal
 from datetime import datetime, timedelta, timezone
 
-from telegram_alert import send_message, md_kv, md_icon, md_title_icon, hostname
-
-
-NGINX_ACCESS_LOG = os.environ.get("NGINX_ACCESS_LOG", "/var/log/nginx/access.log")
-API_PREFIXES = os.environ.get("API_PREFIXES", "/api/,/v1/,/auth/").split(",")
-FLOOD_WINDOW_SEC = int(os.environ.get("API_FLOOD_WINDOW_SEC", "60"))
-FLOOD_THRESHOLD = int(os.environ.get("API_FLOOD_THRESHOLD", "100"))
-FLOOD_COOLDOWN = int(os.environ.get("API_FLOOD_COOLDOWN_SEC", "300"))
-SLEEP_SEC = float(os.environ.get("NGINX_TAIL_SLEEP_SEC", "0.5"))
-
-
-ACCESS_RE = re.compile(r'^(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<method>\S+) (?P<path>\S+)')
-
-
-class FileTailer:
-    def __init__(self, path):
-        self.path = path
-        self.fp = None
-        self.inode = None
-        self.pos = 0
-
-    def _open(self):
-        self.fp = open(self.path, "r", encoding="utf-8", errors="ignore")
-        st = os.fstat(self.fp.fileno())
-        self.inode = st.st_ino
-        self.fp.seek(0, os.SEEK_END)
-        self.pos = self.fp.tell()
-
-    def _reopen_if_rotated(self):
-        try:
-            st = os.stat(self.path)
-        except FileNotFoundError:
-            return
-        if self.inode != st.st_ino or st.st_size < self.pos:
-            try:
-                if self.fp:
-                    self.fp.close()
-            except Exception:
-                pass
-            self._open()
-
-    def lines(self):
-        if self.fp is None:
-            self._open()
-        self._reopen_if_rotated()
-        while True:
-            line = self.fp.readline()
-            if not line:
-                break
-            self.pos = self.fp.tell()
-            yield line
+import iplists
+import metrics
+import tailer as tailing
+from fleet import KIND_API, local_emit, make_forwarder
+from iplists import load_iplists
+from nginx_parser import AccessLogParser, clean_prefixes
+from sketches import CountMinSketch, HyperLogLog, SpaceSaving
+from state import Lifecycle, load_state, restore_state
+from tailer import MultiTailer, expand_sources, live_name
+from telegram_alert import AlertTemplate, get_config, send_alert, hostname, prefetch_emojis
+from windows import EventClock, WindowedCounter
+
+
+DIST_FLOOD_TOP = 5
+
+
+def load_settings():
+    # Detection settings, read again on SIGHUP; log paths and worker
+    # counts need a restart
+    global NGINX_ACCESS_LOG, NGINX_LOG_DIR_PATTERN, SLEEP_SEC, PARSE_WORKERS, PARSE_IN_FLIGHT, DIST_FLOOD_ROUTES
+    global API_PREFIXES, LOG_FORMAT, _API_PREFIXES
+    global FLOOD_WINDOW_SEC, FLOOD_THRESHOLD, FLOOD_COOLDOWN, MAX_TRACKED_IPS
+    global DIST_FLOOD_WINDOW_SEC, DIST_FLOOD_THRESHOLD, DIST_FLOOD_MIN_SOURCES, DIST_FLOOD_COOLDOWN
+    # The env file may set them too; it is read at most once here, before
+    # the tail and IP list settings, which were read at import without it
+    get_config()
+    tailing.load_settings()
+    iplists.load_settings()
+    # Comma separated files, globs or directories, e.g.
+    # "/var/log/nginx/access.log,/var/log/nginx/vhosts/*.access.log"
+    NGINX_ACCESS_LOG = os.environ.get("NGINX_ACCESS_LOG", "/var/log/nginx/access.log")
+    # Files picked from a directory given in NGINX_ACCESS_LOG
+    NGINX_LOG_DIR_PATTERN = os.environ.get("NGINX_LOG_DIR_PATTERN", "*access*.log")
+    SLEEP_SEC = float(os.environ.get("NGINX_TAIL_SLEEP_SEC", "0.5"))
+    # Parser/shard processes (nginx_parallel.py); 0 = parse in this process
+    PARSE_WORKERS = int(os.environ.get("NGINX_PARSE_WORKERS", "0"))
+    # Chunks per worker handed out before waiting for the detectors
+    PARSE_IN_FLIGHT = int(os.environ.get("NGINX_PARSE_IN_FLIGHT", "4"))
+    DIST_FLOOD_ROUTES = int(os.environ.get("API_DIST_FLOOD_ROUTES", "64"))
+    API_PREFIXES = os.environ.get("API_PREFIXES", "/api/,/v1/,/auth/").split(",")
+    # auto: JSON log_format lines (starting with "{") are detected per line
+    LOG_FORMAT = os.environ.get("NGINX_LOG_FORMAT", "auto").strip().lower()
+    _API_PREFIXES = clean_prefixes(API_PREFIXES)
+    FLOOD_WINDOW_SEC = int(os.environ.get("API_FLOOD_WINDOW_SEC", "60"))
+    FLOOD_THRESHOLD = int(os.environ.get("API_FLOOD_THRESHOLD", "100"))
+    FLOOD_COOLDOWN = int(os.environ.get("API_FLOOD_COOLDOWN_SEC", "300"))
+    MAX_TRACKED_IPS = int(os.environ.get("API_MAX_TRACKED_IPS", "100000"))
+
+    # Many sources hitting one route, each staying under FLOOD_THRESHOLD
+    DIST_FLOOD_WINDOW_SEC = int(os.environ.get("API_DIST_FLOOD_WINDOW_SEC", str(FLOOD_WINDOW_SEC)))
+    DIST_FLOOD_THRESHOLD = int(os.environ.get("API_DIST_FLOOD_THRESHOLD", "2000"))
+    DIST_FLOOD_MIN_SOURCES = int(os.environ.get("API_DIST_FLOOD_MIN_SOURCES", "50"))
+    DIST_FLOOD_COOLDOWN = int(os.environ.get("API_DIST_FLOOD_COOLDOWN_SEC", str(FLOOD_COOLDOWN)))
+
+
+load_settings()
+
+
+FLOOD_ALERT = AlertTemplate(
+    ("API_FLOOD_TITLE", "🌊"),
+    "API so'rov oqimi (flood) aniqlandi",
+    [
+        ("ip", "IP", "🌍", "IP"),
+        ("list", "LIST", "🚫", "Ro'yxat"),
+        ("vhost", "VHOST", "🏷️", "Vhost"),
+        ("route", "ROUTE", "🧭", "Yo'nalish"),
+        ("rate", "RATE", "📈", "So'rov/min"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="api_flood",
+    digest_keys=("vhost", "ip", "route"),
+)
+
+
+DIST_FLOOD_ALERT = AlertTemplate(
+    ("API_FLOOD_TITLE", "🌊"),
+    "Taqsimlangan API flood aniqlandi",
+    [
+        ("vhost", "VHOST", "🏷️", "Vhost"),
+        ("route", "ROUTE", "🧭", "Yo'nalish"),
+        ("sources", "IP", "🌍", "Manba IP soni"),
+        ("rate", "RATE", "📈", "So'rov/oyna"),
+        ("top", "RATE", "📈", "Eng faol IP"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="api_dist_flood",
+    digest_keys=("vhost", "route"),
+)
+
+
+class _RouteStats:
+    __slots__ = ("sources", "offenders", "checked")
+
+    def __init__(self):
+        self.sources = HyperLogLog(p=12)
+        self.offenders = SpaceSaving(k=16)
+        self.checked = 0.0
+
+
+class DistributedFloodDetector:
+    # Fixed memory regardless of the number of sources: the busiest routes
+    # (Space-Saving) each get a HyperLogLog of distinct IPs and a small
+    # heavy-hitter table; a Count-Min Sketch estimates per-IP rates.
+    # Windows are tumbling and every sketch is reset when one ends.
+    def __init__(
+        self,
+        window_sec=DIST_FLOOD_WINDOW_SEC,
+        threshold=DIST_FLOOD_THRESHOLD,
+        min_sources=DIST_FLOOD_MIN_SOURCES,
+        cooldown=DIST_FLOOD_COOLDOWN,
+        max_routes=DIST_FLOOD_ROUTES,
+    ):
+        self.window_sec = window_sec
+        self.threshold = threshold
+        self.min_sources = min_sources
+        self.cooldown = cooldown
+        self.routes = SpaceSaving(k=max_routes)
+        self.ip_rates = CountMinSketch(width=4096, depth=4)
+        self._stats = {}
+        self._last_alert = {}
+        self._window_end = None
+
+    def _roll(self, ts):
+        self._window_end = (ts // self.window_sec + 1) * self.window_sec
+        self.routes.clear()
+        self.ip_rates.clear()
+        self._stats.clear()
+        for route, at in list(self._last_alert.items()):
+            if ts - at >= self.cooldown:
+                del self._last_alert[route]
+
+    def add(self, ip, path, ts, vhost=""):
+        if self._window_end is None or ts >= self._window_end:
+            self._roll(ts)
+        route = (vhost, path) if vhost else path
+        self.ip_rates.add(ip)
+        evicted = self.routes.add(route)
+        if evicted is not None:
+            self._stats.pop(evicted, None)
+        st = self._stats.get(route)
+        if st is None:
+            st = self._stats[route] = _RouteStats()
+        st.sources.add(ip)
+        st.offenders.add(ip)
+
+        total = self.routes.count(route)
+        # HyperLogLog estimates are O(m); check each route at most once a second
+        if total < self.threshold or ts - st.checked < 1.0:
+            return None
+        st.checked = ts
+        if ts - self._last_alert.get(route, float("-inf")) < self.cooldown:
+            return None
+        sources = st.sources.count()
+        if sources < self.min_sources:
+            return None
+        self._last_alert[route] = ts
+        top = ", ".join(
+            f"{off_ip} ({self.ip_rates.estimate(off_ip)})"
+            for off_ip, _n in st.offenders.top(DIST_FLOOD_TOP)
+        )
+        return {"vhost": vhost or "-", "route": path, "sources": f"~{sources}", "rate": str(total), "top": top}
+
+    def configure(self, window_sec, threshold, min_sources, cooldown):
+        if window_sec != self.window_sec:
+            # The current tumbling window ends early, on the new boundary
+            self._window_end = None
+        self.window_sec = window_sec
+        self.threshold = threshold
+        self.min_sources = min_sources
+        self.cooldown = cooldown
+
+    def cooldowns(self):
+        # Alert times per route; the sketches use per-process hashing and
+        # are not worth keeping across a restart
+        return [[*route, at] if isinstance(route, tuple) else ["", route, at] for route, at in self._last_alert.items()]
+
+    def restore_cooldowns(self, items):
+        for vhost, path, at in items:
+            self._last_alert[(vhost, path) if vhost else path] = at
+
+    def memory_bytes(self):
+        per_route = 4096 + 16 * 120
+        return self.ip_rates.memory_bytes() + len(self._stats) * per_route
+
+
+_VHOST_SUFFIX_RE = re.compile(r"[._-]?access$")
+
+
+def vhost_name(path):
+    # /var/log/nginx/example.com.access.log -> example.com; the shared
+    # access.log has no vhost. Rotated copies (replay) count as the live file.
+    if not path:
+        return ""
+    stem = live_name(os.path.basename(path))
+    if stem.endswith(".log"):
+        stem = stem[:-4]
+    return _VHOST_SUFFIX_RE.sub("", stem)
 
 
 def is_api_path(path):
-    for pref in API_PREFIXES:
-        pref = pref.strip()
-        if pref and path.startswith(pref):
-            return True
-    return False
+    return path.startswith(_API_PREFIXES)
 
 
 def now_ts():
@@ -70,51 +213,204 @@ def now_ts():
     return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
 
 
-def main():
-    tailer = FileTailer(NGINX_ACCESS_LOG)
-    hits = defaultdict(lambda: deque())
-    last_alert = {}
-    last_path = {}
+class NginxWatcher:
+    def __init__(self, emit=send_alert, live=True, max_keys=MAX_TRACKED_IPS):
+        self.emit = local_emit(emit, live)
+        # API hits also go to the fleet aggregator when FLEET_FORWARD is set
+        self.forwarder = make_forwarder() if live else None
+        self.clock = EventClock(live=live)
+        # Idle keys are kept for the cooldown too, so eviction cannot re-arm an alert
+        self.hits = WindowedCounter(
+            FLOOD_WINDOW_SEC,
+            max_keys=max_keys,
+            idle_ttl=max(FLOOD_WINDOW_SEC, FLOOD_COOLDOWN),
+        )
+        self.dist = DistributedFloodDetector()
+        self.parser = AccessLogParser(API_PREFIXES, LOG_FORMAT)
+        # IP_ALLOWLIST ranges are dropped before any window, IP_DENYLIST ones tagged
+        self.iplists = load_iplists()
+        self.lines_read = 0
+        self.events = 0
+        self.excluded = 0
+        self.alerts = 0
+        self._vhosts = {}
+
+    def tracked_keys(self):
+        return len(self.hits)
+
+    def memory_bytes(self):
+        return self.hits.memory_bytes() + self.dist.memory_bytes()
+
+    def reload_settings(self, shards=1):
+        load_settings()
+        # Counts and cooldowns stay; only the window geometry is converted
+        self.hits.resize(
+            FLOOD_WINDOW_SEC,
+            max_keys=max(1, MAX_TRACKED_IPS // shards),
+            idle_ttl=max(FLOOD_WINDOW_SEC, FLOOD_COOLDOWN),
+        )
+        self.dist.configure(DIST_FLOOD_WINDOW_SEC, DIST_FLOOD_THRESHOLD, DIST_FLOOD_MIN_SOURCES, DIST_FLOOD_COOLDOWN)
+        parser = AccessLogParser(API_PREFIXES, LOG_FORMAT)
+        parser.misses = self.parser.misses
+        self.parser = parser
+
+    def snapshot(self):
+        sections = self.hits.dump("hits")
+        sections["clock"] = json.dumps({"watermark": self.clock.watermark}).encode()
+        sections["dist"] = json.dumps(self.dist.cooldowns()).encode()
+        return sections
+
+    def restore(self, sections):
+        self.hits.load(sections, "hits")
+        if "clock" in sections:
+            self.clock.watermark = json.loads(sections["clock"])["watermark"]
+        if "dist" in sections:
+            self.dist.restore_cooldowns(json.loads(sections["dist"]))
 
-    while True:
-        for line in tailer.lines():
-            m = ACCESS_RE.search(line)
-            if not m:
+    def vhost(self, source):
+        vhost = self._vhosts.get(source)
+        if vhost is None:
+            vhost = self._vhosts[source] = vhost_name(source)
+        return vhost
+
+    def allowed_check(self):
+        lists = self.iplists
+        if lists is None:
+            return None
+        lists.refresh()
+        return lists.allowed
+
+    def feed(self, lines, source=None):
+        parse = self.parser.parse
+        clock = self.clock
+        observe = clock.observe
+        late = clock.late
+        allowed = self.allowed_check()
+        excluded = 0
+        self.lines_read += len(lines)
+        events = []
+        append = events.append
+        for raw in lines:
+            event = parse(raw)
+            if event is None:
                 continue
-            ip = m.group("ip")
-            path = m.group("path").split("?")[0]
-            if not is_api_path(path):
+            ip, path, ts = event
+            if allowed is not None and allowed(ip):
+                excluded += 1
                 continue
-            ts = time.time()
-            dq = hits[ip]
-            dq.append(ts)
-            last_path[ip] = path
-
-            while dq and (ts - dq[0]) > FLOOD_WINDOW_SEC:
-                dq.popleft()
-
-            if len(dq) >= FLOOD_THRESHOLD:
-                last = last_alert.get(ip, 0)
-                if (ts - last) >= FLOOD_COOLDOWN:
-                    last_alert[ip] = ts
-                    msg = "\n".join(
-                        [
-                            md_title_icon(
-                                md_icon("API_FLOOD_TITLE", "🌊"),
-                                "API so'rov oqimi (flood) aniqlandi",
-                            ),
-                            md_kv(md_icon("IP", "🌍"), "IP", ip),
-                            md_kv(md_icon("ROUTE", "🧭"), "Yo'nalish", last_path.get(ip, path)),
-                            md_kv(md_icon("RATE", "📈"), "So'rov/min", str(len(dq))),
-                            md_kv(md_icon("SERVER", "🖥️"), "Server", hostname()),
-                        ]
+            ts = observe(ts)
+            if ts is not None:
+                append((ip, path, ts))
+        # Late and allowlisted lines parsed fine, they count as events too
+        self.excluded += excluded
+        self.events += len(events) + clock.late - late + excluded
+        vhost = self.vhost(source)
+        self.flood(events, vhost)
+        self.dist_flood(events, vhost)
+
+    # The two detectors take (ip, path, event time) lists so the parallel
+    # pipeline (nginx_parallel.py) can run them on IP shards
+    def flood(self, events, vhost=""):
+        hits = self.hits
+        forwarder = self.forwarder
+        for ip, path, ts in events:
+            if forwarder is not None:
+                forwarder.add(KIND_API, ip, path, ts)
+            # Per vhost: one IP hammering two sites is two separate floods
+            key = (vhost, ip) if vhost else ip
+            count = hits.add(key, ts)
+            if count >= FLOOD_THRESHOLD:
+                slot = hits.get(key)
+                if (ts - slot.alert) >= FLOOD_COOLDOWN:
+                    slot.alert = ts
+                    self.alerts += 1
+                    self.emit(
+                        FLOOD_ALERT.message(
+                            ip=ip,
+                            list=self.iplists.label(ip) if self.iplists is not None else "-",
+                            vhost=vhost or "-",
+                            route=path,
+                            rate=str(count),
+                            server=hostname(),
+                        )
                     )
-                    send_message(msg)
-        time.sleep(SLEEP_SEC)
+        if forwarder is not None:
+            forwarder.flush()
+
+    def dist_flood(self, events, vhost=""):
+        add = self.dist.add
+        for ip, path, ts in events:
+            found = add(ip, path, ts, vhost)
+            if found:
+                self.alerts += 1
+                self.emit(DIST_FLOOD_ALERT.message(server=hostname(), **found))
+
+    def flush(self):
+        return True
+
+    def close(self):
+        pass
+
+
+def make_watcher(workers=PARSE_WORKERS, emit=send_alert, live=True):
+    if workers > 0:
+        from nginx_parallel import ParallelNginxWatcher
+
+        return ParallelNginxWatcher(workers, emit=emit, live=live)
+    return NginxWatcher(emit=emit, live=live)
+
+
+def make_tailer(reactor=None):
+    return MultiTailer(
+        expand_sources(NGINX_ACCESS_LOG, NGINX_LOG_DIR_PATTERN),
+        max_sleep=SLEEP_SEC,
+        reactor=reactor,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Nginx API flood kuzatuvchisi")
+    parser.add_argument("--replay", nargs="+", metavar="FILE", help="eski loglarni (.gz ham) tahlil qilib, ogohlantirishlarni chop etish")
+    parser.add_argument("--quiet", action="store_true", help="--replay: faqat yakuniy hisobot")
+    parser.add_argument("--workers", type=int, default=PARSE_WORKERS, help="parallel tahlil jarayonlari soni (0 = bitta jarayon)")
+    args = parser.parse_args(argv)
+    if args.replay:
+        from replay import replay
+
+        return replay(lambda **kw: make_watcher(args.workers, **kw), args.replay, quiet=args.quiet)
+
+    # Workers are forked before the metrics thread starts
+    watcher = make_watcher(args.workers)
+    # Before the tailer: the snapshot may move its checkpoints
+    sections = load_state("nginx_watch")
+    tailer = make_tailer()
+    restore_state("nginx_watch", watcher, sections)
+    lifecycle = Lifecycle("nginx_watch", watcher, tailer).install()
+    metrics.register_watcher("nginx_watch", watcher, tailer)
+    metrics.serve()
+    prefetch_emojis()
+    try:
+        while True:
+            for source, block in tailer.tagged_blocks():
+                lifecycle.step()
+                watcher.feed(block, source)
+            # Alerts of a parallel watcher are out before we go idle
+            watcher.flush()
+            lifecycle.idle()
+            tailer.wait()
+    finally:
+        lifecycle.save()
+        watcher.close()
+        tailer.close()
+
+
+def _handle_term(_sig, _frame):
+    raise SystemExit(0)
 
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _handle_term)
     try:
-        main()
+        raise SystemExit(main())
     except Exception as e:
         print(f"nginx_watch error: {e}")
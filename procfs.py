@@ -0,0 +1,233 @@
+import heapq
+import os
+import resource
+
+
+def load_settings():
+    # resource_watch reads these again after loading the env file
+    global PROC_ROOT, PROCESS_MAX_FDS
+    PROC_ROOT = os.environ.get("PROC_ROOT", "/proc")
+    # Cached /proc/<pid>/stat descriptors; processes beyond this are read with
+    # a plain open/read/close so a host with many PIDs cannot exhaust our fds
+    PROCESS_MAX_FDS = int(os.environ.get("PROCESS_MAX_FDS", "1024"))
+
+
+load_settings()
+
+PSI_RESOURCES = ("cpu", "memory", "io")
+
+
+class ProcFile:
+    # Opened once; every read is a single pread from offset 0, which makes
+    # the kernel regenerate the file without an open/close per sample
+    def __init__(self, path, size=8192):
+        self.path = path
+        self.size = size
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+
+    def read(self):
+        return os.pread(self.fd, self.size, 0)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _open_optional(path):
+    try:
+        return ProcFile(path)
+    except OSError:
+        return None
+
+
+def _field(data, key):
+    # "MemAvailable:    5665788 kB" -> 5665788
+    i = data.find(key)
+    if i < 0:
+        return None
+    return int(data[i + len(key) :].split(None, 1)[0])
+
+
+class ProcSampler:
+    def __init__(self, root=None):
+        root = PROC_ROOT if root is None else root
+        self.stat = ProcFile(os.path.join(root, "stat"))
+        self.meminfo = ProcFile(os.path.join(root, "meminfo"))
+        self.loadavg = _open_optional(os.path.join(root, "loadavg"))
+        # PSI needs CONFIG_PSI (Linux 4.20+); missing files just mean no data
+        self.psi = {}
+        for name in PSI_RESOURCES:
+            f = _open_optional(os.path.join(root, "pressure", name))
+            if f is not None:
+                self.psi[name] = f
+        self._prev = None
+
+    def cpu(self):
+        # Busy and iowait percent of all CPUs since the previous call
+        line = self.stat.read().split(b"\n", 1)[0]
+        vals = [int(v) for v in line.split()[1:]]
+        # user nice system idle iowait irq softirq steal [guest guest_nice]
+        # guest time is already counted in user/nice
+        total = sum(vals[:8])
+        idle = vals[3]
+        iowait = vals[4] if len(vals) > 4 else 0
+        prev = self._prev
+        self._prev = (total, idle, iowait)
+        if prev is None:
+            return None, None
+        dt = total - prev[0]
+        if dt <= 0:
+            return 0.0, 0.0
+        d_idle = idle - prev[1]
+        d_iowait = iowait - prev[2]
+        return 100.0 * (dt - d_idle - d_iowait) / dt, 100.0 * d_iowait / dt
+
+    def memory(self):
+        # Same definition as psutil: (total - available) / total
+        data = self.meminfo.read()
+        total = _field(data, b"MemTotal:")
+        avail = _field(data, b"MemAvailable:")
+        if not total:
+            return None
+        if avail is None:
+            avail = (_field(data, b"MemFree:") or 0) + (_field(data, b"Cached:") or 0)
+        return 100.0 * (total - avail) / total
+
+    def load(self):
+        if self.loadavg is None:
+            return None
+        return float(self.loadavg.read().split(None, 1)[0])
+
+    def pressure(self, name, kind=b"some"):
+        # avg10 of "some" (at least one task stalled) for cpu/memory/io
+        f = self.psi.get(name)
+        if f is None:
+            return None
+        data = f.read()
+        i = data.find(kind + b" avg10=")
+        if i < 0:
+            return None
+        i += len(kind) + 7
+        return float(data[i : data.index(b" ", i)])
+
+    def close(self):
+        for f in [self.stat, self.meminfo, self.loadavg] + list(self.psi.values()):
+            if f is not None:
+                f.close()
+        self.psi = {}
+
+
+class _Proc:
+    __slots__ = ("pid", "name", "start", "ticks", "rss", "cpu", "fd", "gen")
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.name = ""
+        self.start = None
+        self.ticks = 0
+        self.rss = 0
+        self.cpu = 0.0
+        self.fd = None
+        self.gen = 0
+
+
+class ProcessTable:
+    # Incremental view of /proc/<pid>/stat: entries and their descriptors
+    # live across scans, so a scan is one pread per process and the CPU
+    # share is the tick delta since the previous scan
+    def __init__(self, root=None, max_fds=None):
+        self.root = PROC_ROOT if root is None else root
+        max_fds = PROCESS_MAX_FDS if max_fds is None else max_fds
+        # Never take more than half of our descriptor limit
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft != resource.RLIM_INFINITY:
+            max_fds = min(max_fds, soft // 2)
+        self.max_fds = max_fds
+        self.procs = {}
+        self.last_scan = None
+        self.scans = 0
+        self._gen = 0
+        self._fds = 0
+        self._hz = os.sysconf("SC_CLK_TCK")
+        self._page = os.sysconf("SC_PAGE_SIZE")
+
+    def _read(self, proc):
+        if proc.fd is None and self._fds < self.max_fds:
+            try:
+                proc.fd = os.open(f"{self.root}/{proc.pid}/stat", os.O_RDONLY | os.O_CLOEXEC)
+                self._fds += 1
+            except OSError:
+                return None
+        if proc.fd is not None:
+            try:
+                return os.pread(proc.fd, 1024, 0)
+            except OSError:
+                # ESRCH: the process is gone
+                return None
+        try:
+            with open(f"{self.root}/{proc.pid}/stat", "rb") as f:
+                return f.read(1024)
+        except OSError:
+            return None
+
+    def _drop(self, proc):
+        if proc.fd is not None:
+            os.close(proc.fd)
+            self._fds -= 1
+            proc.fd = None
+        del self.procs[proc.pid]
+
+    def scan(self, now):
+        self._gen += 1
+        gen = self._gen
+        dt = None if self.last_scan is None else now - self.last_scan
+        scale = 100.0 / (self._hz * dt) if dt else 0.0
+        procs = self.procs
+        for entry in os.scandir(self.root):
+            name = entry.name
+            if not name.isdigit():
+                continue
+            pid = int(name)
+            proc = procs.get(pid)
+            if proc is None:
+                proc = procs[pid] = _Proc(pid)
+            data = self._read(proc)
+            if not data:
+                self._drop(proc)
+                continue
+            # "pid (comm) state ppid ..."; comm may itself contain ") "
+            rp = data.rfind(b")")
+            fields = data[rp + 2 :].split()
+            try:
+                ticks = int(fields[11]) + int(fields[12])
+                start = int(fields[19])
+                rss = int(fields[21]) * self._page
+            except (IndexError, ValueError):
+                # Truncated or odd line: skip this process, not the scan
+                self._drop(proc)
+                continue
+            if proc.start != start:
+                # New process, or the PID was reused
+                proc.start = start
+                proc.name = data[data.find(b"(") + 1 : rp].decode("utf-8", "replace")
+                proc.cpu = 0.0
+            elif scale:
+                proc.cpu = (ticks - proc.ticks) * scale
+            proc.ticks = ticks
+            proc.rss = rss
+            proc.gen = gen
+        for proc in [p for p in procs.values() if p.gen != gen]:
+            self._drop(proc)
+        self.last_scan = now
+        self.scans += 1
+
+    def top_cpu(self, n=5):
+        return heapq.nlargest(n, self.procs.values(), key=lambda p: p.cpu)
+
+    def top_rss(self, n=5):
+        return heapq.nlargest(n, self.procs.values(), key=lambda p: p.rss)
+
+    def close(self):
+        for proc in list(self.procs.values()):
+            self._drop(proc)
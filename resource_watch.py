@@ -1,20 +1,122 @@
 import os
+import signal
+import sys
 import time
+from collections import deque
 from datetime import datetime, timedelta, timezone
 
-import psutil
+import heartbeat
+import metrics
+import procfs
+from procfs import ProcessTable, ProcSampler
+from telegram_alert import AlertTemplate, get_config, send_alert, hostname, prefetch_emojis, reload_config
 
-from telegram_alert import send_message, md_kv, md_icon, md_title_icon, hostname
 
+def load_settings():
+    # Thresholds and sampling, read again on SIGHUP
+    global CPU_THRESHOLD, CPU_DURATION_SEC, CPU_COOLDOWN_SEC, RAM_THRESHOLD, RAM_COOLDOWN_SEC
+    global IOWAIT_THRESHOLD, IOWAIT_DURATION_SEC, IOWAIT_COOLDOWN_SEC
+    global MEM_PRESSURE_THRESHOLD, MEM_PRESSURE_DURATION_SEC, MEM_PRESSURE_COOLDOWN_SEC
+    global SLEEP_SEC, MAX_SLEEP_SEC, NEAR_RATIO, PROCESS_TOP_N, PROCESS_SCAN_SEC
+    # The env file may set them too; it is read at most once here
+    get_config()
+    procfs.load_settings()
+    CPU_THRESHOLD = float(os.environ.get("CPU_THRESHOLD", "60"))
+    CPU_DURATION_SEC = int(os.environ.get("CPU_DURATION_SEC", "30"))
+    CPU_COOLDOWN_SEC = int(os.environ.get("CPU_COOLDOWN_SEC", "300"))
 
-CPU_THRESHOLD = float(os.environ.get("CPU_THRESHOLD", "60"))
-CPU_DURATION_SEC = int(os.environ.get("CPU_DURATION_SEC", "30"))
-CPU_COOLDOWN_SEC = int(os.environ.get("CPU_COOLDOWN_SEC", "300"))
+    RAM_THRESHOLD = float(os.environ.get("RAM_THRESHOLD", "80"))
+    RAM_COOLDOWN_SEC = int(os.environ.get("RAM_COOLDOWN_SEC", "300"))
 
-RAM_THRESHOLD = float(os.environ.get("RAM_THRESHOLD", "80"))
-RAM_COOLDOWN_SEC = int(os.environ.get("RAM_COOLDOWN_SEC", "300"))
+    # Share of CPU time spent waiting for disk I/O
+    IOWAIT_THRESHOLD = float(os.environ.get("IOWAIT_THRESHOLD", "20"))
+    IOWAIT_DURATION_SEC = int(os.environ.get("IOWAIT_DURATION_SEC", "30"))
+    IOWAIT_COOLDOWN_SEC = int(os.environ.get("IOWAIT_COOLDOWN_SEC", "300"))
 
-SLEEP_SEC = float(os.environ.get("RESOURCE_WATCH_SLEEP_SEC", "1"))
+    # PSI memory "some avg10": % of time at least one task stalled on memory
+    MEM_PRESSURE_THRESHOLD = float(os.environ.get("MEM_PRESSURE_THRESHOLD", "10"))
+    MEM_PRESSURE_DURATION_SEC = int(os.environ.get("MEM_PRESSURE_DURATION_SEC", "30"))
+    MEM_PRESSURE_COOLDOWN_SEC = int(os.environ.get("MEM_PRESSURE_COOLDOWN_SEC", "300"))
+
+    # Sampling interval: SLEEP_SEC near a threshold, backing off to MAX_SLEEP_SEC
+    SLEEP_SEC = float(os.environ.get("RESOURCE_WATCH_SLEEP_SEC", "1"))
+    MAX_SLEEP_SEC = float(os.environ.get("RESOURCE_WATCH_MAX_SLEEP_SEC", "5"))
+    # "Near" means above this fraction of a threshold
+    NEAR_RATIO = float(os.environ.get("RESOURCE_WATCH_NEAR_RATIO", "0.8"))
+
+    # Processes listed in CPU/RAM alerts; 0 turns attribution off
+    PROCESS_TOP_N = int(os.environ.get("PROCESS_TOP_N", "5"))
+    # Background rescan so CPU deltas have a recent baseline and dead PIDs go
+    PROCESS_SCAN_SEC = float(os.environ.get("PROCESS_SCAN_SEC", "60"))
+
+
+load_settings()
+
+
+CPU_ALERT = AlertTemplate(
+    ("CPU_TITLE", "🔥"),
+    "CPU yuklamasi yuqori",
+    [
+        ("cpu", "CPU", "🧠", "CPU yuklama"),
+        ("duration", "DURATION", "⏳", "Davomiylik"),
+        ("load", "LOAD", "📊", "Load average"),
+        ("top", "TOP", "🔝", "Eng ko'p CPU"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="cpu_high",
+)
+
+RAM_ALERT = AlertTemplate(
+    ("RAM_TITLE", "💾"),
+    "Xotira (RAM) yuklamasi yuqori",
+    [
+        ("ram", "RAM", "💽", "RAM ishlatilishi"),
+        ("top", "TOP", "🔝", "Eng ko'p RAM"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="ram_high",
+)
+
+IOWAIT_ALERT = AlertTemplate(
+    ("IO_TITLE", "💿"),
+    "Disk I/O kutish (iowait) yuqori",
+    [
+        ("iowait", "IO", "⏱️", "I/O kutish"),
+        ("duration", "DURATION", "⏳", "Davomiylik"),
+        ("pressure", "PSI", "📉", "I/O bosimi (PSI)"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="iowait_high",
+)
+
+MEM_PRESSURE_ALERT = AlertTemplate(
+    ("RAM_TITLE", "💾"),
+    "Xotira bosimi (memory pressure) yuqori",
+    [
+        ("pressure", "PSI", "📉", "Bosim (avg10)"),
+        ("duration", "DURATION", "⏳", "Davomiylik"),
+        ("ram", "RAM", "💽", "RAM ishlatilishi"),
+        ("top", "TOP", "🔝", "Eng ko'p RAM"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="mem_pressure",
+)
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024.0
+    return f"{n:.1f} TB"
+
+
+def format_top_cpu(procs):
+    return ", ".join(f"{p.name} ({p.pid}) {p.cpu:.0f}%" for p in procs) or "-"
+
+
+def format_top_rss(procs):
+    return ", ".join(f"{p.name} ({p.pid}) {format_bytes(p.rss)}" for p in procs) or "-"
 
 
 def now_ts():
@@ -22,51 +124,222 @@ def now_ts():
     return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
 
 
-def main():
-    cpu_over_seconds = 0
-    last_cpu_alert = 0
-    last_ram_alert = 0
-    ram_check_counter = 0
+class Sustain:
+    # Ring of (monotonic time, value) samples covering `duration` seconds.
+    # The condition holds once every sample since `over_since` is above the
+    # threshold and that span is at least `duration` long, whatever the
+    # sampling interval.
+    def __init__(self, threshold, duration, cooldown):
+        self.configure(threshold, duration, cooldown)
+        self.ring = deque()
+        self.over_since = None
+        self.last_alert = float("-inf")
+        self._last_t = None
 
-    while True:
-        cpu = psutil.cpu_percent(interval=None)
-        if cpu >= CPU_THRESHOLD:
-            cpu_over_seconds += 1
+    def configure(self, threshold, duration, cooldown):
+        # Samples, the span over the threshold and the cooldown are kept;
+        # the next add() judges them by the new values
+        self.threshold = threshold
+        self.duration = duration
+        self.cooldown = cooldown
+
+    def add(self, t, value):
+        ring = self.ring
+        ring.append((t, value))
+        while len(ring) > 1 and t - ring[1][0] >= self.duration:
+            ring.popleft()
+        if value >= self.threshold:
+            if self.over_since is None:
+                # The sample covers the interval since the previous one
+                self.over_since = self._last_t if self._last_t is not None else t
         else:
-            cpu_over_seconds = 0
-
-        now = time.time()
-        if cpu_over_seconds >= CPU_DURATION_SEC and (now - last_cpu_alert) >= CPU_COOLDOWN_SEC:
-            last_cpu_alert = now
-            msg = "\n".join(
-                [
-                    md_title_icon(md_icon("CPU_TITLE", "🔥"), "CPU yuklamasi yuqori"),
-                    md_kv(md_icon("CPU", "🧠"), "CPU yuklama", f"{cpu:.1f}%"),
-                    md_kv(md_icon("DURATION", "⏳"), "Davomiylik", f"{CPU_DURATION_SEC}s+"),
-                    md_kv(md_icon("SERVER", "🖥️"), "Server", hostname()),
-                ]
+            self.over_since = None
+        self._last_t = t
+
+    def sustained(self, t):
+        return self.over_since is not None and t - self.over_since >= self.duration
+
+    def fire(self, t):
+        if not self.sustained(t) or t - self.last_alert < self.cooldown:
+            return False
+        self.last_alert = t
+        return True
+
+    def near(self, value):
+        return value is not None and value >= self.threshold * NEAR_RATIO
+
+    def average(self):
+        return sum(v for _t, v in self.ring) / len(self.ring) if self.ring else 0.0
+
+
+class ResourceWatcher:
+    def __init__(self, emit=send_alert, sampler=None, procs=None):
+        self.emit = emit
+        self.sampler = sampler or ProcSampler()
+        self.procs = procs if procs is not None else (ProcessTable() if PROCESS_TOP_N > 0 else None)
+        self.cpu = Sustain(CPU_THRESHOLD, CPU_DURATION_SEC, CPU_COOLDOWN_SEC)
+        self.iowait = Sustain(IOWAIT_THRESHOLD, IOWAIT_DURATION_SEC, IOWAIT_COOLDOWN_SEC)
+        self.mem_pressure = Sustain(MEM_PRESSURE_THRESHOLD, MEM_PRESSURE_DURATION_SEC, MEM_PRESSURE_COOLDOWN_SEC)
+        self.last_ram_alert = float("-inf")
+        self.interval = SLEEP_SEC
+        self.events = 0
+        self.alerts = 0
+
+    def reload_settings(self):
+        load_settings()
+        self.cpu.configure(CPU_THRESHOLD, CPU_DURATION_SEC, CPU_COOLDOWN_SEC)
+        self.iowait.configure(IOWAIT_THRESHOLD, IOWAIT_DURATION_SEC, IOWAIT_COOLDOWN_SEC)
+        self.mem_pressure.configure(MEM_PRESSURE_THRESHOLD, MEM_PRESSURE_DURATION_SEC, MEM_PRESSURE_COOLDOWN_SEC)
+        if PROCESS_TOP_N > 0 and self.procs is None:
+            self.procs = ProcessTable()
+        elif PROCESS_TOP_N <= 0 and self.procs is not None:
+            self.procs.close()
+            self.procs = None
+        self.interval = SLEEP_SEC
+
+    def _scan(self, now):
+        if self.procs is None:
+            return False
+        try:
+            self.procs.scan(now)
+        except OSError as e:
+            print(f"resource_watch: process scan failed: {e}", file=sys.stderr)
+            return False
+        return True
+
+    def _top_cpu(self, now):
+        # CPU shares are deltas since the scan taken when the load crossed
+        # the threshold, i.e. averaged over the sustained period
+        if not self._scan(now):
+            return "-"
+        return format_top_cpu([p for p in self.procs.top_cpu(PROCESS_TOP_N) if p.cpu >= 0.5])
+
+    def _top_rss(self, now):
+        if self.procs is None:
+            return "-"
+        if self.procs.last_scan != now and not self._scan(now):
+            return "-"
+        return format_top_rss(self.procs.top_rss(PROCESS_TOP_N))
+
+    def _alert(self, message):
+        self.alerts += 1
+        self.emit(message)
+
+    # One sampling step; returns the number of seconds until the next one
+    def sample(self):
+        now = time.monotonic()
+        sampler = self.sampler
+        cpu, iowait = sampler.cpu()
+        ram = sampler.memory()
+        pressure = sampler.pressure("memory")
+        self.events += 1
+        if cpu is None:
+            # First call only primes the CPU counters
+            return SLEEP_SEC
+
+        was_over = self.cpu.over_since is not None
+        self.cpu.add(now, cpu)
+        self.iowait.add(now, iowait)
+        procs = self.procs
+        if procs is not None:
+            # Full scans only as a CPU alert builds up and on a slow cadence
+            if (not was_over and self.cpu.over_since is not None) or (
+                procs.last_scan is None or now - procs.last_scan >= PROCESS_SCAN_SEC
+            ):
+                self._scan(now)
+        if pressure is not None:
+            self.mem_pressure.add(now, pressure)
+
+        if self.cpu.fire(now):
+            load = sampler.load()
+            self._alert(
+                CPU_ALERT.message(
+                    cpu=f"{cpu:.1f}% (o'rtacha {self.cpu.average():.1f}%)",
+                    duration=f"{int(now - self.cpu.over_since)}s",
+                    load="-" if load is None else f"{load:.2f}",
+                    top=self._top_cpu(now),
+                    server=hostname(),
+                )
             )
-            send_message(msg)
-
-        ram_check_counter += 1
-        if ram_check_counter >= 5:
-            ram_check_counter = 0
-            ram = psutil.virtual_memory().percent
-            if ram >= RAM_THRESHOLD and (now - last_ram_alert) >= RAM_COOLDOWN_SEC:
-                last_ram_alert = now
-                msg = "\n".join(
-                    [
-                        md_title_icon(md_icon("RAM_TITLE", "💾"), "Xotira (RAM) yuklamasi yuqori"),
-                        md_kv(md_icon("RAM", "💽"), "RAM ishlatilishi", f"{ram:.1f}%"),
-                        md_kv(md_icon("SERVER", "🖥️"), "Server", hostname()),
-                    ]
+        if self.iowait.fire(now):
+            io_psi = sampler.pressure("io")
+            self._alert(
+                IOWAIT_ALERT.message(
+                    iowait=f"{iowait:.1f}% (o'rtacha {self.iowait.average():.1f}%)",
+                    duration=f"{int(now - self.iowait.over_since)}s",
+                    pressure="-" if io_psi is None else f"{io_psi:.1f}%",
+                    server=hostname(),
                 )
-                send_message(msg)
+            )
+        if pressure is not None and self.mem_pressure.fire(now):
+            self._alert(
+                MEM_PRESSURE_ALERT.message(
+                    pressure=f"{pressure:.1f}%",
+                    duration=f"{int(now - self.mem_pressure.over_since)}s",
+                    ram="-" if ram is None else f"{ram:.1f}%",
+                    top=self._top_rss(now),
+                    server=hostname(),
+                )
+            )
+        if ram is not None and ram >= RAM_THRESHOLD and (now - self.last_ram_alert) >= RAM_COOLDOWN_SEC:
+            self.last_ram_alert = now
+            self._alert(RAM_ALERT.message(ram=f"{ram:.1f}%", top=self._top_rss(now), server=hostname()))
+
+        # Fast while anything is near its threshold, slower when idle
+        near = (
+            self.cpu.near(cpu)
+            or self.iowait.near(iowait)
+            or self.mem_pressure.near(pressure)
+            or (ram is not None and ram >= RAM_THRESHOLD * NEAR_RATIO)
+        )
+        if near:
+            self.interval = SLEEP_SEC
+        else:
+            self.interval = min(self.interval * 2, max(MAX_SLEEP_SEC, SLEEP_SEC))
+        return self.interval
+
+    def close(self):
+        self.sampler.close()
+        if self.procs is not None:
+            self.procs.close()
+
+
+_reload = False
+
+
+def main():
+    global _reload
+    watcher = ResourceWatcher()
+    metrics.register_watcher("resource_watch", watcher)
+    metrics.serve()
+    prefetch_emojis()
+    beat = heartbeat.from_env()
+    while True:
+        if _reload:
+            # Between samples, so no Sustain changes under a running one
+            _reload = False
+            reload_config()
+            watcher.reload_settings()
+            print("resource_watch: settings reloaded", file=sys.stderr)
+        delay = watcher.sample()
+        if beat is not None:
+            beat.beat(watcher.events)
+        time.sleep(delay)
+
+
+def _handle_term(_sig, _frame):
+    raise SystemExit(0)
+
 
-        time.sleep(SLEEP_SEC)
+def _handle_hup(_sig, _frame):
+    # Applied by main() before the next sample; the rings and cooldowns stay
+    global _reload
+    _reload = True
 
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _handle_term)
+    signal.signal(signal.SIGHUP, _handle_hup)
     try:
         main()
     except Exception as e:
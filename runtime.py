@@ -0,0 +1,183 @@
+import asyncio
+import importlib
+import os
+import signal
+import sys
+
+import metrics
+from state import SNAPSHOT_INTERVAL_SEC, load_state, restore_state, save_state
+import tailer as tailing
+from tailer import TailReactor
+from telegram_alert import flush_alerts, get_config, get_dispatcher, reload_config
+
+
+# name -> (module, watcher class, kind); modules are imported lazily so a
+# disabled watcher never pulls in its dependencies
+WATCHERS = {
+    "ssh_watch": ("ssh_watch", "SSHWatcher", "tail"),
+    "nginx_watch": ("nginx_watch", "NginxWatcher", "tail"),
+    "resource_watch": ("resource_watch", "ResourceWatcher", "sample"),
+    "fail2ban_watch": ("fail2ban_watch", "Fail2banWatcher", "socket"),
+}
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return float(default)
+
+
+async def _tail_loop(name, module, watcher_cls, reactor, live):
+    # Same snapshot files as the standalone watchers. Signals and
+    # cancellation only land between blocks here, so no Lifecycle is needed.
+    sections = load_state(name)
+    tailer = module.make_tailer(reactor=reactor)
+    watcher = watcher_cls()
+    restore_state(name, watcher, sections)
+    metrics.register_watcher(name, watcher, tailer)
+    ready = asyncio.Event()
+    reactor.set_callback(tailer, ready.set)
+    loop = asyncio.get_running_loop()
+    next_save = loop.time() + SNAPSHOT_INTERVAL_SEC
+    live[name] = watcher
+    try:
+        while True:
+            ready.clear()
+            for source, block in tailer.tagged_blocks():
+                watcher.feed(block, source)
+                # Let the other watchers run between blocks of a long backlog
+                await asyncio.sleep(0)
+            if SNAPSHOT_INTERVAL_SEC > 0 and loop.time() >= next_save:
+                save_state(name, watcher, tailer)
+                next_save = loop.time() + SNAPSHOT_INTERVAL_SEC
+            if tailer.event_driven:
+                try:
+                    await asyncio.wait_for(ready.wait(), tailing.IDLE_TIMEOUT_SEC)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(tailer.poll_delay())
+    except asyncio.CancelledError:
+        # Not after an error: it may have left a block half fed
+        save_state(name, watcher, tailer)
+        raise
+    finally:
+        live.pop(name, None)
+        tailer.close()
+
+
+async def _sample_loop(name, watcher_cls):
+    watcher = watcher_cls()
+    metrics.register_watcher(name, watcher)
+    while True:
+        await asyncio.sleep(watcher.sample())
+
+
+async def _socket_loop(name, watcher_cls):
+    watcher = watcher_cls()
+    watcher.open()
+    metrics.register_watcher(name, watcher)
+    loop = asyncio.get_running_loop()
+    failed = loop.create_future()
+
+    def on_readable():
+        try:
+            watcher.drain()
+        except Exception as e:
+            if not failed.done():
+                failed.set_exception(e)
+
+    loop.add_reader(watcher.fileno(), on_readable)
+    try:
+        await failed
+    finally:
+        loop.remove_reader(watcher.fileno())
+        watcher.close()
+
+
+async def _supervise(name, reactor, restart_sec, restarts, live):
+    module_name, cls_name, kind = WATCHERS[name]
+    up = metrics.WATCHER_UP.labels(name)
+    restarted = metrics.RESTARTS.labels(name)
+    while True:
+        try:
+            module = importlib.import_module(module_name)
+            watcher_cls = getattr(module, cls_name)
+            up.set(1)
+            if kind == "tail":
+                await _tail_loop(name, module, watcher_cls, reactor, live)
+            elif kind == "socket":
+                await _socket_loop(name, watcher_cls)
+            else:
+                await _sample_loop(name, watcher_cls)
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Only this watcher is restarted; the others keep running
+            restarts[name] = restarts.get(name, 0) + 1
+            restarted.inc()
+            print(f"runtime: {name} error: {e}", file=sys.stderr)
+        finally:
+            up.set(0)
+        await asyncio.sleep(restart_sec)
+
+
+async def _main(names, restart_sec):
+    get_config()
+    get_dispatcher()
+    metrics.serve()
+    loop = asyncio.get_running_loop()
+    reactor = TailReactor()
+    if reactor.active:
+        loop.add_reader(reactor.fileno(), reactor.dispatch)
+
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # Tail watchers by name, for SIGHUP
+    live = {}
+
+    def reload():
+        reload_config()
+        for name, watcher in live.items():
+            watcher.reload_settings()
+            print(f"runtime: {name} settings reloaded", file=sys.stderr)
+
+    loop.add_signal_handler(signal.SIGHUP, reload)
+
+    restarts = {}
+    tasks = [
+        asyncio.create_task(_supervise(name, reactor, restart_sec, restarts, live), name=name)
+        for name in names
+    ]
+    try:
+        await stop.wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if reactor.active:
+            loop.remove_reader(reactor.fileno())
+        reactor.close()
+    return 0
+
+
+def run(names, restart_sec=None):
+    names = [n[:-3] if n.endswith(".py") else n for n in names]
+    unknown = [n for n in names if n not in WATCHERS]
+    if unknown:
+        print(f"runtime: unknown watchers: {', '.join(unknown)}", file=sys.stderr)
+        return 1
+    if restart_sec is None:
+        restart_sec = _env_float("SECURITY_BOT_RESTART_SEC", "2")
+    try:
+        return asyncio.run(_main(names, restart_sec))
+    finally:
+        flush_alerts()
+
+
+if __name__ == "__main__":
+    raise SystemExit(run(sys.argv[1:] or list(WATCHERS)))
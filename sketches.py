@@ -0,0 +1,132 @@
+import math
+from array import array
+
+
+_MASK64 = (1 << 64) - 1
+
+
+def _hash64(key):
+    # Built-in hash is randomised per process, which is fine for sketches
+    # that never leave the process
+    return hash(key) & _MASK64
+
+
+class CountMinSketch:
+    def __init__(self, width=2048, depth=4):
+        self.width = int(width)
+        self.depth = int(depth)
+        self._rows = [array("I", bytes(4 * self.width)) for _ in range(self.depth)]
+        self.total = 0
+
+    def add(self, key, n=1):
+        h = _hash64(key)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        width = self.width
+        est = None
+        for i, row in enumerate(self._rows):
+            j = (h1 + i * h2) % width
+            v = row[j] + n
+            row[j] = v
+            if est is None or v < est:
+                est = v
+        self.total += n
+        return est
+
+    def estimate(self, key):
+        h = _hash64(key)
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        width = self.width
+        return min(row[(h1 + i * h2) % width] for i, row in enumerate(self._rows))
+
+    def clear(self):
+        self._rows = [array("I", bytes(4 * self.width)) for _ in range(self.depth)]
+        self.total = 0
+
+    def memory_bytes(self):
+        return 4 * self.width * self.depth
+
+
+class SpaceSaving:
+    # Metwally et al.: keeps k counters; an unseen key replaces the minimum
+    # and inherits its count, so counts are over-estimates by at most `error`
+    def __init__(self, k=32):
+        self.k = int(k)
+        self._counts = {}
+        self._errors = {}
+
+    def add(self, key, n=1):
+        counts = self._counts
+        c = counts.get(key)
+        if c is not None:
+            counts[key] = c + n
+            return None
+        evicted = None
+        if len(counts) >= self.k:
+            evicted = min(counts, key=counts.get)
+            floor = counts.pop(evicted)
+            self._errors.pop(evicted, None)
+            counts[key] = floor + n
+            self._errors[key] = floor
+        else:
+            counts[key] = n
+        return evicted
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def count(self, key):
+        return self._counts.get(key, 0)
+
+    def top(self, n=None):
+        items = sorted(self._counts.items(), key=lambda kv: kv[1], reverse=True)
+        return items if n is None else items[:n]
+
+    def clear(self):
+        self._counts.clear()
+        self._errors.clear()
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class HyperLogLog:
+    def __init__(self, p=12):
+        self.p = int(p)
+        self.m = 1 << self.p
+        self._regs = bytearray(self.m)
+        if self.m >= 128:
+            self._alpha = 0.7213 / (1 + 1.079 / self.m)
+        else:
+            self._alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(self.m, 0.7213)
+
+    def add(self, key):
+        h = _hash64(key)
+        idx = h & (self.m - 1)
+        w = h >> self.p
+        rank = (64 - self.p) - w.bit_length() + 1
+        if rank > self._regs[idx]:
+            self._regs[idx] = rank
+
+    def count(self):
+        regs = self._regs
+        m = self.m
+        est = self._alpha * m * m / sum(2.0 ** -r for r in regs)
+        if est <= 2.5 * m:
+            zeros = regs.count(0)
+            if zeros:
+                return int(round(m * math.log(m / zeros)))
+        return int(round(est))
+
+    def merge(self, other):
+        regs = self._regs
+        for i, r in enumerate(other._regs):
+            if r > regs[i]:
+                regs[i] = r
+
+    def clear(self):
+        self._regs = bytearray(self.m)
+
+    def memory_bytes(self):
+        return self.m
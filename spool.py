@@ -0,0 +1,146 @@
+import fcntl
+import os
+import sqlite3
+import threading
+import time
+
+
+# next_at of rows the running sender holds in memory; a row left with it
+# belongs to a process that died and is released on the next open
+_HELD = 1e18
+# Delivered rows deleted per statement by compact(); put() can get in
+# between two chunks
+_COMPACT_CHUNK = 128
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alerts (
+    id INTEGER PRIMARY KEY,
+    alert_id TEXT NOT NULL UNIQUE,
+    kind TEXT,
+    body TEXT NOT NULL,
+    created REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_at REAL NOT NULL,
+    sent_at REAL
+);
+CREATE INDEX IF NOT EXISTS alerts_pending ON alerts (sent_at, next_at);
+"""
+
+
+class AlertSpool:
+    # Append-only alert log in SQLite (WAL, synchronous=NORMAL: a commit is
+    # a write to the WAL file without fsync, so it survives a crash of the
+    # process and costs tens of microseconds). One file per process,
+    # enforced with an flock on "<path>.lock": held rows are released on
+    # open, which is only safe when nobody else can be holding them.
+    def __init__(self, path, backoff=5.0, backoff_max=600.0):
+        self.path = path
+        self.backoff = float(backoff)
+        self.backoff_max = float(backoff_max)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._owner = open(f"{path}.lock", "a")
+        try:
+            fcntl.flock(self._owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._owner.close()
+            raise OSError("in use by another process") from None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._db.execute("UPDATE alerts SET next_at = 0 WHERE sent_at IS NULL AND next_at >= ?", (_HELD,))
+
+    def put(self, alert_id, kind, body, now=None):
+        # Row id, or None when the same alert_id is already spooled
+        now = time.time() if now is None else now
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO alerts (alert_id, kind, body, created, next_at) VALUES (?, ?, ?, ?, ?)",
+                (alert_id, kind, body, now, _HELD),
+            )
+            return cur.lastrowid if cur.rowcount else None
+
+    def _update(self, sql, params, ids):
+        if not ids:
+            return
+        marks = ",".join("?" * len(ids))
+        with self._lock:
+            self._db.execute(sql.format(marks=marks), tuple(params) + tuple(ids))
+
+    def ack(self, ids, now=None):
+        now = time.time() if now is None else now
+        self._update("UPDATE alerts SET sent_at = ? WHERE id IN ({marks})", (now,), ids)
+
+    def fail(self, ids, now=None):
+        # Exponential backoff per row: backoff * 2^attempts, capped
+        now = time.time() if now is None else now
+        self._update(
+            "UPDATE alerts SET attempts = attempts + 1, "
+            "next_at = ? + min(?, ? * (1 << min(attempts, 30))) WHERE id IN ({marks})",
+            (now, self.backoff_max, self.backoff),
+            ids,
+        )
+
+    def release(self, ids, now=None):
+        # Hand held rows back undelivered (shed from a full queue), due at
+        # once and without counting an attempt
+        now = time.time() if now is None else now
+        self._update("UPDATE alerts SET next_at = ? WHERE sent_at IS NULL AND id IN ({marks})", (now,), ids)
+
+    def claim(self, limit, now=None):
+        # Due rows, oldest first, marked as held by this process
+        now = time.time() if now is None else now
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = db.execute(
+                    "SELECT id, kind, body FROM alerts WHERE sent_at IS NULL AND next_at <= ? ORDER BY id LIMIT ?",
+                    (now, int(limit)),
+                ).fetchall()
+                if rows:
+                    marks = ",".join("?" * len(rows))
+                    db.execute(f"UPDATE alerts SET next_at = ? WHERE id IN ({marks})", (_HELD,) + tuple(r[0] for r in rows))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return rows
+
+    def next_due(self):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT min(next_at) FROM alerts WHERE sent_at IS NULL AND next_at < ?", (_HELD,)
+            ).fetchone()
+        return row[0]
+
+    def pending(self):
+        with self._lock:
+            return self._db.execute("SELECT count(*) FROM alerts WHERE sent_at IS NULL").fetchone()[0]
+
+    def compact(self, keep, now=None):
+        # Delivered rows are kept `keep` seconds so a re-raised alert is
+        # still recognised as a duplicate
+        now = time.time() if now is None else now
+        deleted = 0
+        while True:
+            with self._lock:
+                n = self._db.execute(
+                    "DELETE FROM alerts WHERE id IN "
+                    "(SELECT id FROM alerts WHERE sent_at IS NOT NULL AND sent_at < ? LIMIT ?)",
+                    (now - keep, _COMPACT_CHUNK),
+                ).rowcount
+            deleted += n
+            if n < _COMPACT_CHUNK:
+                return deleted
+            # Let a waiting put() take the lock
+            time.sleep(0)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        if not self._owner.closed:
+            self._owner.close()
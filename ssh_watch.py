@@ -1,17 +1,40 @@
+import argparse
+import json
 import os
 import re
+import signal
 import time
-from collections import deque, defaultdict
 from datetime import datetime, timedelta, timezone
 
-from telegram_alert import send_message, md_kv, md_icon, md_title_icon, hostname
+import iplists
+import metrics
+import tailer as tailing
+from fleet import KIND_SSH, local_emit, make_forwarder
+from iplists import load_iplists
+from state import Lifecycle, load_state, restore_state
+from tailer import FileTailer, checkpoint_path
+from telegram_alert import AlertTemplate, get_config, send_alert, hostname, prefetch_emojis
+from windows import EventClock, WindowedCounter
 
 
-AUTH_LOG = os.environ.get("AUTH_LOG", "/var/log/auth.log")
-BRUTE_FORCE_WINDOW = int(os.environ.get("SSH_BRUTE_WINDOW_SEC", "60"))
-BRUTE_FORCE_THRESHOLD = int(os.environ.get("SSH_BRUTE_THRESHOLD", "5"))
-ALERT_COOLDOWN = int(os.environ.get("SSH_BRUTE_COOLDOWN_SEC", "300"))
-SLEEP_SEC = float(os.environ.get("SSH_TAIL_SLEEP_SEC", "0.5"))
+def load_settings():
+    # Detection settings, read again on SIGHUP; the log path needs a restart
+    global AUTH_LOG, SLEEP_SEC
+    global BRUTE_FORCE_WINDOW, BRUTE_FORCE_THRESHOLD, ALERT_COOLDOWN, MAX_TRACKED_IPS
+    # The env file may set them too; it is read at most once here, before
+    # the tail and IP list settings, which were read at import without it
+    get_config()
+    tailing.load_settings()
+    iplists.load_settings()
+    AUTH_LOG = os.environ.get("AUTH_LOG", "/var/log/auth.log")
+    SLEEP_SEC = float(os.environ.get("SSH_TAIL_SLEEP_SEC", "0.5"))
+    BRUTE_FORCE_WINDOW = int(os.environ.get("SSH_BRUTE_WINDOW_SEC", "60"))
+    BRUTE_FORCE_THRESHOLD = int(os.environ.get("SSH_BRUTE_THRESHOLD", "5"))
+    ALERT_COOLDOWN = int(os.environ.get("SSH_BRUTE_COOLDOWN_SEC", "300"))
+    MAX_TRACKED_IPS = int(os.environ.get("SSH_MAX_TRACKED_IPS", "100000"))
+
+
+load_settings()
 
 
 FAILED_RE = re.compile(
@@ -19,44 +42,19 @@ FAILED_RE = re.compile(
 )
 INVALID_RE = re.compile(r"(Invalid user (?P<user>\S+) from (?P<ip>\S+))")
 
-
-class FileTailer:
-    def __init__(self, path):
-        self.path = path
-        self.fp = None
-        self.inode = None
-        self.pos = 0
-
-    def _open(self):
-        self.fp = open(self.path, "r", encoding="utf-8", errors="ignore")
-        st = os.fstat(self.fp.fileno())
-        self.inode = st.st_ino
-        self.fp.seek(0, os.SEEK_END)
-        self.pos = self.fp.tell()
-
-    def _reopen_if_rotated(self):
-        try:
-            st = os.stat(self.path)
-        except FileNotFoundError:
-            return
-        if self.inode != st.st_ino or st.st_size < self.pos:
-            try:
-                if self.fp:
-                    self.fp.close()
-            except Exception:
-                pass
-            self._open()
-
-    def lines(self):
-        if self.fp is None:
-            self._open()
-        self._reopen_if_rotated()
-        while True:
-            line = self.fp.readline()
-            if not line:
-                break
-            self.pos = self.fp.tell()
-            yield line
+SSH_ALERT = AlertTemplate(
+    ("SSH_TITLE", "🔐"),
+    "SSH bruteforce urinish aniqlandi",
+    [
+        ("user", "USER", "👤", "Foydalanuvchi"),
+        ("ip", "IP", "🌍", "IP"),
+        ("list", "LIST", "🚫", "Ro'yxat"),
+        ("time", "TIME", "⏰", "Vaqt"),
+        ("server", "SERVER", "🖥️", "Server"),
+    ],
+    kind="ssh_brute",
+    digest_keys=("user", "ip"),
+)
 
 
 def parse_failed(line):
@@ -69,52 +67,196 @@ def parse_failed(line):
     return None, None
 
 
-def now_ts():
+MONTHS = {
+    b"Jan": 1, b"Feb": 2, b"Mar": 3, b"Apr": 4, b"May": 5, b"Jun": 6,
+    b"Jul": 7, b"Aug": 8, b"Sep": 9, b"Oct": 10, b"Nov": 11, b"Dec": 12,
+}
+
+
+class SyslogTime:
+    # "Oct 18 12:00:05 host sshd[1]: ..." (local time, no year) or
+    # "2026-10-18T12:00:05.123456+05:00 host ..." (rsyslog high precision).
+    # `ref` anchors the missing year: the newest time the line can be from.
+    def __init__(self, ref=None):
+        self.ref = ref
+        self._last_key = None
+        self._last_val = None
+
+    def parse(self, raw):
+        if raw[:1].isdigit():
+            sp = raw.find(b" ")
+            try:
+                return datetime.fromisoformat(raw[:sp].decode("ascii")).timestamp()
+            except (ValueError, UnicodeDecodeError):
+                return None
+        key = raw[:12]
+        if key != self._last_key:
+            self._last_val = self._minute(key)
+            self._last_key = key
+        base = self._last_val
+        if base is None:
+            return None
+        try:
+            return base + int(raw[13:15])
+        except ValueError:
+            return None
+
+    def _minute(self, key):
+        try:
+            month = MONTHS[key[0:3]]
+            day = int(key[4:6])
+            hour = int(key[7:9])
+            minute = int(key[10:12])
+        except (KeyError, ValueError):
+            return None
+        ref = self.ref if self.ref is not None else time.time()
+        year = time.localtime(ref).tm_year
+        ts = time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+        if ts > ref + 86400:
+            # December lines read in January
+            ts = time.mktime((year - 1, month, day, hour, minute, 0, 0, 0, -1))
+        return ts
+
+
+def now_ts(ts=None):
     tz = timezone(timedelta(hours=5))
-    return datetime.now(tz).strftime("%Y-%m-%d %H:%M:%S")
+    dt = datetime.now(tz) if ts is None else datetime.fromtimestamp(ts, tz)
+    return dt.strftime("%Y-%m-%d %H:%M:%S")
 
 
-def main():
-    tailer = FileTailer(AUTH_LOG)
-    attempts = defaultdict(lambda: deque())
-    last_alert = {}
+class SSHWatcher:
+    def __init__(self, emit=send_alert, live=True):
+        self.emit = local_emit(emit, live)
+        # Events also go to the fleet aggregator when FLEET_FORWARD is set
+        self.forwarder = make_forwarder() if live else None
+        self.times = SyslogTime()
+        self.clock = EventClock(live=live)
+        # IP_ALLOWLIST ranges are dropped here, IP_DENYLIST ones tagged
+        self.iplists = load_iplists()
+        self.lines_read = 0
+        self.events = 0
+        self.excluded = 0
+        self.alerts = 0
+        # Idle keys are kept for the cooldown too, so eviction cannot re-arm an alert
+        self.attempts = WindowedCounter(
+            BRUTE_FORCE_WINDOW,
+            max_keys=MAX_TRACKED_IPS,
+            idle_ttl=max(BRUTE_FORCE_WINDOW, ALERT_COOLDOWN),
+        )
 
-    while True:
-        for line in tailer.lines():
-            if "Failed password" not in line and "Invalid user" not in line:
+    def tracked_keys(self):
+        return len(self.attempts)
+
+    def reload_settings(self):
+        load_settings()
+        # Counts and cooldowns stay; only the window geometry is converted
+        self.attempts.resize(
+            BRUTE_FORCE_WINDOW,
+            max_keys=MAX_TRACKED_IPS,
+            idle_ttl=max(BRUTE_FORCE_WINDOW, ALERT_COOLDOWN),
+        )
+
+    def snapshot(self):
+        sections = self.attempts.dump("attempts")
+        sections["clock"] = json.dumps({"watermark": self.clock.watermark}).encode()
+        return sections
+
+    def restore(self, sections):
+        self.attempts.load(sections, "attempts")
+        if "clock" in sections:
+            self.clock.watermark = json.loads(sections["clock"])["watermark"]
+
+    def memory_bytes(self):
+        return self.attempts.memory_bytes()
+
+    def feed(self, lines, source=None):
+        attempts = self.attempts
+        forwarder = self.forwarder
+        lists = self.iplists
+        if lists is not None:
+            lists.refresh()
+        self.lines_read += len(lines)
+        for raw in lines:
+            if b"Failed password" not in raw and b"Invalid user" not in raw:
                 continue
-            user, ip = parse_failed(line)
+            user, ip = parse_failed(raw.decode("utf-8", "ignore"))
             if not ip:
                 continue
-            ts = time.time()
-            dq = attempts[ip]
-            dq.append(ts)
-            while dq and (ts - dq[0]) > BRUTE_FORCE_WINDOW:
-                dq.popleft()
-
-            if len(dq) >= BRUTE_FORCE_THRESHOLD:
-                last = last_alert.get(ip, 0)
-                if (ts - last) >= ALERT_COOLDOWN:
-                    last_alert[ip] = ts
-                    msg = "\n".join(
-                        [
-                            md_title_icon(
-                                md_icon("SSH_TITLE", "🔐"),
-                                "SSH bruteforce urinish aniqlandi",
-                            ),
-                            md_kv(md_icon("USER", "👤"), "Foydalanuvchi", user or "unknown"),
-                            md_kv(md_icon("IP", "🌍"), "IP", ip),
-                            md_kv(md_icon("TIME", "⏰"), "Vaqt", now_ts()),
-                            md_kv(md_icon("SERVER", "🖥️"), "Server", hostname()),
-                        ]
+            self.events += 1
+            if lists is not None and lists.allowed(ip):
+                self.excluded += 1
+                continue
+            ts = self.clock.observe(self.times.parse(raw))
+            if ts is None:
+                continue
+            if forwarder is not None:
+                forwarder.add(KIND_SSH, ip, user or "unknown", ts)
+            if attempts.add(ip, ts) >= BRUTE_FORCE_THRESHOLD:
+                slot = attempts.get(ip)
+                if (ts - slot.alert) >= ALERT_COOLDOWN:
+                    slot.alert = ts
+                    self.alerts += 1
+                    self.emit(
+                        SSH_ALERT.message(
+                            user=user or "unknown",
+                            ip=ip,
+                            list=lists.label(ip) if lists is not None else "-",
+                            time=now_ts(ts),
+                            server=hostname(),
+                        )
                     )
-                    send_message(msg)
-        time.sleep(SLEEP_SEC)
+        if forwarder is not None:
+            forwarder.flush()
+
+
+def make_tailer(reactor=None):
+    return FileTailer(
+        AUTH_LOG,
+        max_sleep=SLEEP_SEC,
+        checkpoint=checkpoint_path(AUTH_LOG),
+        reactor=reactor,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="SSH bruteforce kuzatuvchisi")
+    parser.add_argument("--replay", nargs="+", metavar="FILE", help="eski loglarni (.gz ham) tahlil qilib, ogohlantirishlarni chop etish")
+    parser.add_argument("--quiet", action="store_true", help="--replay: faqat yakuniy hisobot")
+    args = parser.parse_args(argv)
+    if args.replay:
+        from replay import replay
+
+        return replay(SSHWatcher, args.replay, quiet=args.quiet)
+
+    # Before the tailer: the snapshot may move its checkpoint
+    sections = load_state("ssh_watch")
+    tailer = make_tailer()
+    watcher = SSHWatcher()
+    restore_state("ssh_watch", watcher, sections)
+    lifecycle = Lifecycle("ssh_watch", watcher, tailer).install()
+    metrics.register_watcher("ssh_watch", watcher, tailer)
+    metrics.serve()
+    prefetch_emojis()
+    try:
+        while True:
+            for source, block in tailer.tagged_blocks():
+                lifecycle.step()
+                watcher.feed(block, source)
+            lifecycle.idle()
+            tailer.wait()
+    finally:
+        lifecycle.save()
+        tailer.close()
+
+
+def _handle_term(_sig, _frame):
+    raise SystemExit(0)
 
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _handle_term)
     try:
-        main()
+        raise SystemExit(main())
     except Exception as e:
         # last-resort log to stderr
         print(f"ssh_watch error: {e}")
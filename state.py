@@ -0,0 +1,201 @@
+import json
+import os
+import signal
+import struct
+import sys
+import time
+
+import heartbeat
+import tailer as tailing
+from tailer import restore_checkpoints
+from telegram_alert import reload_config
+
+
+# Detector snapshots (windows, cooldowns, tail offsets) written on exit and
+# read on startup, so a restart does not forget attacks in progress
+SNAPSHOTS = os.environ.get("STATE_SNAPSHOTS", "1").strip().lower() not in {"0", "false", "no", "off"}
+# Also written this often while running (0: only on exit), so a crash
+# loses at most this much
+SNAPSHOT_INTERVAL_SEC = float(os.environ.get("STATE_SNAPSHOT_INTERVAL_SEC", "300"))
+
+MAGIC = b"SBSNAP1\n"
+# name length, data length; then the name and the data
+_SECTION = struct.Struct("<HQ")
+
+
+def snapshot_path(name):
+    if not SNAPSHOTS:
+        return None
+    return os.path.join(tailing.STATE_DIR, f"snapshot-{name}.bin")
+
+
+def write_snapshot(path, sections):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        for name, data in sections.items():
+            raw = name.encode("utf-8")
+            f.write(_SECTION.pack(len(raw), len(data)))
+            f.write(raw)
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def read_snapshot(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("not a snapshot")
+    sections = {}
+    pos = len(MAGIC)
+    while pos < len(data):
+        if pos + _SECTION.size > len(data):
+            raise ValueError("truncated snapshot")
+        name_len, data_len = _SECTION.unpack_from(data, pos)
+        pos += _SECTION.size
+        end = pos + name_len + data_len
+        if end > len(data):
+            raise ValueError("truncated snapshot")
+        name = data[pos : pos + name_len].decode("utf-8")
+        sections[name] = data[pos + name_len : end]
+        pos = end
+    return sections
+
+
+def save_state(name, watcher, tailer=None):
+    path = snapshot_path(name)
+    if path is None or not hasattr(watcher, "snapshot"):
+        return False
+    started = time.monotonic()
+    try:
+        sections = watcher.snapshot()
+        if tailer is not None:
+            # Offsets of exactly the lines the windows have seen
+            tailer.save_checkpoint()
+            sections["tail"] = json.dumps(tailer.checkpoint_records()).encode()
+        write_snapshot(path, sections)
+    except OSError as e:
+        print(f"{name}: cannot write snapshot {path}: {e}", file=sys.stderr)
+        return False
+    print(f"{name}: snapshot saved in {time.monotonic() - started:.2f}s", file=sys.stderr)
+    return True
+
+
+def load_state(name):
+    # Sections of the last snapshot, with its tail offsets put back in
+    # place; call before the tailer is created
+    path = snapshot_path(name)
+    if path is None:
+        return None
+    try:
+        sections = read_snapshot(path)
+        if "tail" in sections:
+            restore_checkpoints(json.loads(sections["tail"]))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"{name}: ignoring snapshot {path}: {e}", file=sys.stderr)
+        return None
+    return sections
+
+
+def restore_state(name, watcher, sections):
+    if not sections or not hasattr(watcher, "restore"):
+        return False
+    started = time.monotonic()
+    try:
+        watcher.restore(sections)
+    except KeyError as e:
+        # Taken by the other watcher layout (single or parallel)
+        print(f"{name}: ignoring snapshot: no {e.args[0]} section", file=sys.stderr)
+        return False
+    except ValueError as e:
+        print(f"{name}: ignoring snapshot: {e}", file=sys.stderr)
+        return False
+    print(f"{name}: snapshot restored in {time.monotonic() - started:.2f}s", file=sys.stderr)
+    return True
+
+
+class Lifecycle:
+    # SIGHUP (re-read settings) and SIGTERM (stop) for a watcher's main
+    # loop. While a block is being fed both are only noted and acted on
+    # before the next one, so windows, cooldowns and tail offsets in a
+    # snapshot always agree.
+    def __init__(self, name, watcher, tailer=None, interval=SNAPSHOT_INTERVAL_SEC):
+        self.name = name
+        self.watcher = watcher
+        self.tailer = tailer
+        self.interval = interval
+        self.busy = False
+        self._reload = False
+        self._stop = False
+        self._next_save = time.monotonic() + interval if interval > 0 else None
+        # Progress reports to main.py, when started by it
+        self.heartbeat = heartbeat.from_env()
+
+    def install(self):
+        signal.signal(signal.SIGHUP, self._on_hup)
+        signal.signal(signal.SIGTERM, self._on_term)
+        return self
+
+    def _on_hup(self, _sig, _frame):
+        if self.busy:
+            self._reload = True
+        else:
+            self.reload()
+
+    def _on_term(self, _sig, _frame):
+        if self.busy:
+            self._stop = True
+        else:
+            raise SystemExit(0)
+
+    def _act(self):
+        if self._stop:
+            self.busy = False
+            raise SystemExit(0)
+        if self._reload:
+            self._reload = False
+            self.reload()
+
+    def _beat(self):
+        beat = self.heartbeat
+        if beat is None or not beat.due():
+            return
+        tailer = self.tailer
+        if tailer is None:
+            beat.beat(self.watcher.lines_read)
+        else:
+            beat.beat(self.watcher.lines_read, tailer.pos, tailer.lag())
+
+    def step(self):
+        # Before feeding a block: the previous one is fully consumed
+        self._act()
+        self._beat()
+        self.busy = True
+
+    def idle(self):
+        # After the last block, before waiting for more
+        self._act()
+        self._beat()
+        if self._next_save is not None and time.monotonic() >= self._next_save:
+            # Busy, so a SIGHUP cannot resize the windows mid-dump
+            self.busy = True
+            save_state(self.name, self.watcher, self.tailer)
+            self._next_save = time.monotonic() + self.interval
+            self._act()
+        self.busy = False
+
+    def reload(self):
+        reload_config()
+        self.watcher.reload_settings()
+        print(f"{self.name}: settings reloaded", file=sys.stderr)
+
+    def save(self):
+        # Only from between blocks: an exception in the middle of one
+        # leaves windows that the tail offsets do not match
+        if not self.busy:
+            save_state(self.name, self.watcher, self.tailer)
@@ -0,0 +1,723 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import select
+import struct
+import time
+
+
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+FILE_MASK = IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF
+DIR_MASK = IN_CREATE | IN_MOVED_TO
+
+_EVENT = struct.Struct("iIII")
+
+
+
+def load_settings():
+    # Read again from the watchers' load_settings(), after the env file;
+    # tailers and reactors already running keep what they started with
+    global USE_INOTIFY, IDLE_TIMEOUT_SEC, POLL_MIN_SEC, BLOCK_SIZE, MAX_LINE
+    global STATE_DIR, USE_CHECKPOINTS, CHECKPOINT_INTERVAL_SEC, RESCAN_SEC
+    USE_INOTIFY = os.environ.get("TAIL_USE_INOTIFY", "1").strip().lower() not in {"0", "false", "no", "off"}
+    # Safety wakeup even with inotify (e.g. NFS mounts where events never arrive)
+    IDLE_TIMEOUT_SEC = float(os.environ.get("TAIL_IDLE_TIMEOUT_SEC", "5"))
+    POLL_MIN_SEC = float(os.environ.get("TAIL_POLL_MIN_SEC", "0.05"))
+    BLOCK_SIZE = int(os.environ.get("TAIL_BLOCK_SIZE", str(1024 * 1024)))
+    # A "line" without a newline longer than this is flushed as-is
+    MAX_LINE = int(os.environ.get("TAIL_MAX_LINE", str(1024 * 1024)))
+
+    STATE_DIR = os.environ.get("SECURITY_BOT_STATE_DIR", "/var/lib/security-bot")
+    USE_CHECKPOINTS = os.environ.get("TAIL_CHECKPOINTS", "1").strip().lower() not in {"0", "false", "no", "off"}
+    CHECKPOINT_INTERVAL_SEC = float(os.environ.get("TAIL_CHECKPOINT_INTERVAL_SEC", "5"))
+    # MultiTailer: how often the patterns are globbed again without an inotify hint
+    RESCAN_SEC = float(os.environ.get("TAIL_RESCAN_SEC", "10"))
+
+
+load_settings()
+
+# Bytes from the start of the file used to recognise it after restarts
+HEAD_BYTES = 1024
+# Rotated copies (access.log.1, access.log.2.gz, access.log-20261018) are
+# followed through their live file, never on their own
+_ROTATED_RE = re.compile(r"(\.\d+|\.gz|\.bz2|\.xz|\.zst|-\d{8}(\d{2})?)$")
+
+
+class Inotify:
+    def __init__(self):
+        name = ctypes.util.find_library("c") or "libc.so.6"
+        self._libc = ctypes.CDLL(name, use_errno=True)
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.fd = fd
+        self._poll = select.poll()
+        self._poll.register(fd, select.POLLIN)
+        self._paths = {}
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self._paths[wd] = path
+        return wd
+
+    def rm_watch(self, wd):
+        self._paths.pop(wd, None)
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            i = 0
+            while i + _EVENT.size <= len(buf):
+                wd, mask, _cookie, length = _EVENT.unpack_from(buf, i)
+                i += _EVENT.size
+                name = buf[i : i + length].rstrip(b"\0")
+                i += length
+                if mask & IN_IGNORED:
+                    self._paths.pop(wd, None)
+                events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def poll(self, timeout):
+        ms = None if timeout is None else int(timeout * 1000)
+        try:
+            return bool(self._poll.poll(ms))
+        except InterruptedError:
+            return False
+
+    def wait(self, timeout):
+        if not self.poll(timeout):
+            return []
+        return self.read_events()
+
+    def close(self):
+        if self.fd is not None:
+            try:
+                os.close(self.fd)
+            except OSError:
+                pass
+            self.fd = None
+
+
+class TailReactor:
+    # One inotify instance shared by any number of tailers. Events are
+    # routed to the tailers that own the watch; a callback per tailer lets
+    # an event loop wake the right task.
+    def __init__(self, use_inotify=None):
+        if use_inotify is None:
+            use_inotify = USE_INOTIFY
+        self.notify = None
+        self._owners = {}
+        self._callbacks = {}
+        if use_inotify:
+            try:
+                self.notify = Inotify()
+            except (OSError, AttributeError):
+                # No inotify (non-Linux, exhausted instances): tailers poll instead
+                self.notify = None
+
+    @property
+    def active(self):
+        return self.notify is not None
+
+    def fileno(self):
+        return self.notify.fileno() if self.notify is not None else -1
+
+    def watch(self, tailer, path, mask):
+        if self.notify is None:
+            return None
+        try:
+            wd = self.notify.add_watch(path, mask)
+        except OSError:
+            return None
+        owners = self._owners.setdefault(wd, [])
+        if tailer not in owners:
+            owners.append(tailer)
+        return wd
+
+    def unwatch(self, tailer, wd):
+        owners = self._owners.get(wd)
+        if not owners:
+            return
+        if tailer in owners:
+            owners.remove(tailer)
+        if not owners:
+            del self._owners[wd]
+            self.notify.rm_watch(wd)
+
+    def set_callback(self, tailer, callback):
+        if callback is None:
+            self._callbacks.pop(tailer, None)
+        else:
+            self._callbacks[tailer] = callback
+
+    def dispatch(self):
+        if self.notify is None:
+            return set()
+        ready = set()
+        for wd, mask, name in self.notify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: let every tailer re-check its file
+                for owners in self._owners.values():
+                    ready.update(owners)
+                continue
+            for tailer in self._owners.get(wd, ()):
+                if tailer.wants(wd, name):
+                    ready.add(tailer)
+            if mask & IN_IGNORED:
+                self._owners.pop(wd, None)
+        for tailer in ready:
+            self.fire(tailer)
+        return ready
+
+    def fire(self, tailer):
+        callback = self._callbacks.get(tailer)
+        if callback is not None:
+            callback()
+
+    def wait(self, timeout):
+        if self.notify is None:
+            time.sleep(timeout)
+            return set()
+        if not self.notify.poll(timeout):
+            return set()
+        return self.dispatch()
+
+    def close(self):
+        if self.notify is not None:
+            self.notify.close()
+            self.notify = None
+        self._owners.clear()
+        self._callbacks.clear()
+
+
+def live_name(name):
+    # access.log.2.gz -> access.log
+    while True:
+        stripped = _ROTATED_RE.sub("", name)
+        if stripped == name:
+            return name
+        name = stripped
+
+
+def checkpoint_path(log_path):
+    if not USE_CHECKPOINTS:
+        return None
+    name = os.path.abspath(log_path).strip("/").replace("/", "_")
+    return os.path.join(STATE_DIR, f"tail-{name}.json")
+
+
+def _record(path, state):
+    return {
+        "path": path,
+        "dev": state[0],
+        "ino": state[1],
+        "offset": state[2],
+        "head_len": state[3],
+        "head": state[4],
+    }
+
+
+def _write_checkpoint(checkpoint, record):
+    os.makedirs(os.path.dirname(checkpoint), exist_ok=True)
+    tmp = f"{checkpoint}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(record, f)
+    os.replace(tmp, checkpoint)
+
+
+def restore_checkpoints(records):
+    # Offsets from a detector snapshot. They win over the checkpoint file
+    # only when it is missing or behind them on the same file, so the
+    # windows never count a line twice.
+    for rec in records:
+        checkpoint = checkpoint_path(rec["path"])
+        if checkpoint is None:
+            continue
+        try:
+            with open(checkpoint, "r", encoding="utf-8") as f:
+                cur = json.load(f)
+            if (int(cur["dev"]), int(cur["ino"])) != (rec["dev"], rec["ino"]) or int(cur["offset"]) >= rec["offset"]:
+                continue
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError):
+            # Corrupt checkpoint: the snapshot's offset is the better guess
+            pass
+        try:
+            _write_checkpoint(checkpoint, rec)
+        except OSError as e:
+            print(f"tailer: cannot write checkpoint {checkpoint}: {e}", file=sys.stderr)
+
+
+def _head_digest(fd, length):
+    data = os.pread(fd, length, 0) if length else b""
+    return hashlib.sha1(data).hexdigest()
+
+
+class FileTailer:
+    def __init__(
+        self,
+        path,
+        max_sleep=0.5,
+        min_sleep=None,
+        block_size=None,
+        checkpoint=None,
+        reactor=None,
+        from_start=False,
+    ):
+        self.path = path
+        self._base = os.path.basename(path)
+        self.checkpoint = checkpoint
+        self.fd = None
+        self.inode = None
+        # pos: offset just past the last complete line handed out
+        self.pos = 0
+        min_sleep = POLL_MIN_SEC if min_sleep is None else min_sleep
+        self.block_size = BLOCK_SIZE if block_size is None else block_size
+        self.max_sleep = max(float(max_sleep), min_sleep)
+        self.min_sleep = min_sleep
+        self._partial = b""
+        self._head = None
+        self._saved = None
+        self._saved_at = 0.0
+        self._warned = False
+        # True while a backlog from before startup is being read
+        self.catching_up = False
+        self._sleep = min_sleep
+        self._got_data = False
+        # from_start: a file that appeared while we run is read from byte 0
+        self._started = from_start
+        self._own_reactor = reactor is None
+        self.reactor = reactor if reactor is not None else TailReactor()
+        self._file_wd = None
+        self._dir_wd = self.reactor.watch(self, os.path.dirname(os.path.abspath(path)) or "/", DIR_MASK)
+
+    @property
+    def event_driven(self):
+        # Without a directory watch a missing or new file would go unnoticed
+        return self._dir_wd is not None
+
+    def wants(self, wd, name):
+        return wd == self._file_wd or (wd == self._dir_wd and name == self._base)
+
+    def _watch_file(self):
+        if self._file_wd is not None:
+            self.reactor.unwatch(self, self._file_wd)
+            self._file_wd = None
+        self._file_wd = self.reactor.watch(self, self.path, FILE_MASK)
+
+    def _open(self, from_start=False):
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+        st = os.fstat(self.fd)
+        self.inode = st.st_ino
+        self.pos = 0 if from_start else os.lseek(self.fd, 0, os.SEEK_END)
+        self._partial = b""
+        self._head = None
+        self._watch_file()
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint, "r", encoding="utf-8") as f:
+                cp = json.load(f)
+            return (
+                int(cp["dev"]),
+                int(cp["ino"]),
+                int(cp["offset"]),
+                int(cp["head_len"]),
+                str(cp["head"]),
+            )
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Corrupt checkpoint: behave as on a first start
+            return None
+
+    def _resume(self):
+        cp = self._load_checkpoint()
+        if cp is None:
+            return False
+        dev, ino, offset, head_len, head = cp
+        # The checkpointed file may have been rotated away while we were down
+        rotated = [p for p in sorted(glob.glob(glob.escape(self.path) + ".*")) if not p.endswith(".gz")]
+        for cand in [self.path] + rotated:
+            try:
+                fd = os.open(cand, os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                continue
+            st = os.fstat(fd)
+            same_file = (st.st_dev, st.st_ino) == (dev, ino) or (cand == self.path and head_len > 0)
+            if same_file and st.st_size >= offset and _head_digest(fd, head_len) == head:
+                self.fd = fd
+                self.inode = st.st_ino
+                self.pos = os.lseek(fd, offset, os.SEEK_SET)
+                self._partial = b""
+                self._head = (head_len, head)
+                self.catching_up = cand != self.path or st.st_size > offset
+                self._watch_file()
+                return True
+            os.close(fd)
+        # Unknown file: everything in it was written after the checkpoint
+        self._open(from_start=True)
+        self.catching_up = True
+        return True
+
+    def _state(self):
+        st = os.fstat(self.fd)
+        if self._head is None or (self._head[0] < HEAD_BYTES and self.pos > self._head[0]):
+            head_len = min(self.pos, HEAD_BYTES)
+            self._head = (head_len, _head_digest(self.fd, head_len))
+        return (st.st_dev, st.st_ino, self.pos, self._head[0], self._head[1])
+
+    def checkpoint_records(self):
+        # What save_checkpoint() writes, for detector snapshots (state.py)
+        if self.fd is None:
+            return []
+        try:
+            return [_record(self.path, self._state())]
+        except OSError:
+            return []
+
+    def save_checkpoint(self):
+        if not self.checkpoint or self.fd is None:
+            return
+        try:
+            state = self._state()
+            if state == self._saved:
+                return
+            _write_checkpoint(self.checkpoint, _record(self.path, state))
+            self._saved = state
+        except OSError as e:
+            if not self._warned:
+                self._warned = True
+                print(f"tailer: cannot write checkpoint {self.checkpoint}: {e}", file=sys.stderr)
+        self._saved_at = time.monotonic()
+
+    def _close(self):
+        try:
+            if self.fd is not None:
+                os.close(self.fd)
+        except OSError:
+            pass
+        self.fd = None
+
+    def _reopen_if_rotated(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if self.inode != st.st_ino or st.st_size < self.pos + len(self._partial):
+            return True
+        return False
+
+    def _read_blocks(self, final=False):
+        while True:
+            chunk = os.read(self.fd, self.block_size)
+            if not chunk:
+                break
+            if self._partial:
+                chunk = self._partial + chunk
+            lines = chunk.split(b"\n")
+            partial = lines.pop()
+            if len(partial) > MAX_LINE:
+                lines.append(partial)
+                partial = b""
+            self._partial = partial
+            self._got_data = True
+            end = self.pos + len(chunk) - len(partial)
+            if lines:
+                yield lines
+            # Advance only once the consumer is done with the block, so a
+            # checkpoint taken mid-block replays it instead of skipping it
+            self.pos = end
+        if final and self._partial:
+            # The file is going away: its unterminated last line is complete
+            lines = [self._partial]
+            self._partial = b""
+            yield lines
+            self.pos += len(lines[0])
+
+    # Yields lists of raw lines (bytes, without the trailing newline)
+    def blocks(self):
+        self._got_data = False
+        if self.fd is None:
+            try:
+                if self._started:
+                    # A file that shows up later is new: read it from the start
+                    self._open(from_start=True)
+                elif not (self.checkpoint and self._resume()):
+                    # First start without a checkpoint skips history
+                    self._open(from_start=False)
+            except FileNotFoundError:
+                self._started = True
+                return
+            self._started = True
+        if self._reopen_if_rotated():
+            # Drain what was written to the old file before rotation,
+            # then follow the new file from its first byte.
+            yield from self._read_blocks(final=True)
+            self._close()
+            try:
+                self._open(from_start=True)
+            except FileNotFoundError:
+                return
+        yield from self._read_blocks()
+        self.catching_up = False
+        if self.checkpoint and time.monotonic() - self._saved_at >= CHECKPOINT_INTERVAL_SEC:
+            self.save_checkpoint()
+
+    def tagged_blocks(self):
+        for block in self.blocks():
+            yield self.path, block
+
+    def lines(self):
+        for block in self.blocks():
+            yield from block
+
+    def lag(self):
+        # Bytes already in the file that have not been read yet. An
+        # unterminated last line has been read into _partial and waits for
+        # its newline; it is not backlog.
+        fd = self.fd
+        if fd is None:
+            return 0
+        try:
+            return max(0, os.fstat(fd).st_size - self.pos - len(self._partial))
+        except OSError:
+            return 0
+
+    def poll_delay(self):
+        # Adaptive backoff polling: fast right after activity, slower when idle
+        if self._got_data:
+            self._sleep = self.min_sleep
+        else:
+            self._sleep = min(self._sleep * 2, self.max_sleep)
+        return self._sleep
+
+    def wait(self, timeout=None):
+        if self.event_driven:
+            self.reactor.wait(IDLE_TIMEOUT_SEC if timeout is None else timeout)
+            return
+        delay = self.poll_delay()
+        time.sleep(delay if timeout is None else min(delay, timeout))
+
+    def close(self):
+        self.save_checkpoint()
+        self._close()
+        for wd in (self._file_wd, self._dir_wd):
+            if wd is not None and self.reactor.notify is not None:
+                self.reactor.unwatch(self, wd)
+        self._file_wd = self._dir_wd = None
+        self.reactor.set_callback(self, None)
+        if self._own_reactor:
+            self.reactor.close()
+
+
+def expand_sources(spec, dir_pattern="*.log"):
+    # "a.log,/var/log/nginx/*.access.log,/var/log/vhosts/" -> glob patterns;
+    # a directory means every file in it matching dir_pattern
+    out = []
+    for part in str(spec).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if os.path.isdir(part):
+            part = os.path.join(part, dir_pattern)
+        out.append(os.path.abspath(part))
+    return out
+
+
+class MultiTailer:
+    # Follows every file matching a set of glob patterns through one
+    # reactor. Each file keeps its own FileTailer (offset, rotation,
+    # checkpoint); only files inotify reported as changed are read, plus a
+    # sweep of all of them every IDLE_TIMEOUT_SEC, so idle files cost nothing.
+    def __init__(
+        self,
+        patterns,
+        max_sleep=0.5,
+        min_sleep=None,
+        block_size=None,
+        checkpoints=True,
+        reactor=None,
+    ):
+        self.patterns = [os.path.abspath(p) for p in patterns]
+        min_sleep = POLL_MIN_SEC if min_sleep is None else min_sleep
+        self.max_sleep = max(float(max_sleep), min_sleep)
+        self.min_sleep = min_sleep
+        self.block_size = BLOCK_SIZE if block_size is None else block_size
+        self.checkpoints = checkpoints
+        # Replaced, never changed in place: the metrics thread sums pos and
+        # lag over it while _rescan runs on the tailer's thread
+        self.tailers = {}
+        self._dirty = set()
+        self._gone = []
+        self._sleep = min_sleep
+        self._got_data = False
+        self._started = False
+        self._rescan_due = True
+        self._next_rescan = 0.0
+        self._next_sweep = 0.0
+        self._own_reactor = reactor is None
+        self.reactor = reactor if reactor is not None else TailReactor()
+        self._dir_wds = {}
+        self._all_dirs_watched = True
+        for pat in self.patterns:
+            d = os.path.dirname(pat)
+            wd = None if glob.has_magic(d) else self.reactor.watch(self, d, DIR_MASK)
+            if wd is None:
+                # Wildcard or missing directory: only the periodic rescan sees new files
+                self._all_dirs_watched = False
+                continue
+            self._dir_wds.setdefault(wd, []).append(os.path.basename(pat))
+
+    @property
+    def event_driven(self):
+        return self.reactor.active and self._all_dirs_watched
+
+    @property
+    def catching_up(self):
+        return any(t.catching_up for t in self.tailers.values())
+
+    @property
+    def pos(self):
+        return sum(t.pos for t in self.tailers.values())
+
+    def wants(self, wd, name):
+        pats = self._dir_wds.get(wd)
+        if not pats or _ROTATED_RE.search(name):
+            return False
+        if any(fnmatch.fnmatch(name, p) for p in pats):
+            # A matching file was created or moved in: glob again
+            self._rescan_due = True
+            return True
+        return False
+
+    def _child_ready(self, tailer):
+        self._dirty.add(tailer)
+        self.reactor.fire(self)
+
+    def _match(self):
+        found = set()
+        for pat in self.patterns:
+            for path in glob.glob(pat):
+                if not _ROTATED_RE.search(path) and os.path.isfile(path):
+                    found.add(path)
+        return found
+
+    def _rescan(self):
+        found = self._match()
+        tailers = dict(self.tailers)
+        for path in sorted(found - tailers.keys()):
+            tailer = FileTailer(
+                path,
+                max_sleep=self.max_sleep,
+                min_sleep=self.min_sleep,
+                block_size=self.block_size,
+                checkpoint=checkpoint_path(path) if self.checkpoints else None,
+                reactor=self.reactor,
+                from_start=self._started,
+            )
+            self.reactor.set_callback(tailer, lambda t=tailer: self._child_ready(t))
+            tailers[path] = tailer
+            self._dirty.add(tailer)
+        for path in list(tailers.keys() - found):
+            if not os.path.exists(path):
+                # Removed vhost: drain what is left, then let go of it
+                self._gone.append(tailers.pop(path))
+        self.tailers = tailers
+        self._rescan_due = False
+        self._next_rescan = time.monotonic() + RESCAN_SEC
+
+    # Yields (path, lines) so the consumer knows which file a block is from
+    def tagged_blocks(self):
+        now = time.monotonic()
+        if self._rescan_due or now >= self._next_rescan:
+            self._rescan()
+        self._started = True
+        if not self.event_driven or now >= self._next_sweep:
+            ready = list(self.tailers.values())
+            self._next_sweep = now + IDLE_TIMEOUT_SEC
+            self._dirty = set()
+        else:
+            ready = list(self._dirty)
+            self._dirty = set()
+        got = False
+        for tailer in ready + self._gone:
+            for block in tailer.blocks():
+                got = True
+                yield tailer.path, block
+        for tailer in self._gone:
+            tailer.close()
+        self._gone = []
+        self._got_data = got
+
+    def blocks(self):
+        for _path, block in self.tagged_blocks():
+            yield block
+
+    def lag(self):
+        return sum(t.lag() for t in self.tailers.values())
+
+    def save_checkpoint(self):
+        for tailer in self.tailers.values():
+            tailer.save_checkpoint()
+
+    def checkpoint_records(self):
+        return [rec for tailer in self.tailers.values() for rec in tailer.checkpoint_records()]
+
+    def poll_delay(self):
+        if self._got_data:
+            self._sleep = self.min_sleep
+        else:
+            self._sleep = min(self._sleep * 2, self.max_sleep)
+        return self._sleep
+
+    def wait(self, timeout=None):
+        if self.event_driven:
+            self.reactor.wait(IDLE_TIMEOUT_SEC if timeout is None else timeout)
+            return
+        delay = self.poll_delay()
+        time.sleep(delay if timeout is None else min(delay, timeout))
+
+    def close(self):
+        for tailer in list(self.tailers.values()) + self._gone:
+            tailer.close()
+        self.tailers = {}
+        self._gone = []
+        if self.reactor.notify is not None:
+            for wd in list(self._dir_wds):
+                self.reactor.unwatch(self, wd)
+        self._dir_wds.clear()
+        self.reactor.set_callback(self, None)
+        if self._own_reactor:
+            self.reactor.close()
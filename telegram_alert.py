@@ -1,20 +1,107 @@
+import atexit
+import fcntl
+import hashlib
+import itertools
+import json
 import os
 import re
 import socket
+import sqlite3
+import sys
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
+import metrics
+from spool import AlertSpool
+
 
 BOT_TOKEN_ENV = "TELEGRAM_BOT_TOKEN"
 CHAT_ID_ENV = "TELEGRAM_CHAT_ID"
+# Bot API base URL; pointed at a local stub by the benchmarks
+API_URL_ENV = "TELEGRAM_API_URL"
+DEFAULT_API_URL = "https://api.telegram.org"
 ENV_FILE_NAME = ".env"
+STATE_DIR_ENV = "SECURITY_BOT_STATE_DIR"
+DEFAULT_STATE_DIR = "/var/lib/security-bot"
 
 _CUSTOM_EMOJI_TOKEN_RE = re.compile(r"\[\[CE:(\d+)\|([^\]]*)\]\]")
 _CUSTOM_EMOJI_BASE_CACHE = {}
+_EMOJI_CACHE_VERSION = 0
+_EMOJI_ENV_PREFIX = "TG_EMOJI_"
+_EMOJI_ENV_SUFFIX = "_ID"
+# Custom emoji lookups shared by every process (watchers, fail2ban_alert.py)
+EMOJI_CACHE_ENV = "TELEGRAM_EMOJI_CACHE"
+EMOJI_TTL_ENV = "TELEGRAM_EMOJI_TTL_SEC"
+# Failed or unknown ids are not asked again before this
+EMOJI_RETRY_ENV = "TELEGRAM_EMOJI_RETRY_SEC"
+# getCustomEmojiStickers takes at most 200 ids per call
+EMOJI_BATCH = 200
+
+QUEUE_SIZE_ENV = "TELEGRAM_QUEUE_SIZE"
+QUEUE_OVERFLOW_ENV = "TELEGRAM_QUEUE_OVERFLOW"
+FLUSH_TIMEOUT_ENV = "TELEGRAM_FLUSH_TIMEOUT_SEC"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_COALESCE = "coalesce"
+MAX_MESSAGE_LEN = 4096
+
+DIGEST_WINDOW_ENV = "TELEGRAM_DIGEST_WINDOW_SEC"
+DIGEST_TOP = 5
+# Distinct values counted per digest field; the rest only add to the total
+DIGEST_MAX_VALUES = 10000
+DIGEST_FIELD = ("merged", "DIGEST", "📦", "Birlashtirildi")
+
+# Alerts are committed here before they are sent; a path, or "off"
+SPOOL_ENV = "TELEGRAM_SPOOL"
+SPOOL_BACKOFF_ENV = "TELEGRAM_SPOOL_BACKOFF_SEC"
+SPOOL_BACKOFF_MAX_ENV = "TELEGRAM_SPOOL_BACKOFF_MAX_SEC"
+# The same alert raised again within this window is sent once
+SPOOL_DEDUP_ENV = "TELEGRAM_SPOOL_DEDUP_SEC"
+# Spooled alerts re-sent per pass after a failure or a restart
+SPOOL_BATCH = 50
+SPOOL_COMPACT_SEC = 60.0
+# A 429 asking for a longer wait is not slept through: the dispatcher
+# holds sends and puts spooled alerts back until then
+RETRY_AFTER_MAX_ENV = "TELEGRAM_RETRY_AFTER_MAX_SEC"
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return float(default)
+
+try:
+    FANOUT_WORKERS = int(os.environ.get("TELEGRAM_FANOUT_WORKERS", "8"))
+except ValueError:
+    FANOUT_WORKERS = 8
+
+SEND_SECONDS = metrics.histogram(
+    "security_bot_telegram_request_seconds", "Bot API sendMessage round-trip time"
+)
+_RESPONSES = metrics.counter(
+    "security_bot_telegram_responses_total", "Bot API responses by status", ("code",), locked=True
+)
+_RESPONSE_OK = _RESPONSES.labels("200")
+_RESPONSE_429 = _RESPONSES.labels("429")
+_RESPONSE_ERROR = _RESPONSES.labels("error")
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+_FANOUT_POOL = None
+
+_CONFIG = None
+_CONFIG_LOCK = threading.Lock()
+_CONFIG_VERSIONS = itertools.count(1)
+# Keys that came from the .env file (not the real environment) and may be
+# overwritten by reload_config()
+_ENV_FILE_KEYS = set()
 
 
-def _load_env_file(path):
+def _load_env_file(path, override=False):
     try:
         with open(path, "r", encoding="utf-8") as f:
             for line in f:
@@ -24,8 +111,11 @@ def _load_env_file(path):
                 key, val = line.split("=", 1)
                 key = key.strip()
                 val = val.strip().strip('"').strip("'")
-                if key and key not in os.environ:
+                if not key:
+                    continue
+                if key not in os.environ or (override and key in _ENV_FILE_KEYS):
                     os.environ[key] = val
+                    _ENV_FILE_KEYS.add(key)
     except FileNotFoundError:
         return
     except Exception:
@@ -33,13 +123,55 @@ def _load_env_file(path):
         return
 
 
-def _load_env():
+def _load_env(override=False):
     env_path = os.environ.get("SECURITY_BOT_ENV")
     if env_path:
-        _load_env_file(env_path)
+        _load_env_file(env_path, override=override)
         return
     here = os.path.dirname(os.path.abspath(__file__))
-    _load_env_file(os.path.join(here, ENV_FILE_NAME))
+    _load_env_file(os.path.join(here, ENV_FILE_NAME), override=override)
+
+
+class Config:
+    def __init__(self, environ):
+        self.version = next(_CONFIG_VERSIONS)
+        self.token = environ.get(BOT_TOKEN_ENV)
+        self.chat_ids = _get_chat_ids(environ.get(CHAT_ID_ENV))
+        self.api_url = (environ.get(API_URL_ENV) or DEFAULT_API_URL).rstrip("/")
+        self.emoji_ids = {}
+        for key, val in environ.items():
+            if key.startswith(_EMOJI_ENV_PREFIX) and key.endswith(_EMOJI_ENV_SUFFIX):
+                name = key[len(_EMOJI_ENV_PREFIX) : -len(_EMOJI_ENV_SUFFIX)]
+                if name and str(val).strip():
+                    self.emoji_ids[name] = str(val).strip()
+
+    def emoji_id(self, name):
+        return self.emoji_ids.get(str(name).strip().upper())
+
+
+def get_config():
+    # The .env file is read once per process; use reload_config() to re-read it
+    global _CONFIG
+    if _CONFIG is None:
+        with _CONFIG_LOCK:
+            if _CONFIG is None:
+                _load_env()
+                _CONFIG = Config(os.environ)
+    return _CONFIG
+
+
+def reload_config():
+    global _CONFIG
+    with _CONFIG_LOCK:
+        _load_env(override=True)
+        _CONFIG = Config(os.environ)
+    if _EMOJI_CACHE is not None:
+        prefetch_emojis()
+    return _CONFIG
+
+
+def _state_path(name):
+    return os.path.join(os.environ.get(STATE_DIR_ENV) or DEFAULT_STATE_DIR, name)
 
 
 def _utf16_len(text):
@@ -49,19 +181,21 @@ def _utf16_len(text):
 
 
 def _fetch_custom_emoji_bases(token, emoji_ids, timeout=10):
+    # None when the call itself failed, so the caller can tell it from
+    # "Telegram does not know these ids"
     if not emoji_ids:
         return {}
-    url = f"https://api.telegram.org/bot{token}/getCustomEmojiStickers"
+    url = f"{get_config().api_url}/bot{token}/getCustomEmojiStickers"
     try:
-        resp = requests.post(url, json={"custom_emoji_ids": emoji_ids}, timeout=timeout)
+        resp = _get_session().post(url, json={"custom_emoji_ids": emoji_ids}, timeout=timeout)
         if resp.status_code != 200:
-            return {}
+            return None
         data = resp.json()
     except Exception:
-        return {}
+        return None
 
     if not data.get("ok"):
-        return {}
+        return None
 
     out = {}
     for item in data.get("result", []):
@@ -72,21 +206,192 @@ def _fetch_custom_emoji_bases(token, emoji_ids, timeout=10):
     return out
 
 
+class EmojiCache:
+    # custom_emoji_id -> base emoji in a JSON file ({"id": [emoji or null,
+    # expires_at]}) shared by every bot process. Lookups only read
+    # _CUSTOM_EMOJI_BASE_CACHE; ids that are unknown or expired go to a
+    # background thread, which fetches all of them in one batched call
+    # under an flock, so processes starting together fetch once.
+    def __init__(self, path, ttl=86400.0, retry=600.0):
+        self.path = path
+        self.ttl = float(ttl)
+        self.retry = float(retry)
+        self.entries = {}
+        self.fetches = 0
+        self._wanted = set()
+        self._mtime = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._warned = False
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        out = {}
+        for emoji_id, entry in data.items() if isinstance(data, dict) else ():
+            if isinstance(entry, list) and len(entry) == 2:
+                out[str(emoji_id)] = (entry[0] or None, float(entry[1]))
+        return out
+
+    def _merge(self, entries):
+        global _EMOJI_CACHE_VERSION
+        changed = False
+        with self._lock:
+            for emoji_id, (base, expires) in entries.items():
+                old = self.entries.get(emoji_id)
+                if old is not None and old[1] >= expires:
+                    continue
+                self.entries[emoji_id] = (base, expires)
+                if base and _CUSTOM_EMOJI_BASE_CACHE.get(emoji_id) != base:
+                    _CUSTOM_EMOJI_BASE_CACHE[emoji_id] = base
+                    changed = True
+            if changed:
+                _EMOJI_CACHE_VERSION += 1
+
+    def load(self, force=False):
+        # Picks up what other processes fetched; one stat a second at most
+        now = time.monotonic()
+        if not force and now - self._checked < 1.0:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self._mtime = mtime
+            self._merge(self._read())
+
+    def _save(self, now):
+        # Long-expired entries are dropped; a stale emoji is still better
+        # than the fallback while Telegram is unreachable
+        with self._lock:
+            data = {k: [b, e] for k, (b, e) in self.entries.items() if e > now - self.ttl}
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if not self._warned:
+                self._warned = True
+                print(f"telegram_alert: cannot write emoji cache {self.path}: {e}", file=sys.stderr)
+
+    def due(self, emoji_ids, now):
+        entries = self.entries
+        return sorted({e for e in emoji_ids if e not in entries or entries[e][1] <= now})
+
+    def want(self, emoji_ids):
+        # Never blocks on the network
+        emoji_ids = [str(e) for e in emoji_ids if e]
+        if not emoji_ids:
+            return
+        self.load()
+        with self._cond:
+            self._wanted.update(emoji_ids)
+            if self.due(emoji_ids, time.time()):
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="emoji-cache", daemon=True)
+                    self._thread.start()
+                self._cond.notify()
+
+    def _open_lock(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            f = open(f"{self.path}.lock", "a")
+        except OSError:
+            return None
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def refresh(self, timeout=10):
+        with self._cond:
+            wanted = list(self._wanted)
+        lock = self._open_lock()
+        try:
+            # Another process may have fetched while we waited for the lock
+            self.load(force=True)
+            now = time.time()
+            due = self.due(wanted, now)
+            if not due:
+                return 0
+            token = get_config().token
+            fresh = {}
+            for i in range(0, len(due), EMOJI_BATCH):
+                batch = due[i : i + EMOJI_BATCH]
+                got = _fetch_custom_emoji_bases(token, batch, timeout=timeout) if token else None
+                self.fetches += 1
+                for emoji_id in batch:
+                    if got is None:
+                        # Keep what we had and ask again after `retry`
+                        old = self.entries.get(emoji_id)
+                        fresh[emoji_id] = (old[0] if old else None, now + self.retry)
+                    elif emoji_id in got:
+                        fresh[emoji_id] = (got[emoji_id], now + self.ttl)
+                    else:
+                        fresh[emoji_id] = (None, now + self.retry)
+            self._merge(fresh)
+            self._save(now)
+            return len(due)
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def _next_due(self):
+        now = time.time()
+        expires = [self.entries[e][1] if e in self.entries else now for e in self._wanted]
+        return max(1.0, min(expires) - now) if expires else None
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"telegram_alert: emoji refresh failed: {e}", file=sys.stderr)
+            with self._cond:
+                self._cond.wait(self._next_due())
+
+
+_EMOJI_CACHE = None
+_EMOJI_CACHE_LOCK = threading.Lock()
+
+
+def get_emoji_cache():
+    global _EMOJI_CACHE
+    if _EMOJI_CACHE is None:
+        with _EMOJI_CACHE_LOCK:
+            if _EMOJI_CACHE is None:
+                get_config()
+                path = os.environ.get(EMOJI_CACHE_ENV) or _state_path("emoji-cache.json")
+                _EMOJI_CACHE = EmojiCache(
+                    path,
+                    ttl=_env_float(EMOJI_TTL_ENV, "86400"),
+                    retry=_env_float(EMOJI_RETRY_ENV, "600"),
+                )
+    return _EMOJI_CACHE
+
+
+def prefetch_emojis():
+    # Every configured TG_EMOJI_*_ID, in the background, so the first alert
+    # already has them
+    get_emoji_cache().want(get_config().emoji_ids.values())
+
+
 def _render_custom_emojis(message, token, timeout=10):
     text = "" if message is None else str(message)
     matches = list(_CUSTOM_EMOJI_TOKEN_RE.finditer(text))
     if not matches:
         return text, None
 
-    missing = []
-    for m in matches:
-        emoji_id = m.group(1)
-        if emoji_id not in _CUSTOM_EMOJI_BASE_CACHE:
-            missing.append(emoji_id)
-
-    if missing:
-        fresh = _fetch_custom_emoji_bases(token, sorted(set(missing)), timeout=timeout)
-        _CUSTOM_EMOJI_BASE_CACHE.update(fresh)
+    if token:
+        get_emoji_cache().want([m.group(1) for m in matches])
 
     out_parts = []
     entities = []
@@ -129,6 +434,244 @@ def _render_custom_emojis(message, token, timeout=10):
     return rendered, entities
 
 
+def _emoji_segment(emoji_id, fallback):
+    # (text, entity offset/length or None) for one icon, from the cache only
+    base_emoji = _CUSTOM_EMOJI_BASE_CACHE.get(emoji_id) if emoji_id else None
+    if base_emoji:
+        return base_emoji, (emoji_id, _utf16_len(base_emoji))
+    return fallback, None
+
+
+# kind -> template, to rebuild spooled alerts; the first one of a kind wins
+# (a digest template shares the kind of its base)
+_TEMPLATES = {}
+
+
+class AlertTemplate:
+    # title_icon: (icon name, fallback); fields: [(key, icon name, fallback, label)]
+    # digest_keys: fields summarised as "top values" when alerts of this
+    # kind are merged into one digest message during an attack storm
+    def __init__(self, title_icon, title, fields, kind=None, digest_keys=()):
+        self.title_icon = title_icon
+        self.title = title
+        self.fields = list(fields)
+        self.keys = tuple(f[0] for f in self.fields)
+        self.kind = kind or title
+        self.digest_keys = tuple(digest_keys)
+        self._digest_template = None
+        self._compiled = None
+        self._compiled_for = None
+        _TEMPLATES.setdefault(self.kind, self)
+
+    def digest_template(self):
+        if self._digest_template is None:
+            self._digest_template = AlertTemplate(
+                self.title_icon,
+                self.title,
+                [DIGEST_FIELD] + self.fields,
+                kind=self.kind,
+            )
+        return self._digest_template
+
+    def emoji_ids(self):
+        cfg = get_config()
+        names = [self.title_icon[0]] + [f[1] for f in self.fields]
+        return [cfg.emoji_id(n) for n in names if cfg.emoji_id(n)]
+
+    def _compile(self):
+        # Static text between the variable fields, with the custom emoji
+        # entities of each static segment relative to the segment start
+        cfg = get_config()
+        statics = []
+        text_parts = []
+        entities = []
+        offset = 0
+
+        def add_icon(name, fallback):
+            nonlocal offset
+            text, ent = _emoji_segment(cfg.emoji_id(name), fallback)
+            if ent:
+                entities.append((offset, ent[1], ent[0]))
+            text_parts.append(text)
+            offset += _utf16_len(text)
+            return bool(text)
+
+        def add_text(text):
+            nonlocal offset
+            text_parts.append(text)
+            offset += _utf16_len(text)
+
+        def close_segment():
+            nonlocal text_parts, entities, offset
+            statics.append(("".join(text_parts), offset, tuple(entities)))
+            text_parts, entities, offset = [], [], 0
+
+        if add_icon(*self.title_icon):
+            add_text(" ")
+        add_text("" if self.title is None else str(self.title))
+        for _key, icon_name, fallback, label in self.fields:
+            add_text("\n")
+            if add_icon(icon_name, fallback):
+                add_text(" ")
+            add_text(f"{label}: ")
+            close_segment()
+        close_segment()
+        return statics
+
+    def render(self, values):
+        key = (get_config().version, _EMOJI_CACHE_VERSION)
+        if self._compiled_for != key:
+            self._compiled = self._compile()
+            self._compiled_for = key
+        statics = self._compiled
+        parts = []
+        entities = []
+        offset = 0
+        for i, (text, length, ents) in enumerate(statics):
+            parts.append(text)
+            for rel, ent_len, emoji_id in ents:
+                entities.append(
+                    {
+                        "offset": offset + rel,
+                        "length": ent_len,
+                        "type": "custom_emoji",
+                        "custom_emoji_id": emoji_id,
+                    }
+                )
+            offset += length
+            if i < len(self.keys):
+                val = values.get(self.keys[i])
+                val = "" if val is None else str(val)
+                parts.append(val)
+                offset += len(val) if val.isascii() else _utf16_len(val)
+        return "".join(parts), (entities or None)
+
+    def message(self, **values):
+        return Message(self, values)
+
+
+class _Digest:
+    __slots__ = ("template", "until", "count", "counters", "last", "spool_ids")
+
+    def __init__(self, template, until):
+        self.template = template
+        self.until = until
+        self.count = 0
+        self.counters = {k: {} for k in template.digest_keys}
+        self.last = None
+        self.spool_ids = []
+
+    def add(self, message):
+        self.count += 1
+        self.last = message
+        self.spool_ids.extend(message.spool_ids)
+        for key, counter in self.counters.items():
+            val = message.values.get(key)
+            if val is None:
+                continue
+            if val in counter:
+                counter[val] += 1
+            elif len(counter) < DIGEST_MAX_VALUES:
+                counter[val] = 1
+
+    def build(self):
+        if self.count == 1:
+            return self.last
+        values = dict(self.last.values)
+        for key, counter in self.counters.items():
+            top = sorted(counter.items(), key=lambda kv: kv[1], reverse=True)
+            shown = ", ".join(f"{val} ({n})" for val, n in top[:DIGEST_TOP])
+            if len(top) > DIGEST_TOP:
+                shown += f" +{len(top) - DIGEST_TOP}"
+            values[key] = shown
+        values["merged"] = f"{self.count} ta ogohlantirish"
+        message = self.template.digest_template().message(**values)
+        message.spool_ids = tuple(self.spool_ids)
+        return message
+
+    def reset(self, until):
+        self.until = until
+        self.count = 0
+        self.counters = {k: {} for k in self.template.digest_keys}
+        self.last = None
+        self.spool_ids = []
+
+
+class Message:
+    # An alert waiting to be rendered; rendering happens on the sender side
+    __slots__ = ("template", "values", "spool_ids")
+
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+        self.spool_ids = ()
+
+    def emoji_ids(self):
+        return self.template.emoji_ids()
+
+    def render(self):
+        return self.template.render(self.values)
+
+    def __str__(self):
+        return self.render()[0]
+
+    def __len__(self):
+        return len(str(self))
+
+
+class MessageBatch:
+    # Several alerts joined into one Telegram message
+    __slots__ = ("parts",)
+
+    def __init__(self, parts):
+        self.parts = list(parts)
+
+    @property
+    def spool_ids(self):
+        return tuple(i for p in self.parts for i in getattr(p, "spool_ids", ()))
+
+    def emoji_ids(self):
+        out = []
+        for p in self.parts:
+            if hasattr(p, "emoji_ids"):
+                out.extend(p.emoji_ids())
+        return out
+
+    def render(self, token=None, timeout=10):
+        texts = []
+        entities = []
+        offset = 0
+        sep = "\n\n"
+        for i, part in enumerate(self.parts):
+            if i:
+                texts.append(sep)
+                offset += len(sep)
+            text, ents = _render_message(part, token, timeout)
+            texts.append(text)
+            for ent in ents or ():
+                shifted = dict(ent)
+                shifted["offset"] += offset
+                entities.append(shifted)
+            offset += _utf16_len(text)
+        return "".join(texts), (entities or None)
+
+    def __str__(self):
+        return "\n\n".join(str(p) for p in self.parts)
+
+    def __len__(self):
+        return sum(len(p) for p in self.parts) + 2 * max(len(self.parts) - 1, 0)
+
+
+def _render_message(message, token, timeout=10):
+    if isinstance(message, MessageBatch):
+        return message.render(token, timeout)
+    if isinstance(message, Message):
+        if token:
+            get_emoji_cache().want(message.emoji_ids())
+        return message.render()
+    return _render_custom_emojis(message, token, timeout=timeout)
+
+
 def hostname():
     try:
         return socket.gethostname()
@@ -144,40 +687,173 @@ def _get_chat_ids(raw):
     return [p for p in parts if p]
 
 
+def _get_session():
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=2, pool_maxsize=max(FANOUT_WORKERS, 1)
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _SESSION = session
+    return _SESSION
+
+
+def _get_fanout_pool():
+    global _FANOUT_POOL
+    if _FANOUT_POOL is None:
+        with _SESSION_LOCK:
+            if _FANOUT_POOL is None:
+                _FANOUT_POOL = ThreadPoolExecutor(
+                    max_workers=max(FANOUT_WORKERS, 1), thread_name_prefix="telegram-fanout"
+                )
+    return _FANOUT_POOL
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Blocks the calling sender thread until a token is available
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                wait = (1.0 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+_CHAT_BUCKETS = {}
+_GLOBAL_BUCKET = None
+
+
+def _acquire_send_slot(chat_id):
+    global _GLOBAL_BUCKET
+    with _SESSION_LOCK:
+        if _GLOBAL_BUCKET is None:
+            _GLOBAL_BUCKET = TokenBucket(
+                _env_float("TELEGRAM_GLOBAL_RATE", "30"), _env_float("TELEGRAM_GLOBAL_BURST", "30")
+            )
+        bucket = _CHAT_BUCKETS.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(
+                _env_float("TELEGRAM_CHAT_RATE", "1"), _env_float("TELEGRAM_CHAT_BURST", "3")
+            )
+            _CHAT_BUCKETS[chat_id] = bucket
+    bucket.acquire()
+    _GLOBAL_BUCKET.acquire()
+
+
+class RateLimited(RuntimeError):
+    def __init__(self, retry_after, message):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after(resp):
+    try:
+        val = resp.json().get("parameters", {}).get("retry_after")
+        if val is not None:
+            return float(val)
+    except Exception:
+        pass
+    try:
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _post_with_retry(url, payload, retries, timeout):
+    # At least one attempt, so a failure always has a real error to raise
+    retries = max(1, int(retries))
+    last_err = None
+    backoff = 1.0
+    for attempt in range(retries):
+        delay = backoff
+        _acquire_send_slot(payload["chat_id"])
+        started = time.monotonic()
+        try:
+            resp = _get_session().post(url, json=payload, timeout=timeout)
+            SEND_SECONDS.observe(time.monotonic() - started)
+            if resp.status_code == 200:
+                _RESPONSE_OK.inc()
+                return True
+            if resp.status_code == 429:
+                _RESPONSE_429.inc()
+            else:
+                _RESPONSES.labels(f"{resp.status_code // 100}xx").inc()
+            last_err = RuntimeError(f"Telegram API error: {resp.status_code} {resp.text}")
+            if resp.status_code == 429:
+                delay = _retry_after(resp) or backoff
+                if delay > _env_float(RETRY_AFTER_MAX_ENV, "5"):
+                    raise RateLimited(delay, f"Telegram API rate limit: retry after {delay:.0f}s")
+            elif resp.status_code < 500:
+                # Bad request / forbidden / unknown chat: retrying will not help
+                break
+        except requests.RequestException as e:
+            _RESPONSE_ERROR.inc()
+            last_err = e
+        if attempt + 1 < retries:
+            time.sleep(delay)
+            backoff *= 2
+    raise last_err
+
+
 def send_message(message, retries=3, timeout=10):
-    _load_env()
-    token = os.environ.get(BOT_TOKEN_ENV)
-    chat_id_raw = os.environ.get(CHAT_ID_ENV)
-    chat_ids = _get_chat_ids(chat_id_raw)
+    cfg = get_config()
+    token = cfg.token
+    chat_ids = cfg.chat_ids
     if not token or not chat_ids:
         raise RuntimeError("TELEGRAM_BOT_TOKEN or TELEGRAM_CHAT_ID is not set")
 
-    rendered_message, entities = _render_custom_emojis(message, token, timeout=timeout)
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
-    last_err = None
-    for _ in range(retries):
+    rendered_message, entities = _render_message(message, token, timeout=timeout)
+    url = f"{cfg.api_url}/bot{token}/sendMessage"
+    payloads = []
+    for chat_id in chat_ids:
+        payload = {
+            "chat_id": chat_id,
+            "text": rendered_message,
+            "disable_web_page_preview": True,
+        }
+        if entities:
+            payload["entities"] = entities
+        payloads.append(payload)
+
+    if len(payloads) == 1:
+        return _post_with_retry(url, payloads[0], retries, timeout)
+
+    # Fan out to every chat at once; each chat retries on its own so one
+    # failing chat neither delays nor duplicates delivery to the others
+    pool = _get_fanout_pool()
+    futures = [pool.submit(_post_with_retry, url, p, retries, timeout) for p in payloads]
+    first_err = None
+    for fut in futures:
         try:
-            ok = True
-            for chat_id in chat_ids:
-                payload = {
-                    "chat_id": chat_id,
-                    "text": rendered_message,
-                    "disable_web_page_preview": True,
-                }
-                if entities:
-                    payload["entities"] = entities
-                resp = requests.post(url, json=payload, timeout=timeout)
-                if resp.status_code != 200:
-                    ok = False
-                    last_err = RuntimeError(f"Telegram API error: {resp.status_code} {resp.text}")
-            if ok:
-                return True
+            fut.result()
+        except RateLimited as e:
+            # The longest wait asked for wins, so no chat is retried early
+            if not isinstance(first_err, RateLimited) or e.retry_after > first_err.retry_after:
+                first_err = e
         except Exception as e:
-            last_err = e
-        time.sleep(1)
-    if last_err:
-        raise last_err
-    return False
+            if first_err is None:
+                first_err = e
+    if first_err is not None:
+        raise first_err
+    return True
 
 
 def md_kv(icon, label, value):
@@ -204,9 +880,7 @@ def md_custom_emoji(emoji_id, fallback=""):
 
 
 def md_icon(name, fallback=""):
-    _load_env()
-    env_name = f"TG_EMOJI_{str(name).strip().upper()}_ID"
-    return md_custom_emoji(os.environ.get(env_name), fallback=fallback)
+    return md_custom_emoji(get_config().emoji_id(name), fallback=fallback)
 
 
 def md_title_icon(icon, text):
@@ -214,3 +888,368 @@ def md_title_icon(icon, text):
     if icon:
         return f"{icon} {clean_text}"
     return clean_text
+
+
+class AlertDispatcher:
+    # With a spool every alert is committed to disk in submit(); it is
+    # acked once sent, and a failed send leaves it for _redrive(), which
+    # also picks up what a previous run did not deliver
+    def __init__(self, send=None, maxsize=1000, overflow=OVERFLOW_DROP_OLDEST, digest_window=0, spool=None, dedup_window=60.0):
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE):
+            raise ValueError(f"unknown overflow policy: {overflow}")
+        self._send = send or send_message
+        self.maxsize = max(1, int(maxsize))
+        self.overflow = overflow
+        self.digest_window = float(digest_window)
+        self.spool = spool
+        self.dedup_window = float(dedup_window)
+        self._compacted_at = 0.0
+        self._digests = {}
+        self._queue = deque()
+        # Spooled alerts shed from a full queue, to be released by the sender
+        self._shed = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._busy = False
+        self._closed = False
+        # Monotonic time a rate limit lifts; sender thread only
+        self._hold_until = 0.0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.merged = 0
+        self.duplicates = 0
+        self.redriven = 0
+        if spool is not None and spool.pending():
+            self._ensure_worker()
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="telegram-sender", daemon=True)
+            self._thread.start()
+
+    def submit(self, message):
+        if message is None:
+            message = ""
+        if self.spool is not None and isinstance(message, Message) and not self._spool_put(message):
+            self.duplicates += 1
+            return True
+        with self._cond:
+            if self._closed:
+                return False
+            if self.digest_window > 0 and isinstance(message, Message) and message.template.digest_keys:
+                if self._absorb(message):
+                    return True
+            self._enqueue(message)
+            self._ensure_worker()
+            self._cond.notify()
+        return True
+
+    def _spool_put(self, message):
+        # False when the same alert is already spooled (raised again after
+        # a restart re-read the lines, for example)
+        body = json.dumps(message.values, ensure_ascii=False, sort_keys=True, default=str)
+        kind = message.template.kind
+        alert_id = hashlib.sha1(f"{kind}\0{body}".encode("utf-8")).hexdigest()
+        try:
+            sid = self.spool.put(alert_id, kind, body)
+        except sqlite3.Error as e:
+            print(f"telegram_alert: spool write failed: {e}", file=sys.stderr)
+            return True
+        if sid is None:
+            return False
+        message.spool_ids = (sid,)
+        return True
+
+    def _settle(self, message, ok, retry_after=None):
+        ids = getattr(message, "spool_ids", ())
+        if self.spool is None or not ids:
+            return
+        try:
+            if ok:
+                self.spool.ack(ids)
+            elif retry_after is not None:
+                self.spool.release(ids, time.time() + retry_after)
+            else:
+                self.spool.fail(ids)
+        except sqlite3.Error as e:
+            print(f"telegram_alert: spool update failed: {e}", file=sys.stderr)
+
+    def _release(self, messages, at=None):
+        ids = [i for m in messages for i in getattr(m, "spool_ids", ())]
+        try:
+            self.spool.release(ids, at)
+        except sqlite3.Error as e:
+            print(f"telegram_alert: spool update failed: {e}", file=sys.stderr)
+
+    def _redrive(self):
+        # Due spooled alerts joined into as few messages as fit, and the
+        # seconds until the next row is due (None: none waiting). Runs
+        # without the lock.
+        now = time.time()
+        batches = []
+        try:
+            if now - self._compacted_at >= SPOOL_COMPACT_SEC:
+                self._compacted_at = now
+                self.spool.compact(self.dedup_window, now)
+            rows = self.spool.claim(SPOOL_BATCH, now)
+            due = None if rows else self.spool.next_due()
+        except sqlite3.Error as e:
+            print(f"telegram_alert: spool read failed: {e}", file=sys.stderr)
+            return batches, SPOOL_COMPACT_SEC
+        batch = None
+        for sid, kind, body in rows:
+            template = _TEMPLATES.get(kind)
+            if template is None:
+                # Not a template this process knows; back off and keep it
+                self._settle(_Spooled(sid), False)
+                continue
+            message = template.message(**json.loads(body))
+            message.spool_ids = (sid,)
+            self.redriven += 1
+            if batch is not None and len(batch) + len(message) + 2 <= MAX_MESSAGE_LEN:
+                batch.parts.append(message)
+            else:
+                batch = MessageBatch([message])
+                batches.append(batch)
+        if rows:
+            return batches, 0.0
+        return batches, None if due is None else max(0.0, due - now)
+
+    def _absorb(self, message):
+        # The first alert of a kind goes out at once and opens a window;
+        # alerts of the same kind inside the window are merged into a digest
+        kind = message.template.kind
+        digest = self._digests.get(kind)
+        if digest is None:
+            self._digests[kind] = _Digest(message.template, time.monotonic() + self.digest_window)
+            return False
+        digest.add(message)
+        self.merged += 1
+        return True
+
+    def _release_digests(self, force=False):
+        now = time.monotonic()
+        next_due = None
+        for kind, digest in list(self._digests.items()):
+            if force or digest.until <= now:
+                if digest.count == 0:
+                    del self._digests[kind]
+                    continue
+                self._enqueue(digest.build())
+                if force:
+                    del self._digests[kind]
+                    continue
+                # Storm still going: keep merging for another window
+                digest.reset(now + self.digest_window)
+            if next_due is None or digest.until < next_due:
+                next_due = digest.until
+        return None if next_due is None else max(0.0, next_due - now)
+
+    def _enqueue(self, message):
+        if len(self._queue) >= self.maxsize:
+            last = self._queue[-1]
+            if self.overflow == OVERFLOW_COALESCE and len(last) + len(message) + 2 <= MAX_MESSAGE_LEN:
+                if isinstance(last, MessageBatch):
+                    last.parts.append(message)
+                else:
+                    self._queue[-1] = MessageBatch([last, message])
+                self.coalesced += 1
+                return
+            # Shed from memory only: a spooled alert stays pending on disk
+            # and is redriven once sends succeed again
+            shed = self._queue.popleft()
+            if self.spool is not None and getattr(shed, "spool_ids", ()):
+                self._shed.append(shed)
+            self.dropped += 1
+        self._queue.append(message)
+
+    def qsize(self):
+        return len(self._queue)
+
+    def _run(self):
+        # Spool reads and writes happen with the lock released, so submit()
+        # from a detection loop never waits on SQLite
+        next_redrive = 0.0
+        while True:
+            message = None
+            redrive = False
+            back = []
+            with self._cond:
+                while True:
+                    wait = self._release_digests(force=self._closed)
+                    shed, self._shed = self._shed, []
+                    held = 0.0 if self._closed else self._hold_until - time.monotonic()
+                    if held > 0 and self._queue and self.spool is not None:
+                        # Rate limited: spooled alerts go back to the spool
+                        # until the limit lifts, the rest wait here
+                        back = [m for m in self._queue if getattr(m, "spool_ids", ())]
+                        if back:
+                            self._queue = deque(m for m in self._queue if not getattr(m, "spool_ids", ()))
+                    if shed or back or (self._queue and held <= 0) or (self._closed and not self._digests):
+                        break
+                    # next_redrive None: nothing in the spool is due
+                    if self.spool is not None and not self._closed and next_redrive is not None:
+                        left = next_redrive - time.monotonic()
+                        if left <= 0:
+                            redrive = True
+                            break
+                        wait = left if wait is None else min(wait, left)
+                    if held > 0:
+                        wait = held if wait is None else min(wait, held)
+                    self._cond.wait(wait)
+                if self._queue and held <= 0:
+                    message = self._queue.popleft()
+                elif not shed and not back and not redrive:
+                    return
+                self._busy = True
+            try:
+                if shed:
+                    self._release(shed)
+                    next_redrive = 0.0
+                if back:
+                    self._release(back, time.time() + held)
+                    next_redrive = 0.0
+                if redrive:
+                    batches, left = self._redrive()
+                    next_redrive = None if left is None else time.monotonic() + left
+                    if batches:
+                        with self._cond:
+                            self._queue.extend(batches)
+                if message is not None:
+                    self._deliver(message)
+                    # A failed send is due again later, a success may
+                    # mean the spool backlog can go now
+                    next_redrive = 0.0
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _deliver(self, message):
+        ok = False
+        retry_after = None
+        try:
+            self._send(message)
+            self.sent += 1
+            ok = True
+        except RateLimited as e:
+            self.failed += 1
+            retry_after = e.retry_after
+            self._hold_until = time.monotonic() + retry_after
+            print(f"telegram_alert: send failed: {e}", file=sys.stderr)
+        except Exception as e:
+            self.failed += 1
+            print(f"telegram_alert: send failed: {e}", file=sys.stderr)
+        finally:
+            self._settle(message, ok, retry_after)
+
+    def flush(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._queue or self._busy:
+                if self._thread is None:
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        # Pending digests are sent before the worker exits
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is None:
+            return True
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+
+class _Spooled:
+    __slots__ = ("spool_ids",)
+
+    def __init__(self, sid):
+        self.spool_ids = (sid,)
+
+
+_DISPATCHER = None
+_DISPATCHER_LOCK = threading.Lock()
+
+
+def _open_spool():
+    raw = os.environ.get(SPOOL_ENV, "").strip()
+    if raw.lower() in ("0", "off", "false", "no"):
+        return None
+    if not raw:
+        # One file per program: a spool is drained by the process whose
+        # templates can rebuild its alerts
+        name = os.path.splitext(os.path.basename(sys.argv[0] or ""))[0].lstrip("-") or "security-bot"
+        raw = _state_path(f"spool-{name}.db")
+    try:
+        return AlertSpool(
+            raw,
+            backoff=_env_float(SPOOL_BACKOFF_ENV, "5"),
+            backoff_max=_env_float(SPOOL_BACKOFF_MAX_ENV, "600"),
+        )
+    except (OSError, sqlite3.Error) as e:
+        print(f"telegram_alert: alert spool disabled ({raw}: {e})", file=sys.stderr)
+        return None
+
+
+def get_dispatcher():
+    global _DISPATCHER
+    if _DISPATCHER is None:
+        with _DISPATCHER_LOCK:
+            if _DISPATCHER is None:
+                get_config()
+                try:
+                    maxsize = int(os.environ.get(QUEUE_SIZE_ENV, "1000"))
+                except ValueError:
+                    maxsize = 1000
+                overflow = os.environ.get(QUEUE_OVERFLOW_ENV, OVERFLOW_DROP_OLDEST).strip().lower()
+                if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_COALESCE):
+                    overflow = OVERFLOW_DROP_OLDEST
+                dispatcher = AlertDispatcher(
+                    maxsize=maxsize,
+                    overflow=overflow,
+                    digest_window=_env_float(DIGEST_WINDOW_ENV, "10"),
+                    spool=_open_spool(),
+                    dedup_window=_env_float(SPOOL_DEDUP_ENV, "60"),
+                )
+                _register_dispatcher_metrics(dispatcher)
+                _DISPATCHER = dispatcher
+                prefetch_emojis()
+    return _DISPATCHER
+
+
+def _register_dispatcher_metrics(dispatcher):
+    metrics.gauge("security_bot_alert_queue_depth", "Alerts waiting for the sender").set_function(dispatcher.qsize)
+    outcomes = metrics.counter("security_bot_alerts_total", "Alerts handled by the dispatcher", ("result",))
+    for result in ("sent", "failed", "dropped", "coalesced", "merged", "duplicates", "redriven"):
+        outcomes.labels(result).set_function(lambda result=result: getattr(dispatcher, result))
+    if dispatcher.spool is not None:
+        metrics.gauge("security_bot_alert_spool_pending", "Spooled alerts not delivered yet").set_function(
+            dispatcher.spool.pending
+        )
+
+
+def send_alert(message):
+    # Non-blocking: queue the alert for the background sender
+    return get_dispatcher().submit(message)
+
+
+def flush_alerts(timeout=None):
+    if _DISPATCHER is None:
+        return True
+    if timeout is None:
+        try:
+            timeout = float(os.environ.get(FLUSH_TIMEOUT_ENV, "5"))
+        except ValueError:
+            timeout = 5.0
+    return _DISPATCHER.close(timeout)
+
+
+atexit.register(flush_alerts)
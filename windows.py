@@ -0,0 +1,434 @@
+import json
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from itertools import compress
+
+
+# One bucket per second by default, but never more than this many per key
+MAX_BUCKETS = int(os.environ.get("WINDOW_MAX_BUCKETS", "60"))
+# How often (in adds) idle keys are swept out
+EVICT_EVERY = 1024
+# How far behind the newest event a line may be and still be counted
+MAX_LATENESS_SEC = float(os.environ.get("EVENT_MAX_LATENESS_SEC", "30"))
+# Live mode: stamps further than this ahead of the wall clock are clamped
+MAX_FUTURE_SEC = float(os.environ.get("EVENT_MAX_FUTURE_SEC", "300"))
+
+
+class EventClock:
+    # Windows run on the time written in the log line, not on when we read
+    # it, so a backlog read in one go keeps its real spacing. The newest
+    # stamp seen is the watermark; lines without a stamp use it (or the
+    # wall clock before the first one) and lines more than max_lateness
+    # behind it are counted as late and skipped.
+    def __init__(self, max_lateness=MAX_LATENESS_SEC, live=True, max_future=MAX_FUTURE_SEC):
+        self.max_lateness = float(max_lateness)
+        self.live = live
+        self.max_future = float(max_future)
+        self.watermark = None
+        self.late = 0
+        self.missing = 0
+
+    def observe(self, ts):
+        wm = self.watermark
+        if ts is None:
+            self.missing += 1
+            return time.time() if wm is None else wm
+        if self.live:
+            # A bogus future stamp must not push every later line out as late
+            limit = time.time() + self.max_future
+            if ts > limit:
+                ts = limit
+        if wm is None or ts > wm:
+            self.watermark = ts
+            return ts
+        if wm - ts > self.max_lateness:
+            self.late += 1
+            return None
+        return ts
+
+    def clamp(self, ts):
+        if self.live and ts is not None:
+            limit = time.time() + self.max_future
+            if ts > limit:
+                return limit
+        return ts
+
+    def settle(self, ts, seen):
+        # observe() for a chunk parsed elsewhere: the watermark is the one
+        # at the start of the chunk and `seen` the newest (clamped) stamp in
+        # the chunk up to and including this line, so the result is the same
+        # as observing the whole stream in order
+        wm = self.watermark
+        if seen is not None and (wm is None or seen > wm):
+            wm = seen
+        if ts is None:
+            self.missing += 1
+            return time.time() if wm is None else wm
+        if wm - ts > self.max_lateness:
+            self.late += 1
+            return None
+        return ts
+
+
+class Slot:
+    # ring is None while every event of the key sits in bucket `head`;
+    # most scanning IPs never need more than that
+    __slots__ = ("ring", "head", "total", "seen", "alert", "extra")
+
+    def __init__(self, head, ts, total=0, alert=0.0):
+        self.ring = None
+        self.head = head
+        self.total = total
+        self.seen = ts
+        self.alert = alert
+        self.extra = None
+
+
+class _Cold:
+    # Keys of a loaded snapshot that have not been touched since. Their
+    # Slot is built when the key comes back, so a restart does not pay for
+    # a million objects up front. Rows are in touch order, oldest first;
+    # rows before `next` are gone.
+    __slots__ = ("rows", "keys", "head", "seen", "total", "alert", "ringed", "rings", "buckets", "next", "size")
+
+    def __init__(self, keys, head, seen, total, alert, ringed, rings, buckets):
+        self.rows = dict(zip(keys, range(len(keys))))
+        self.keys = keys
+        self.head = head
+        self.seen = seen
+        self.total = total
+        self.alert = alert
+        # row -> position of its ring in `rings`
+        self.ringed = dict(zip(ringed, range(len(ringed))))
+        self.rings = rings
+        self.buckets = buckets
+        self.next = 0
+        self.size = (
+            sys.getsizeof(self.rows)
+            + sys.getsizeof(keys)
+            + (sys.getsizeof(keys[0]) * len(keys) if keys else 0)
+            + sum(col.itemsize * len(col) for col in (head, seen, total, alert, rings))
+        )
+
+    def slot(self, row):
+        slot = Slot(self.head[row], self.seen[row], self.total[row], self.alert[row])
+        pos = self.ringed.get(row)
+        if pos is not None:
+            nb = self.buckets
+            slot.ring = self.rings[pos * nb : (pos + 1) * nb]
+        return slot
+
+    def live_rows(self):
+        rows = self.rows
+        keys = self.keys
+        if len(rows) == len(keys) - self.next:
+            # Nothing thawed: a range, so columns can be sliced
+            return range(self.next, len(keys))
+        return [i for i in range(self.next, len(keys)) if keys[i] in rows]
+
+    def pick(self, col, rows):
+        if isinstance(rows, range):
+            return col[rows.start :]
+        if isinstance(col, list):
+            return list(map(col.__getitem__, rows))
+        return array(col.typecode, map(col.__getitem__, rows))
+
+
+class WindowedCounter:
+    def __init__(self, window_sec, max_keys=100000, idle_ttl=None, buckets=None):
+        self.window_sec = float(window_sec)
+        nb = buckets or min(MAX_BUCKETS, max(1, int(self.window_sec)))
+        self.buckets = max(1, int(nb))
+        self.bucket_sec = self.window_sec / self.buckets
+        self.max_keys = max(1, int(max_keys))
+        self.idle_ttl = float(idle_ttl) if idle_ttl is not None else self.window_sec
+        self._slots = OrderedDict()
+        self._cold = None
+        self._adds = 0
+        # Bytes per live slot, sampled by the owning thread in evict() so
+        # memory_bytes() never walks the dict from another thread
+        self._slot_bytes = sys.getsizeof(Slot(0, 0.0)) + 64
+        self.evicted_idle = 0
+        self.evicted_cap = 0
+        self.late_dropped = 0
+
+    def __len__(self):
+        cold = self._cold
+        return len(self._slots) + (len(cold.rows) if cold is not None else 0)
+
+    def __contains__(self, key):
+        return key in self._slots or (self._cold is not None and key in self._cold.rows)
+
+    def get(self, key):
+        slot = self._slots.get(key)
+        if slot is None and self._cold is not None:
+            slot = self._thaw(key)
+        return slot
+
+    def _thaw(self, key):
+        cold = self._cold
+        row = cold.rows.pop(key, None)
+        if row is None:
+            return None
+        slot = self._slots[key] = cold.slot(row)
+        if not cold.rows:
+            self._cold = None
+        return slot
+
+    def _thaw_all(self):
+        # Cold keys are older than every touched one: they go in front
+        cold = self._cold
+        if cold is None:
+            return
+        hot = self._slots
+        slots = self._slots = OrderedDict()
+        keys = cold.keys
+        for row in cold.live_rows():
+            slots[keys[row]] = cold.slot(row)
+        slots.update(hot)
+        self._cold = None
+
+    def _drop_oldest(self):
+        cold = self._cold
+        if cold is None:
+            self._slots.popitem(last=False)
+            return
+        rows = cold.rows
+        keys = cold.keys
+        while True:
+            row = cold.next
+            cold.next += 1
+            if rows.pop(keys[row], None) is not None:
+                break
+        if not rows:
+            self._cold = None
+
+    def _advance(self, slot, idx):
+        nb = self.buckets
+        steps = idx - slot.head
+        if steps >= nb:
+            if slot.ring is not None:
+                slot.ring = None
+            slot.total = 0
+        elif slot.ring is not None:
+            ring = slot.ring
+            head = slot.head
+            for i in range(1, steps + 1):
+                j = (head + i) % nb
+                slot.total -= ring[j]
+                ring[j] = 0
+        elif slot.total:
+            # Promote the single bucket to a full ring
+            ring = array("I", bytes(4 * nb))
+            ring[slot.head % nb] = slot.total
+            slot.ring = ring
+        slot.head = idx
+
+    def add(self, key, ts, n=1):
+        idx = int(ts // self.bucket_sec)
+        slots = self._slots
+        slot = slots.get(key)
+        if slot is None and self._cold is not None:
+            slot = self._thaw(key)
+        if slot is None:
+            slot = Slot(idx, ts)
+            slots[key] = slot
+            if len(slots) > self.max_keys or (self._cold is not None and len(self) > self.max_keys):
+                self._drop_oldest()
+                self.evicted_cap += 1
+        else:
+            slots.move_to_end(key)
+        if idx > slot.head:
+            self._advance(slot, idx)
+        elif idx < slot.head:
+            if slot.head - idx >= self.buckets:
+                # Older than the whole window: nothing left to count it in
+                self.late_dropped += 1
+                return slot.total
+            if slot.ring is None:
+                ring = array("I", bytes(4 * self.buckets))
+                ring[slot.head % self.buckets] = slot.total
+                slot.ring = ring
+        if slot.ring is not None:
+            slot.ring[idx % self.buckets] += n
+        slot.total += n
+        if ts > slot.seen:
+            slot.seen = ts
+        self._adds += 1
+        if self._adds >= EVICT_EVERY:
+            self._adds = 0
+            self.evict(ts)
+        return slot.total
+
+    def count(self, key, ts):
+        slot = self.get(key)
+        if slot is None:
+            return 0
+        idx = int(ts // self.bucket_sec)
+        if idx > slot.head:
+            self._advance(slot, idx)
+        return slot.total
+
+    def evict(self, now):
+        # Keys are kept in touch order, so idle ones are at the front
+        cutoff = now - self.idle_ttl
+        cold = self._cold
+        if cold is not None:
+            rows, keys, seen = cold.rows, cold.keys, cold.seen
+            i = cold.next
+            while i < len(keys) and seen[i] < cutoff:
+                if rows.pop(keys[i], None) is not None:
+                    self.evicted_idle += 1
+                i += 1
+            cold.next = i
+            if not rows:
+                self._cold = None
+        slots = self._slots
+        while slots:
+            key, slot = next(iter(slots.items()))
+            if slot.seen >= cutoff:
+                break
+            del slots[key]
+            self.evicted_idle += 1
+        self._sample_slot_bytes()
+
+    def _sample_slot_bytes(self):
+        # A few slots instead of every key
+        sample = 0
+        n = 0
+        for key, slot in self._slots.items():
+            sample += sys.getsizeof(key) + sys.getsizeof(slot)
+            if slot.ring is not None:
+                sample += sys.getsizeof(slot.ring)
+            n += 1
+            if n >= 64:
+                break
+        if n:
+            self._slot_bytes = sample / n
+
+    def memory_bytes(self):
+        # Safe from the metrics thread: no iteration, only len() and sizes
+        slots = self._slots
+        total = sys.getsizeof(slots) + int(self._slot_bytes * len(slots))
+        cold = self._cold
+        if cold is not None:
+            total += cold.size
+        return total
+
+    def resize(self, window_sec, max_keys=None, idle_ttl=None, buckets=None):
+        # New settings for a live counter. Counts are moved to the bucket
+        # covering the start of their old bucket; whatever falls outside a
+        # shorter window is dropped.
+        old_nb, old_sec = self.buckets, self.bucket_sec
+        self.window_sec = float(window_sec)
+        nb = buckets or min(MAX_BUCKETS, max(1, int(self.window_sec)))
+        self.buckets = max(1, int(nb))
+        self.bucket_sec = self.window_sec / self.buckets
+        self.idle_ttl = float(idle_ttl) if idle_ttl is not None else self.window_sec
+        if max_keys is not None:
+            self.max_keys = max(1, int(max_keys))
+            while len(self) > self.max_keys:
+                self._drop_oldest()
+                self.evicted_cap += 1
+        if (self.buckets, self.bucket_sec) == (old_nb, old_sec):
+            return
+        self._thaw_all()
+        nb, sec = self.buckets, self.bucket_sec
+        for slot in self._slots.values():
+            old_head = slot.head
+            head = slot.head = int(old_head * old_sec // sec)
+            ring = slot.ring
+            if ring is None:
+                continue
+            new = array("I", bytes(4 * nb))
+            total = 0
+            for j in range(old_head - old_nb + 1, old_head + 1):
+                n = ring[j % old_nb]
+                if n:
+                    idx = int(j * old_sec // sec)
+                    if head - idx < nb:
+                        new[idx % nb] += n
+                        total += n
+            slot.ring = new
+            slot.total = total
+
+    # Snapshots (state.py) are flat columns: one list comprehension per
+    # field instead of an object per key, and load() keeps them that way
+    # until a key is touched again. Keys are str or tuples of str;
+    # slot.extra is not kept.
+    def dump(self, name):
+        slots = self._slots
+        # One walk in touch order; walking an OrderedDict is the slow part
+        keys = list(slots)
+        vals = list(map(slots.__getitem__, keys))
+        head = array("q", [s.head for s in vals])
+        seen = array("d", [s.seen for s in vals])
+        total = array("I", [s.total for s in vals])
+        alert = array("d", [s.alert for s in vals])
+        ringed = array("I")
+        rings = array("I")
+        cold = self._cold
+        if cold is not None:
+            rows = cold.live_rows()
+            keys = cold.pick(cold.keys, rows) + keys
+            head = cold.pick(cold.head, rows) + head
+            seen = cold.pick(cold.seen, rows) + seen
+            total = cold.pick(cold.total, rows) + total
+            alert = cold.pick(cold.alert, rows) + alert
+            nb = cold.buckets
+            for row, pos in cold.ringed.items():
+                if cold.keys[row] in cold.rows:
+                    ringed.append(bisect_left(rows, row))
+                    rings.extend(cold.rings[pos * nb : (pos + 1) * nb])
+        offset = len(keys) - len(vals)
+        for i in compress(range(len(vals)), [s.ring is not None for s in vals]):
+            ringed.append(offset + i)
+            rings.extend(vals[i].ring)
+        meta = {"window_sec": self.window_sec, "buckets": self.buckets, "keys": len(keys)}
+        return {
+            f"{name}.meta": json.dumps(meta).encode(),
+            f"{name}.keys": "\n".join([k if k.__class__ is str else "\t".join(k) for k in keys]).encode("utf-8"),
+            f"{name}.head": head.tobytes(),
+            f"{name}.seen": seen.tobytes(),
+            f"{name}.total": total.tobytes(),
+            f"{name}.alert": alert.tobytes(),
+            f"{name}.ringed": ringed.tobytes(),
+            f"{name}.rings": rings.tobytes(),
+        }
+
+    def load(self, sections, name):
+        # Replaces the current keys with a dump(), taken with these or
+        # other settings
+        meta = json.loads(sections[f"{name}.meta"])
+        n = meta["keys"]
+        nb = meta["buckets"]
+        keys = sections[f"{name}.keys"].decode("utf-8").split("\n") if n else []
+        columns = []
+        for field, code in (("head", "q"), ("seen", "d"), ("total", "I"), ("alert", "d"), ("ringed", "I"), ("rings", "I")):
+            col = array(code)
+            col.frombytes(sections[f"{name}.{field}"])
+            columns.append(col)
+        if len(keys) != n or any(len(col) != n for col in columns[:4]) or len(columns[5]) != len(columns[4]) * nb:
+            raise ValueError(f"snapshot section {name} is inconsistent")
+        if any("\t" in k for k in keys):
+            keys = [tuple(k.split("\t")) if "\t" in k else k for k in keys]
+        self._slots = OrderedDict()
+        self._cold = _Cold(keys, *columns, nb) if n else None
+        current = (self.window_sec, self.max_keys, self.idle_ttl, self.buckets)
+        self.window_sec = float(meta["window_sec"])
+        self.buckets = nb
+        self.bucket_sec = self.window_sec / nb
+        self.resize(current[0], max_keys=current[1], idle_ttl=current[2], buckets=current[3])
+
+    def stats(self):
+        return {
+            "keys": len(self),
+            "memory_bytes": self.memory_bytes(),
+            "evicted_idle": self.evicted_idle,
+            "evicted_cap": self.evicted_cap,
+            "late_dropped": self.late_dropped,
+        }